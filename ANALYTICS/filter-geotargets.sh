@@ -3,17 +3,23 @@
 # Wrapper script to run Python geotargets filter in conda environment
 
 show_usage() {
-    echo "Usage: $(basename "$0") [search_string]"
+    echo "Usage: $(basename "$0") [--mode MODE] [search_string ...]"
+    echo "       $(basename "$0") --batch FILE"
     echo "Filter geotargets data by Criteria ID or Parent ID"
     echo ""
     echo "Arguments:"
-    echo "  search_string    String to search for (optional, will prompt if not provided)"
+    echo "  search_string    One or more strings to search for (optional, will prompt if not provided)"
     echo ""
     echo "Options:"
+    echo "  --mode MODE     substring (default), prefix or exact"
+    echo "  --batch FILE    Resolve every Criteria ID in FILE (one per line, '-' for stdin) and print CSV"
     echo "  -h, --help      Show this help message"
     echo ""
+    echo "The first lookup builds an index next to the CSV; later lookups only read matching rows."
+    echo ""
     echo "Examples:"
     echo "  $(basename "$0") 1023191"
+    echo "  $(basename "$0") --mode exact 1023191 1009540"
     echo "  $(basename "$0")"
 }
 
@@ -30,9 +36,8 @@ fi
 if [ $# -eq 0 ]; then
     echo -n "Enter the number to search for: "
     read search_string
-else
-    search_string="$1"
+    set -- "$search_string"
 fi
 
-# Run Python script with conda environment
-conda run --name google-analytics python scripts/filter-geotargets-core.py "$search_string"
+# Run Python script with conda environment; all lookups share one process
+conda run --name google-analytics python scripts/filter-geotargets-core.py "$@"
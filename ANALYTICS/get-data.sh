@@ -1,20 +1,29 @@
 #!/usr/bin/env bash
 
 usage() {
-    echo "Usage: $0 [-n LINES] [--all|-a] [--level|-l LEVEL]"
+    echo "Usage: $0 [-n LINES] [--all|-a] [--level|-l LEVEL] [--no-fetch] [--from DATE] [--to DATE] [--country NAME] [--city NAME] [--page TEXT]"
     echo ""
     echo "Options:"
     echo "  -n LINES           Specify the number of lines to display from the end of the CSV file. Default is 10 for --level 1 and 30 for --level 2."
     echo "  --all, -a          Display all lines of the CSV file."
-    echo "  --level, -l LEVEL  Specify the level of data to fetch: 1 for daily user data, 2 for detailed data. Default is 1."
+    echo "  --level, -l LEVEL  Specify the level of data to display: 1 for daily user data, 2 for detailed data. Default is 1."
+    echo "  --no-fetch         Only display the stored data, without refreshing it first."
+    echo "  --from DATE        Only display rows from this date/time on."
+    echo "  --to DATE          Only display rows up to this date/time (a date includes the whole day)."
+    echo "  --country NAME     Only display rows of this country."
+    echo "  --city NAME        Only display rows of this city."
+    echo "  --page TEXT        Only display rows whose page contains TEXT (level 2)."
     echo ""
     echo "Description:"
     echo "  This script runs a Python script using a specified Conda environment and then displays lines of a CSV file."
     echo ""
-    echo "  The script runs either 'daily-user.py' (level 1) or 'details.py' (level 2) using the Conda environment named 'google-analytics'."
-    echo "  It then determines the number of lines to display from the corresponding CSV file."
+    echo "  The script runs 'ingest.py' using the Conda environment named 'google-analytics', which refreshes both"
+    echo "  the daily user data (level 1) and the detailed data (level 2) in one batched request."
+    echo "  If the ingest daemon (scripts/daemon.py serve) is running, the refresh is delegated to it instead."
+    echo "  It then determines the number of lines to display from the CSV file of the chosen level."
     echo "  If the '-n' option is provided, it uses the specified number of lines; if '--all' is provided, it shows all lines."
     echo "  Otherwise, it defaults to displaying 10 lines for level 1 and 30 lines for level 2."
+    echo "  Filters are applied by 'scripts/query.py', which reads the CSV backwards from the end."
     echo ""
     echo "  The script attempts to use the 'bat' or 'batcat' command for displaying the CSV file with syntax highlighting."
     echo "  If neither 'bat' nor 'batcat' is available, it falls back to using the 'cat' command."
@@ -28,10 +37,19 @@ fi
 # conda bin
 export PATH="$PATH:/opt/conda/bin"
 
+# Python of the google-analytics env. The quick client commands run it
+# directly, since 'conda run' alone takes longer than they do.
+ga_python="/opt/conda/envs/google-analytics/bin/python"
+if [[ ! -x "$ga_python" ]]; then
+    ga_python="$(conda run --name google-analytics which python 2>/dev/null)"
+fi
+
 # Default values
 show_all=false
 data_level=1
 lines_to_show=""
+fetch=true
+query_args=()
 
 # Parse command line arguments
 while [[ $# -gt 0 ]]; do
@@ -48,6 +66,14 @@ while [[ $# -gt 0 ]]; do
             data_level="$2"
             shift 2
             ;;
+        --no-fetch)
+            fetch=false
+            shift
+            ;;
+        --from|--to|--country|--city|--page)
+            query_args+=("$1" "$2")
+            shift 2
+            ;;
         *)
             echo "Unknown option: $1"
             usage
@@ -70,10 +96,8 @@ script_dir="$(dirname "$0")"
 mkdir -p "$script_dir/data"
 
 if [[ "$data_level" == 1 ]]; then
-    conda run --name google-analytics python "$script_dir/scripts/daily-user.py"
     csv_file="$script_dir/data/raw_data.csv"
 elif [[ "$data_level" == 2 ]]; then
-    conda run --name google-analytics python "$script_dir/scripts/details.py"
     csv_file="$script_dir/data/raw_data_detail.csv"
 else
     echo "Invalid data level: $data_level. Must be 1 or 2."
@@ -81,15 +105,45 @@ else
     exit 1
 fi
 
+# Refresh both levels with one client and one batched request. If the ingest
+# daemon (scripts/daemon.py serve) is running, ask it instead: its client and
+# indexes are already warm. Every script runs in the google-analytics env;
+# only ingest.py goes through 'conda run'.
+if $fetch; then
+    "$ga_python" "$script_dir/scripts/daemon.py" refresh > /dev/null 2>&1
+    daemon_status=$?
+    if [[ "$daemon_status" == 2 || "$daemon_status" == 127 ]]; then
+        conda run --name google-analytics python "$script_dir/scripts/ingest.py"
+    elif [[ "$daemon_status" != 0 ]]; then
+        echo "The ingest daemon failed to refresh; see '$ga_python $script_dir/scripts/daemon.py status'"
+    fi
+fi
+
+# Highlight CSV read from stdin with bat/batcat, or pass it through with cat
+viewer() {
+    if [[ "$1" == cat ]]; then
+        cat
+    else
+        "$1" --style=plain --paging=never --language csv
+    fi
+}
+
 # Function to display the data
 display_data() {
-    if $show_all; then
-        cat "$csv_file" | "$1" --style=plain --paging=never --language csv
+    if [[ ${#query_args[@]} -gt 0 ]]; then
+        if $show_all; then
+            query_args+=(--all)
+        else
+            query_args+=(-n "$lines_to_show")
+        fi
+        "$ga_python" "$script_dir/scripts/query.py" -l "$data_level" "${query_args[@]}" | viewer "$1"
+    elif $show_all; then
+        cat "$csv_file" | viewer "$1"
     else
         {
             head -n 1 "$csv_file"
             tail -n "$lines_to_show" "$csv_file"
-        } | "$1" --style=plain --paging=never --language csv
+        } | viewer "$1"
     fi
 }
 
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""Archive snapshots for daily-user.py and details.py.
+
+By default a snapshot is a full copy of the live CSV, as it has always been.
+Set GA_ARCHIVE_MODE=chunked to store snapshots as gzip-compressed,
+content-addressed chunks instead: the CSV is split into one chunk per month,
+each chunk is stored once under its SHA-256, and a small JSON manifest lists
+the chunks of a snapshot. Months that did not change since the previous
+snapshot are shared, so storage grows with new data only.
+
+Usage:
+    python archive.py list <archive_dir> <base_filename>
+    python archive.py restore <manifest> <output.csv>
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+# Configuration
+ARCHIVE_MODE = os.environ.get("GA_ARCHIVE_MODE", "copy")
+CHUNK_DIR = "chunks"
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+def iter_month_chunks(csv_path: Path) -> Iterator[Tuple[str, bytes]]:
+    """Split a date/time-sorted CSV into one byte chunk per month.
+
+    The header is not part of any chunk. Concatenating the chunks in order
+    gives back every byte after the header.
+
+    Yields:
+        Tuple[str, bytes]: Month key ("YYYY-MM") and the raw lines of that month
+    """
+    with open(csv_path, "rb") as f:
+        f.readline()
+        key = None
+        parts = []
+        for line in f:
+            line_key = line.lstrip(b'"')[:7].decode("utf-8", "replace")
+            if key is not None and line_key != key:
+                yield key, b"".join(parts)
+                parts = []
+            key = line_key
+            parts.append(line)
+        if parts:
+            yield key, b"".join(parts)
+
+
+def store_chunk(archive_dir: Path, data: bytes) -> Tuple[str, bool]:
+    """Store a chunk under its SHA-256 unless it is already there.
+
+    Returns:
+        Tuple[str, bool]: The digest, and whether the chunk was newly written
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    path = archive_dir / CHUNK_DIR / f"{digest}.gz"
+    if path.exists():
+        return digest, False
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with gzip.open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return digest, True
+
+
+def write_chunked_snapshot(source_file: Path, manifest_path: Path) -> int:
+    """Archive a CSV as content-addressed month chunks plus a manifest.
+
+    Returns:
+        int: Number of chunks that were not already stored
+    """
+    archive_dir = manifest_path.parent
+    with open(source_file, "rb") as f:
+        header = f.readline()
+
+    chunks = []
+    new_chunks = 0
+    for key, data in iter_month_chunks(source_file):
+        digest, created = store_chunk(archive_dir, data)
+        new_chunks += created
+        chunks.append({"month": key, "sha256": digest, "size": len(data)})
+
+    stat = source_file.stat()
+    manifest = {
+        "source": source_file.name,
+        "header": header.decode("utf-8"),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "chunks": chunks,
+    }
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    return new_chunks
+
+
+def restore_snapshot(manifest_path: Path, output_path: Path) -> None:
+    """Rebuild the archived CSV, byte for byte, from a manifest."""
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    chunk_dir = manifest_path.parent / CHUNK_DIR
+    tmp_path = output_path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as out:
+        out.write(manifest["header"].encode("utf-8"))
+        for chunk in manifest["chunks"]:
+            with gzip.open(chunk_dir / f"{chunk['sha256']}.gz", "rb") as f:
+                data = f.read()
+            if hashlib.sha256(data).hexdigest() != chunk["sha256"]:
+                raise ValueError(f"Corrupt chunk {chunk['sha256']} ({chunk['month']})")
+            out.write(data)
+
+    if tmp_path.stat().st_size != manifest["size"]:
+        raise ValueError(f"Restored size does not match manifest: {manifest_path}")
+    os.replace(tmp_path, output_path)
+    os.utime(output_path, (manifest["mtime"], manifest["mtime"]))
+
+
+def list_snapshots(archive_dir: Path, base_filename: str) -> List[Tuple[Path, datetime]]:
+    """List the copied and chunked snapshots of a dataset, newest first."""
+    pattern = re.compile(
+        rf'{re.escape(base_filename)}_(\d{{4}}-\d{{2}}-\d{{2}})(\.csv|{re.escape(MANIFEST_SUFFIX)})$'
+    )
+    snapshots = []
+    for file in archive_dir.glob(f'{base_filename}_*'):
+        match = pattern.match(file.name)
+        if match:
+            snapshots.append((file, datetime.strptime(match.group(1), '%Y-%m-%d')))
+    snapshots.sort(key=lambda x: x[1], reverse=True)
+    return snapshots
+
+
+def archive_snapshot(source_file: Path, archive_dir: Path, base_filename: str, today: datetime) -> Path:
+    """Archive the live CSV using the configured archive mode.
+
+    Args:
+        source_file (Path): Live data file
+        archive_dir (Path): Archive directory
+        base_filename (str): Data file name without extension (e.g. "raw_data")
+        today (datetime): Date used in the snapshot name
+
+    Returns:
+        Path: The archived CSV (copy mode) or manifest (chunked mode)
+    """
+    stem = f"{base_filename}_{today.strftime('%Y-%m-%d')}"
+    if ARCHIVE_MODE == "chunked":
+        manifest_path = archive_dir / f"{stem}{MANIFEST_SUFFIX}"
+        new_chunks = write_chunked_snapshot(source_file, manifest_path)
+        logging.info(f"Stored {new_chunks} new chunk(s) for snapshot {manifest_path.name}")
+        return manifest_path
+
+    archive_path = archive_dir / f"{stem}.csv"
+    shutil.copy2(source_file, archive_path)
+    return archive_path
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Inspect and restore data archives")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = subparsers.add_parser("list", help="List snapshots of a dataset")
+    list_parser.add_argument("archive_dir", type=Path)
+    list_parser.add_argument("base_filename", help='e.g. "raw_data" or "raw_data_detail"')
+
+    restore_parser = subparsers.add_parser("restore", help="Rebuild a CSV from a snapshot manifest")
+    restore_parser.add_argument("manifest", type=Path)
+    restore_parser.add_argument("output", type=Path)
+
+    args = parser.parse_args()
+    try:
+        if args.command == "list":
+            for path, date in list_snapshots(args.archive_dir, args.base_filename):
+                print(f"{date.date()}  {path.name}")
+        else:
+            restore_snapshot(args.manifest, args.output)
+            print(f"Restored {args.output}")
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""Benchmark the ingest -> merge -> archive stages of details.py and daily-user.py.
+
+For every script and history size, a fresh working directory is filled with
+a synthetic history CSV of that many rows (made with the offline fake GA
+client), then these stages run in order on a fake API response covering the
+usual look-back window:
+
+    process_response, load_existing_data, merge_and_save_data, check_and_archive_data
+
+The other storage paths then run on fresh copies of the same history:
+
+    unseen_rows, upsert_csv          row-hash lookup (building the index) and tail rewrite
+    stream_merge_csv                 chunked full pass (GA_MERGE_MODE=stream)
+    wal_append, wal_compact          write-ahead log (GA_MERGE_MODE=wal)
+    parquet_import, parquet_merge    Parquet partitions, if pyarrow is installed
+    *_build, *_update                rollups and sessions (details) or the summary
+                                     (daily-user): full build, then the update after
+                                     the upsert
+
+Each case runs in its own process so peak RSS is not polluted by earlier
+cases. Wall time, peak RSS and bytes read/written are recorded per stage and
+written as JSON. Compare mode flags stages that got slower or hungrier than a
+stored baseline and exits with status 1 if any did.
+
+Usage:
+    python benchmark.py run [--rows 10000 1000000 10000000] [--scripts details daily-user]
+                            [--output FILE] [--baseline FILE] [--threshold 0.1]
+    python benchmark.py compare <baseline.json> <current.json> [--threshold 0.1]
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Dict, List
+
+from ingest import load_script
+
+# Configuration
+DEFAULT_ROWS = [10000, 1000000, 10000000]
+DEFAULT_SCRIPTS = ['details', 'daily-user']
+DEFAULT_OUTPUT = '../data/benchmark.json'
+HISTORY_DAYS = 365
+CHUNK_DAYS = 30
+# Regressions smaller than these are treated as noise
+MIN_SECONDS = 0.05
+MIN_BYTES = 16 * 1024 * 1024
+
+
+def date_request(module, start: date, end: date):
+    """The script's own report request, limited to [start, end]."""
+    request = module.create_report_request(module.GA_ID, start.strftime('%Y-%m-%d'))
+    request.date_ranges[0].end_date = end.strftime('%Y-%m-%d')
+    return request
+
+
+def write_history(module, path: Path, rows: int, today: date) -> int:
+    """Write a synthetic, sorted history CSV of about `rows` rows ending yesterday.
+
+    The fake client's events are aggregated like real GA reports, so enough
+    events and cities are generated to leave at least the target number of
+    distinct rows; each month is then thinned to its share of the target.
+
+    Returns:
+        int: Number of rows written
+    """
+    from fake_ga import FakeAnalyticsClient
+
+    per_day = math.ceil(rows / HISTORY_DAYS)
+    client = FakeAnalyticsClient(rows_per_day=per_day * 2, cities=max(200, per_day * 4), skew=0)
+    first = today - timedelta(days=HISTORY_DAYS)
+
+    written = 0
+    header = True
+    start = first
+    path.parent.mkdir(parents=True, exist_ok=True)
+    while start < today:
+        end = min(start + timedelta(days=CHUNK_DAYS - 1), today - timedelta(days=1))
+        target = round(rows * ((end - first).days + 1) / HISTORY_DAYS) - written
+        df = module.process_frame(client.report_frame(date_request(module, start, end)))
+        if len(df) > target:
+            # Evenly spaced rows keep the sort order and cover the whole month
+            df = df.iloc[[round(i * len(df) / target) for i in range(target)]] if target > 0 else df.iloc[:0]
+        df.to_csv(path, mode='w' if header else 'a', header=header, index=False)
+        header = False
+        written += len(df)
+        start = end + timedelta(days=1)
+    return written
+
+
+def run_case(script: str, rows: int, workdir: Path) -> Dict:
+    """Run all stages of one script at one history size in this process."""
+    from ga_fetch import LOOKBACK_DAYS
+    from fake_ga import FakeAnalyticsClient
+    from perf import measure
+
+    dirname = Path(os.path.dirname(os.path.abspath(__file__)))
+    module = load_script(dirname, script)
+
+    # The stages resolve their files relative to the script directory
+    script_dir = workdir / 'scripts'
+    script_dir.mkdir(parents=True, exist_ok=True)
+    output_path = script_dir / module.OUTPUT_FILE
+    today = date.today()
+    history_rows = write_history(module, output_path, rows, today)
+    history_path = workdir / 'history.csv'
+    shutil.copyfile(output_path, history_path)
+
+    # New data: one API page for the look-back window, overlapping the history
+    per_day = math.ceil(rows / HISTORY_DAYS)
+    client = FakeAnalyticsClient(rows_per_day=per_day * 2, cities=max(200, per_day * 4), skew=0)
+    request = date_request(module, today - timedelta(days=LOOKBACK_DAYS), today)
+    request.limit = min(client.page_size, 100000)
+    response = client.run_report(request)
+
+    stages = {}
+    with measure() as stats:
+        new_df = module.process_response(response)
+    stages['process_response'] = dict(stats, rows_in=len(response.rows), rows_out=len(new_df))
+
+    # details.py merges encoded rows (see codec.py); daily-user.py merges strings
+    codec = codec_for(module, output_path)
+    codec_args = [codec] if codec is not None else []
+    with measure() as stats:
+        existing_df = module.load_existing_data(output_path, *codec_args)
+    stages['load_existing_data'] = dict(stats, rows_in=history_rows, rows_out=len(existing_df))
+
+    with measure() as stats:
+        module.merge_and_save_data(new_df, existing_df, output_path, *codec_args)
+    stages['merge_and_save_data'] = dict(stats, rows_in=len(new_df) + len(existing_df),
+                                         file_size=output_path.stat().st_size)
+    del existing_df
+
+    with measure() as stats:
+        module.check_and_archive_data(script_dir, module.OUTPUT_FILE)
+    stages['check_and_archive_data'] = dict(stats)
+
+    stages.update(run_storage_stages(module, new_df, history_path, workdir))
+    return {"script": script, "rows": rows, "history_rows": history_rows,
+            "new_rows": len(new_df), "stages": stages}
+
+
+def fresh_copy(history_path: Path, workdir: Path, name: str) -> Path:
+    """A copy of the history CSV in its own directory, so index files do not collide."""
+    path = workdir / name / history_path.name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(history_path, path)
+    return path
+
+
+def codec_for(module, path: Path):
+    """The codec a script merges its rows with (see codec.py), or None for plain strings."""
+    return module.open_codec(path) if hasattr(module, 'open_codec') else None
+
+
+def run_storage_stages(module, new_df, history_path: Path, workdir: Path) -> Dict:
+    """Measure the incremental storage paths and derived outputs on copies of the history."""
+    from perf import measure
+    from storage import stream_merge_csv, unseen_rows, upsert_csv
+    from wal import WriteAheadLog, compact
+
+    stages = {}
+
+    def derive(path: Path, suffix: str) -> None:
+        if hasattr(module, 'update_rollup'):
+            with measure() as stats:
+                module.update_rollup(path, path.parent / 'rollup')
+            stages[f'update_rollup_{suffix}'] = dict(stats)
+            with measure() as stats:
+                module.update_sessions(path, path.parent / 'sessions.csv', path.parent / 'sessions_state.json')
+            stages[f'update_sessions_{suffix}'] = dict(stats)
+        else:
+            with measure() as stats:
+                module.update_summary(path, path.parent / 'summary_state.json', path.parent)
+            stages[f'update_summary_{suffix}'] = dict(stats)
+
+    path = fresh_copy(history_path, workdir, 'upsert')
+    derive(path, 'build')
+    with measure() as stats:
+        unseen_df = unseen_rows(new_df, path)
+    stages['unseen_rows'] = dict(stats, rows_in=len(new_df), rows_out=len(unseen_df))
+    with measure() as stats:
+        added = upsert_csv(new_df, path, module.TIME_COLUMN, module.merge_data, codec=codec_for(module, path))
+    stages['upsert_csv'] = dict(stats, rows_in=len(new_df), rows_out=added)
+    derive(path, 'update')
+
+    path = fresh_copy(history_path, workdir, 'stream')
+    with measure() as stats:
+        added = stream_merge_csv(new_df, path, module.TIME_COLUMN, module.merge_data, codec=codec_for(module, path))
+    stages['stream_merge_csv'] = dict(stats, rows_in=len(new_df), rows_out=added)
+
+    path = fresh_copy(history_path, workdir, 'wal')
+    log = WriteAheadLog(path.parent / 'wal')
+    with measure() as stats:
+        written = log.append(unseen_df)
+    stages['wal_append'] = dict(stats, rows_in=len(unseen_df), file_size=written)
+    with measure() as stats:
+        added = compact(path, log, module.TIME_COLUMN, module.merge_data, codec_for(module, path))
+    stages['wal_compact'] = dict(stats, rows_in=len(unseen_df), rows_out=added)
+
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        logging.warning("pyarrow is not installed, skipping the Parquet stages")
+        return stages
+    path = fresh_copy(history_path, workdir, 'parquet')
+    dataset_dir = path.parent / 'dataset'
+    with measure() as stats:
+        module.merge_and_save_partitioned(new_df.iloc[:0], dataset_dir, path)
+    stages['parquet_import'] = dict(stats)
+    with measure() as stats:
+        module.merge_and_save_partitioned(new_df, dataset_dir, path)
+    stages['parquet_merge'] = dict(stats, rows_in=len(new_df))
+    return stages
+
+
+def run_isolated(script: str, rows: int, keep: bool) -> Dict:
+    """Run one case in a child process and return its result."""
+    workdir = Path(tempfile.mkdtemp(prefix=f"ga-bench-{script}-{rows}-"))
+    result_path = workdir / 'result.json'
+    logging.info(f"Running {script} with {rows} history rows in {workdir}")
+    subprocess.run([sys.executable, os.path.abspath(__file__), '_case', script, str(rows),
+                    str(workdir), str(result_path)], check=True)
+    with open(result_path) as f:
+        result = json.load(f)
+    if not keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def compare_results(baseline: Dict, current: Dict, threshold: float) -> List[str]:
+    """List the stages that regressed by more than `threshold` (a fraction).
+
+    Wall time and peak RSS growth over the stage are compared; differences
+    below MIN_SECONDS / MIN_BYTES are ignored as noise.
+    """
+    def index(report):
+        return {(r['script'], r['rows'], stage): stats
+                for r in report['results'] for stage, stats in r['stages'].items()}
+
+    base, cur = index(baseline), index(current)
+    regressions = []
+    for key in sorted(base.keys() & cur.keys()):
+        b, c = base[key], cur[key]
+        checks = [
+            ('seconds', b['seconds'], c['seconds'], MIN_SECONDS),
+            ('peak_rss', b['peak_rss'] - b['rss_start'], c['peak_rss'] - c['rss_start'], MIN_BYTES),
+        ]
+        for metric, old, new, floor in checks:
+            if new - old > floor and new > old * (1 + threshold):
+                change = (new / old - 1) * 100 if old else float('inf')
+                regressions.append(f"{key[0]} rows={key[1]} {key[2]}: {metric} {old:.6g} -> {new:.6g} (+{change:.0f}%)")
+    return regressions
+
+
+def print_results(report: Dict) -> None:
+    print(f"{'script':<12}{'rows':>10}  {'stage':<24}{'seconds':>10}{'peak MiB':>10}{'written MiB':>13}")
+    for result in report['results']:
+        for stage, stats in result['stages'].items():
+            written = stats.get('bytes_written')
+            written = f"{written / 2**20:.1f}" if written is not None else "-"
+            print(f"{result['script']:<12}{result['rows']:>10}  {stage:<24}{stats['seconds']:>10.3f}"
+                  f"{(stats['peak_rss'] - stats['rss_start']) / 2**20:>10.1f}{written:>13}")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Benchmark the GA ingest pipeline")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmark")
+    run_parser.add_argument("--rows", type=int, nargs="+", default=DEFAULT_ROWS)
+    run_parser.add_argument("--scripts", nargs="+", choices=DEFAULT_SCRIPTS, default=DEFAULT_SCRIPTS)
+    run_parser.add_argument("--output", type=Path, help=f"Result JSON (default: {DEFAULT_OUTPUT})")
+    run_parser.add_argument("--baseline", type=Path, help="Compare against this result JSON")
+    run_parser.add_argument("--threshold", type=float, default=0.1)
+    run_parser.add_argument("--keep", action="store_true", help="Keep the working directories")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("baseline", type=Path)
+    compare_parser.add_argument("current", type=Path)
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+
+    case_parser = subparsers.add_parser("_case")
+    case_parser.add_argument("script")
+    case_parser.add_argument("rows", type=int)
+    case_parser.add_argument("workdir", type=Path)
+    case_parser.add_argument("result", type=Path)
+
+    args = parser.parse_args()
+
+    if args.command == "_case":
+        # Keep the scripts' own logging out of the measurements
+        logging.getLogger().setLevel(logging.WARNING)
+        result = run_case(args.script, args.rows, args.workdir)
+        with open(args.result, "w") as f:
+            json.dump(result, f)
+        return
+
+    if args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+    else:
+        current = {
+            "created": datetime.now().isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {k: v for k, v in os.environ.items() if k.startswith("GA_")},
+            "results": [run_isolated(script, rows, args.keep) for script in args.scripts for rows in args.rows],
+        }
+        output = args.output or Path(os.path.dirname(os.path.abspath(__file__))) / DEFAULT_OUTPUT
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(current, f, indent=2)
+        print_results(current)
+        logging.info(f"Results written to {output}")
+        if not args.baseline:
+            return
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = compare_results(baseline, current, args.threshold)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    if regressions:
+        sys.exit(1)
+    print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""On-disk checkpoints of fetched report pages.
+
+Every page fetched by ga_fetch is processed and then written to
+../data/checkpoints/<dataset>/<shard>/ before the next page is requested.
+The shard directory is named after a hash of the shard's request (without
+limit and offset), so a run that failed half way, and is started again with
+the same request, loads the pages it already has and continues from the
+next offset instead of downloading and parsing them again. Shards whose
+pages were all fetched are skipped entirely.
+
+The checkpoints of a dataset are cleared once its rows are stored.
+Checkpoints older than GA_CHECKPOINT_TTL_HOURS (default 24) are ignored,
+as GA may have revised the data since.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import pandas as pd
+
+# Configuration
+CHECKPOINT_DIR = '../data/checkpoints'
+CHECKPOINT_TTL_HOURS = float(os.environ.get("GA_CHECKPOINT_TTL_HOURS", "24"))
+META_FILE = "meta.json"
+
+
+def request_key(request) -> str:
+    """Stable name of a shard request, ignoring the paging fields."""
+    base = type(request)(request)
+    base.limit = 0
+    base.offset = 0
+    base.return_property_quota = False
+    return hashlib.sha256(type(request).serialize(base)).hexdigest()[:20]
+
+
+class FetchCheckpoint:
+    """Processed pages of the shards of one dataset, kept until the dataset is stored."""
+
+    def __init__(self, directory: Path, ttl_hours: float = CHECKPOINT_TTL_HOURS):
+        self.directory = directory
+        self.ttl_seconds = ttl_hours * 3600
+
+    def _shard_dir(self, request) -> Path:
+        return self.directory / request_key(request)
+
+    def _read_meta(self, shard_dir: Path) -> Dict:
+        with open(shard_dir / META_FILE) as f:
+            return json.load(f)
+
+    def _write_meta(self, shard_dir: Path, meta: Dict) -> None:
+        tmp_path = shard_dir / (META_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, shard_dir / META_FILE)
+
+    def load(self, request) -> Tuple[List[pd.DataFrame], int, bool]:
+        """Pages already fetched for a shard.
+
+        Returns:
+            Tuple[List[pd.DataFrame], int, bool]: Processed pages in order,
+                the offset to continue from, and whether the shard is complete
+        """
+        shard_dir = self._shard_dir(request)
+        if not (shard_dir / META_FILE).exists():
+            return [], 0, False
+        try:
+            meta = self._read_meta(shard_dir)
+            if time.time() - meta["created"] > self.ttl_seconds:
+                logging.info(f"Discarding expired checkpoint {shard_dir.name}")
+                shutil.rmtree(shard_dir, ignore_errors=True)
+                return [], 0, False
+            frames = [pd.read_pickle(shard_dir / page["file"]) for page in meta["pages"]]
+            offset = sum(page["rows"] for page in meta["pages"])
+            return frames, offset, meta["complete"]
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable checkpoint {shard_dir}: {e}")
+            shutil.rmtree(shard_dir, ignore_errors=True)
+            return [], 0, False
+
+    def save_page(self, request, offset: int, rows: int, frame: pd.DataFrame) -> None:
+        """Store one processed page; pages must be saved in offset order."""
+        shard_dir = self._shard_dir(request)
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        meta = self._read_meta(shard_dir) if (shard_dir / META_FILE).exists() else \
+            {"created": time.time(), "complete": False, "pages": []}
+        name = f"page-{offset:010d}.pkl"
+        tmp_path = shard_dir / (name + ".tmp")
+        frame.to_pickle(tmp_path)
+        os.replace(tmp_path, shard_dir / name)
+        meta["pages"].append({"offset": offset, "rows": rows, "file": name})
+        self._write_meta(shard_dir, meta)
+
+    def complete(self, request) -> None:
+        """Mark a shard as fully fetched."""
+        shard_dir = self._shard_dir(request)
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        meta = self._read_meta(shard_dir) if (shard_dir / META_FILE).exists() else \
+            {"created": time.time(), "complete": False, "pages": []}
+        meta["complete"] = True
+        self._write_meta(shard_dir, meta)
+
+    def clear(self) -> None:
+        """Drop every checkpoint of the dataset, once its rows are stored."""
+        if self.directory.exists():
+            shutil.rmtree(self.directory, ignore_errors=True)
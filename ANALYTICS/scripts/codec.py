@@ -0,0 +1,182 @@
+"""Compact in-memory representation of detail rows.
+
+Read as plain strings, every cell of raw_data_detail.csv is a separate
+Python object, although the data holds only a few thousand distinct
+countries, cities, devices and pages. The detail merges (upsert_csv,
+stream_merge_csv, the write-ahead log compaction and the full merge in
+details.py) work on encoded rows instead:
+
+* string columns become int32 codes into a vocabulary shared by all chunks
+  and runs and persisted next to the CSV (raw_data_detail.vocab.json); it
+  only ever grows, so a value keeps its code;
+* newUsers becomes a boolean (True for "New");
+* time becomes int32 minutes since the epoch.
+
+Deduplication and sorting then compare small integers, and rows are turned
+back into the exact CSV text only when written. Values the encoding cannot
+hold exactly (a time with seconds, a newUsers other than New/Return) raise
+CodecError, and the callers fall back to merging strings.
+"""
+import csv
+import io
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# Configuration
+VOCAB_SUFFIX = ".vocab.json"
+TIME_COLUMN = 'time'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+FLAG_COLUMN = 'newUsers'
+FLAG_VALUES = ("Return", "New")  # False, True
+
+_CODECS: Dict[Path, "Codec"] = {}
+
+
+class CodecError(ValueError):
+    """Rows hold a value the encoding cannot represent exactly."""
+
+
+class Codec:
+    """Encodes the rows of one CSV against its persisted vocabulary (see load_codec).
+
+    Args:
+        csv_path (Path): Data file; the vocabulary is kept next to it
+        clean (Optional[Callable]): clean(column, values) applied to the
+            distinct string values of a column before they are encoded
+    """
+
+    def __init__(self, csv_path: Path, clean: Optional[Callable[[str, np.ndarray], np.ndarray]] = None):
+        self.path = csv_path.with_name(csv_path.stem + VOCAB_SUFFIX)
+        self.clean = clean
+        self.values: Dict[str, List[str]] = {}
+        if self.path.exists():
+            try:
+                with open(self.path) as f:
+                    self.values = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Could not read vocabulary {self.path}: {e}")
+        self._lookup = {column: {value: code for code, value in enumerate(values)}
+                        for column, values in self.values.items()}
+        self.changed = False
+
+    def codes(self, column: str, values: np.ndarray) -> np.ndarray:
+        """Codes of distinct values, adding unseen values to the column's vocabulary."""
+        known = self.values.setdefault(column, [])
+        lookup = self._lookup.setdefault(column, {})
+        mapping = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            code = lookup.get(value)
+            if code is None:
+                code = lookup[value] = len(known)
+                known.append(value)
+                self.changed = True
+            mapping[i] = code
+        return mapping
+
+    def encode(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Encode a frame of strings.
+
+        Every column but time is factorized first, so cleaning and the
+        vocabulary lookups only see distinct values. Missing values become "".
+
+        Raises:
+            CodecError: If a time or newUsers value cannot be encoded exactly
+        """
+        encoded = {}
+        for column in df.columns:
+            if column == TIME_COLUMN:
+                # Times are nearly all distinct, so they are parsed as they are
+                try:
+                    times = pd.DatetimeIndex(pd.to_datetime(df[column], format=TIME_FORMAT))
+                except (ValueError, TypeError) as e:
+                    raise CodecError(f"Cannot encode time: {e}") from e
+                if times.hasnans or (times.second != 0).any():
+                    raise CodecError("Cannot encode missing times or times with seconds as minutes")
+                encoded[column] = times.to_numpy(dtype='datetime64[m]').astype(np.int64).astype(np.int32)
+                continue
+            codes, uniques = pd.factorize(df[column], use_na_sentinel=False)
+            uniques = pd.Series(uniques, dtype=object).fillna("").astype(str).to_numpy(dtype=object)
+            if self.clean is not None:
+                uniques = self.clean(column, uniques)
+            if column == FLAG_COLUMN:
+                unknown = set(uniques) - set(FLAG_VALUES)
+                if unknown:
+                    raise CodecError(f"Cannot encode {column} values {sorted(unknown)[:5]} as booleans")
+                encoded[column] = (uniques == FLAG_VALUES[1])[codes]
+            else:
+                encoded[column] = self.codes(column, uniques)[codes]
+        return pd.DataFrame(encoded, columns=df.columns)
+
+    def decoded_values(self, column: str, values: np.ndarray) -> np.ndarray:
+        """The strings of distinct encoded values of a column."""
+        if column == TIME_COLUMN:
+            return pd.DatetimeIndex(values.astype('datetime64[m]')).strftime(TIME_FORMAT).to_numpy(dtype=object)
+        if column == FLAG_COLUMN:
+            return np.where(values, FLAG_VALUES[1], FLAG_VALUES[0]).astype(object)
+        return np.asarray(self.values.get(column, []), dtype=object)[values]
+
+    def decode(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Turn an encoded frame back into strings."""
+        out = {}
+        for column in df.columns:
+            codes, uniques = pd.factorize(df[column].to_numpy())
+            out[column] = self.decoded_values(column, uniques)[codes]
+        return pd.DataFrame(out, columns=df.columns, index=df.index, dtype=object)
+
+    def to_csv(self, df: pd.DataFrame) -> str:
+        """CSV lines of an encoded frame, without a header.
+
+        Each distinct value is decoded and quoted once, so the text is the
+        same to_csv would write for the decoded frame.
+        """
+        if df.empty:
+            return ""
+        columns = []
+        for column in df.columns:
+            codes, uniques = pd.factorize(df[column].to_numpy())
+            columns.append(_csv_fields(self.decoded_values(column, uniques))[codes])
+        return "".join([",".join(row) + "\n" for row in zip(*columns)])
+
+    def save(self) -> None:
+        """Persist the vocabulary if values were added since it was loaded."""
+        if not self.changed:
+            return
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.values, f)
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+
+def is_encoded(df: pd.DataFrame) -> bool:
+    return TIME_COLUMN in df.columns and pd.api.types.is_integer_dtype(df[TIME_COLUMN])
+
+
+def load_codec(csv_path: Path, clean: Optional[Callable[[str, np.ndarray], np.ndarray]] = None) -> Codec:
+    """The codec of a CSV; kept in memory for the life of the process."""
+    key = csv_path.resolve()
+    if key not in _CODECS:
+        _CODECS[key] = Codec(csv_path, clean)
+    return _CODECS[key]
+
+
+def _csv_fields(values: np.ndarray) -> np.ndarray:
+    """Quote distinct values the way to_csv does (csv.QUOTE_MINIMAL)."""
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    fields = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        if value == "":
+            fields[i] = ""
+            continue
+        out.seek(0)
+        out.truncate()
+        writer.writerow([value])
+        fields[i] = out.getvalue()[:-1]
+    return fields
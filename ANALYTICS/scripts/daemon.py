@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""Long-running ingest daemon.
+
+`serve` imports the pipeline once, keeps the GA client and the row-hash
+indexes of the data files in memory, and refreshes every level through
+ingest.py on a schedule. Each refresh only appends or rewrites the changed
+tail of the data files, like a normal run.
+
+The other commands talk to a running daemon over a Unix socket next to the
+data and only use the standard library, so they start in milliseconds:
+
+    python daemon.py serve [--interval SECONDS] [--levels daily detail]
+    python daemon.py refresh          # refresh now and wait for it
+    python daemon.py tail LEVEL [-n N] # last N rows of a level as CSV
+    python daemon.py status
+    python daemon.py stop
+
+Client commands exit with status 2 when no daemon is listening, so callers
+such as get-data.sh can fall back to running ingest.py.
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict
+
+from query import LEVEL_KEY_FIELDS, read_tail
+
+# Configuration
+SOCKET_FILE = '../data/ingest.sock'
+REFRESH_INTERVAL = int(os.environ.get("GA_DAEMON_INTERVAL", "3600"))
+CLIENT_TIMEOUT = 600
+OUTPUT_FILES = {'daily': '../data/raw_data.csv', 'detail': '../data/raw_data_detail.csv'}
+KEY_FIELDS = {'daily': LEVEL_KEY_FIELDS['1'], 'detail': LEVEL_KEY_FIELDS['2']}
+
+
+class IngestDaemon:
+    """Warm ingest state plus the scheduler that refreshes it."""
+
+    def __init__(self, dirname: Path, levels: list, interval: int):
+        from ingest import load_levels
+
+        self.dirname = dirname
+        self.modules = load_levels(dirname, levels)
+        self.interval = interval
+        self.client = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.last_refresh = None
+        self.last_result = None
+        self.last_error = None
+
+    def refresh(self) -> Dict:
+        """Run one refresh; concurrent callers wait for the one in progress."""
+        from ingest import ingest, setup_client
+
+        with self.lock:
+            start = time.perf_counter()
+            try:
+                if self.client is None:
+                    self.client = setup_client(self.dirname, self.modules)
+                self.last_result = ingest(self.dirname, self.modules, self.client)
+                self.last_error = None
+            except Exception as e:
+                logging.error(f"Refresh failed: {e}")
+                self.last_error = f"{type(e).__name__}: {e}"
+                # A broken connection should not poison the next refresh
+                self.client = None
+            self.last_refresh = datetime.now().isoformat(timespec='seconds')
+            return {"ok": self.last_error is None, "fetched": self.last_result,
+                    "error": self.last_error, "seconds": round(time.perf_counter() - start, 3)}
+
+    def status(self) -> Dict:
+        return {"ok": True, "pid": os.getpid(), "levels": list(self.modules),
+                "interval": self.interval, "last_refresh": self.last_refresh,
+                "last_result": self.last_result, "last_error": self.last_error,
+                "refreshing": self.lock.locked()}
+
+    def tail(self, level: str, n: int) -> Dict:
+        path = self.dirname / OUTPUT_FILES[level]
+        if not path.exists():
+            return {"ok": False, "error": f"{path} not found"}
+        header, lines = read_tail(path, n, KEY_FIELDS[level])
+        return {"ok": True, "csv": "\n".join([header] + lines) + "\n"}
+
+    def handle(self, command: Dict) -> Dict:
+        name = command.get("command")
+        if name == "refresh":
+            return self.refresh()
+        if name == "status":
+            return self.status()
+        if name == "tail":
+            return self.tail(command.get("level", "daily"), int(command.get("n", 10)))
+        if name == "stop":
+            self.stopping.set()
+            return {"ok": True}
+        return {"ok": False, "error": f"Unknown command: {name}"}
+
+    def run_schedule(self) -> None:
+        """Refresh immediately and then every interval seconds until stopped."""
+        while not self.stopping.is_set():
+            self.refresh()
+            self.stopping.wait(self.interval)
+
+
+def serve(dirname: Path, levels: list, interval: int) -> None:
+    socket_path = dirname / SOCKET_FILE
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    if socket_path.exists():
+        if _send(socket_path, {"command": "status"}, timeout=5) is not None:
+            raise RuntimeError(f"A daemon is already listening on {socket_path}")
+        socket_path.unlink()
+
+    daemon = IngestDaemon(dirname, levels, interval)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                command = json.loads(self.rfile.readline())
+                reply = daemon.handle(command)
+            except Exception as e:
+                reply = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+    server = socketserver.ThreadingUnixStreamServer(str(socket_path), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Listening on {socket_path}, refreshing every {interval}s")
+    try:
+        daemon.run_schedule()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        socket_path.unlink(missing_ok=True)
+        logging.info("Daemon stopped")
+
+
+def _send(socket_path: Path, command: Dict, timeout: float = CLIENT_TIMEOUT):
+    """Send one command to the daemon; None if no daemon answered.
+
+    A missing socket, a refused connection, a daemon that hangs past the
+    timeout and a connection closed without a reply all count as no daemon,
+    so callers fall back to running ingest.py.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(str(socket_path))
+            sock.sendall(json.dumps(command).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as f:
+                return json.loads(f.readline())
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    except (OSError, ValueError) as e:
+        # OSError covers TimeoutError (socket.timeout); ValueError an empty or broken reply
+        logging.warning(f"Daemon at {socket_path} did not answer: {e}")
+        return None
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Long-running GA ingest daemon")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Run the daemon")
+    serve_parser.add_argument("--interval", type=int, default=REFRESH_INTERVAL,
+                              help=f"Seconds between refreshes (default: {REFRESH_INTERVAL})")
+    serve_parser.add_argument("--levels", nargs="+", choices=list(OUTPUT_FILES), default=list(OUTPUT_FILES))
+
+    subparsers.add_parser("refresh", help="Ask the daemon to refresh now and wait for it")
+    tail_parser = subparsers.add_parser("tail", help="Print the last rows of a level as CSV")
+    tail_parser.add_argument("level", choices=list(OUTPUT_FILES))
+    tail_parser.add_argument("-n", type=int, default=10)
+    subparsers.add_parser("status", help="Show the daemon state")
+    subparsers.add_parser("stop", help="Stop the daemon")
+
+    args = parser.parse_args()
+    dirname = Path(os.path.dirname(os.path.abspath(__file__)))
+
+    if args.command == "serve":
+        try:
+            serve(dirname, args.levels, args.interval)
+        except Exception as e:
+            logging.error(f"Daemon failed: {e}")
+            sys.exit(1)
+        return
+
+    command = {"command": args.command}
+    if args.command == "tail":
+        command.update(level=args.level, n=args.n)
+    reply = _send(dirname / SOCKET_FILE, command)
+    if reply is None:
+        print("Error: no daemon is running or it did not answer", file=sys.stderr)
+        sys.exit(2)
+    if args.command == "tail" and reply.get("ok"):
+        sys.stdout.write(reply["csv"])
+    else:
+        print(json.dumps(reply, indent=2))
+    if not reply.get("ok"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
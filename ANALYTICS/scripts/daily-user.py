@@ -9,9 +9,25 @@ import logging
 from typing import List, Dict
 from datetime import datetime
 from pathlib import Path
-from tqdm import tqdm
-import re
-import shutil
+
+from fake_ga import FAKE_GA, FakeAnalyticsClient
+from instrument import PROFILE_DIR, RUN_LOG_FILE, RunRecorder
+from ga_fetch import (
+    FIRST_DATE, STATE_FILE, QuotaTracker, compute_start_date, fetch_report_frames,
+    format_timestamps, load_watermark, read_last_value, response_to_frame,
+    save_watermark
+)
+from checkpoint import CHECKPOINT_DIR, FetchCheckpoint
+from response_cache import open_cache
+from storage import (
+    DRY_RUN, EXPORT_CSV, MERGE_MODE, STORAGE_BACKEND, export_csv, format_merge_diff,
+    import_csv, latest_value, merge_diff, partition_keys, save_partitioned,
+    stream_merge_csv, unseen_rows, upsert_csv
+)
+from wal import COMPACT_ROWS as WAL_COMPACT_ROWS, WAL_DIR, WriteAheadLog, compact
+from archive import archive_snapshot, list_snapshots
+from geotargets import GEOTARGETS_FILE, update_city_table
+from summary import SUMMARY_DIR, SUMMARY_STATE, update_summary
 
 # Setup logging
 logging.basicConfig(
@@ -23,7 +39,16 @@ logging.basicConfig(
 CREDENTIALS_PATH = "my-website-analytics-b37a5d44bcc6.json"
 GA_ID = '434705894'
 OUTPUT_FILE = '../data/raw_data.csv'
+TIME_COLUMN = 'date'  # Sort key and high-water mark column
+KEY_COLUMNS = ['date', 'country', 'city', 'cityId']  # A new row replaces the stored row with its key
 ARCHIVE_DIR = '../data/archive'
+CITIES_FILE = '../data/cities.csv'
+DATASET_DIR = '../data/raw_data'  # Parquet dataset used when GA_STORAGE=parquet
+COLUMN_DTYPES = {
+    'date': 'string', 'country': 'string', 'city': 'string', 'cityId': 'string',
+    'activeUsers': 'int64', 'newUsers': 'int64'
+}
+DICTIONARY_COLUMNS = ['date', 'country', 'city', 'cityId']
 
 def setup_ga_client(credentials_path: str) -> BetaAnalyticsDataClient:
     """Initialize the Google Analytics client with credentials.
@@ -34,27 +59,35 @@ def setup_ga_client(credentials_path: str) -> BetaAnalyticsDataClient:
     Returns:
         BetaAnalyticsDataClient: Initialized GA client
         
+    Note:
+        With GA_FAKE=1 an offline FakeAnalyticsClient is returned instead,
+        configured through the GA_FAKE_* environment variables.
+        
     Raises:
         Exception: If client initialization fails
     """
     try:
+        if FAKE_GA:
+            logging.info("Using the offline fake GA client")
+            return FakeAnalyticsClient.from_env()
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_path
         return BetaAnalyticsDataClient()
     except Exception as e:
         logging.error(f"Failed to initialize GA client: {e}")
         raise
 
-def create_report_request(ga_id: str) -> RunReportRequest:
+def create_report_request(ga_id: str, start_date: str = FIRST_DATE) -> RunReportRequest:
     """Create a report request with specified dimensions and metrics.
     
     Args:
         ga_id (str): Google Analytics property ID
+        start_date (str): First date to request, in YYYY-MM-DD format
         
     Returns:
         RunReportRequest: Configured request object with:
             - Dimensions: date, country, city, cityId
             - Metrics: activeUsers, newUsers
-            - Date range: from 2020-04-01 to 2030-12-31
+            - Date range: from start_date to today
     """
     return RunReportRequest(
         property=f"properties/{ga_id}",
@@ -68,12 +101,15 @@ def create_report_request(ga_id: str) -> RunReportRequest:
             Metric(name="activeUsers"),
             Metric(name="newUsers")
         ],
-        date_ranges=[DateRange(start_date="2020-04-01", end_date="2030-12-31")],
+        date_ranges=[DateRange(start_date=start_date, end_date="today")],
     )
 
 def process_response(response) -> pd.DataFrame:
     """Process the GA response into a pandas DataFrame.
     
+    The response is decoded column by column, with no per-row Python work
+    after decoding.
+    
     Args:
         response: Google Analytics API response object
         
@@ -84,17 +120,19 @@ def process_response(response) -> pd.DataFrame:
             - Numeric metrics
             - Properly formatted datetime
     """
-    data = []
-    for row in tqdm(response.rows, desc="Processing rows"):
-        dimension_values = [value.value for value in row.dimension_values]
-        metric_values = [value.value for value in row.metric_values]
-        data.append(dimension_values + metric_values)
+    return process_frame(response_to_frame(response))
 
-    columns = [dim.name for dim in response.dimension_headers] + [metric.name for metric in response.metric_headers]
-    df = pd.DataFrame(data, columns=columns)
+def process_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Clean a decoded report (all values as strings) into the stored format.
     
+    Args:
+        df (pd.DataFrame): Report columns as returned by response_to_frame
+        
+    Returns:
+        pd.DataFrame: Processed DataFrame, see process_response
+    """
     # Data cleaning - keep date as string to match archive format
-    df['date'] = pd.to_datetime(df['date']).dt.strftime('%Y-%m-%d')
+    df['date'] = format_timestamps(df['date'], "%Y%m%d", '%Y-%m-%d')
     df = df.sort_values('date')
     
     # Convert metrics to numeric, then back to int to match archive format
@@ -129,6 +167,46 @@ def load_existing_data(file_path: Path) -> pd.DataFrame:
         return df
     return pd.DataFrame()
 
+def merge_data(new_df: pd.DataFrame, existing_df: pd.DataFrame) -> pd.DataFrame:
+    """Merge new data with existing data.
+    
+    Args:
+        new_df (pd.DataFrame): New data from GA
+        existing_df (pd.DataFrame): Existing data
+        
+    Returns:
+        pd.DataFrame: Merged data
+        
+    Note:
+        - Removes duplicates based on date, country, city, and cityId
+        - Keeps the most recent version of duplicate entries
+        - Sorts final data by date
+    """
+    if existing_df.empty:
+        final_df = new_df
+    
+    else:
+        # Combine existing and new data
+        combined_df = pd.concat([existing_df, new_df])
+        
+        # Replace NaN with ""
+        combined_df = combined_df.fillna("")
+        
+        # Replace "(not set)" with "" in combined data (both new and existing)
+        combined_df = combined_df.replace("(not set)", "")
+        
+        # Clean cityId by removing .0 suffix if present (for existing data compatibility)
+        combined_df['cityId'] = combined_df['cityId'].astype(str).str.replace(r'\.0$', '', regex=True)
+        
+        # Remove duplicates based on date, country, city, and cityId (KEY_COLUMNS)
+        final_df = combined_df.drop_duplicates(subset=KEY_COLUMNS, keep='last')
+        
+        # Sort by date
+        final_df = final_df.sort_values('date')
+    
+    # Apply final cleaning to ensure no "(not set)" values remain
+    return final_df.replace("(not set)", "")
+
 def merge_and_save_data(new_df: pd.DataFrame, existing_df: pd.DataFrame, output_path: Path) -> None:
     """Merge new data with existing data and save to CSV.
     
@@ -141,37 +219,14 @@ def merge_and_save_data(new_df: pd.DataFrame, existing_df: pd.DataFrame, output_
         Exception: If saving fails
         
     Note:
-        - Removes duplicates based on date, country, city, and cityId
-        - Keeps the most recent version of duplicate entries
-        - Sorts final data by date
+        - Merges with merge_data
         - Creates output directory if it doesn't exist
     """
     try:
         if existing_df.empty:
-            final_df = new_df
             logging.info("No existing data found!")
         
-        else:
-            # Combine existing and new data
-            combined_df = pd.concat([existing_df, new_df])
-            
-            # Replace NaN with ""
-            combined_df = combined_df.fillna("")
-            
-            # Replace "(not set)" with "" in combined data (both new and existing)
-            combined_df = combined_df.replace("(not set)", "")
-            
-            # Clean cityId by removing .0 suffix if present (for existing data compatibility)
-            combined_df['cityId'] = combined_df['cityId'].astype(str).str.replace(r'\.0$', '', regex=True)
-            
-            # Remove duplicates based on date, country, city, and cityId
-            final_df = combined_df.drop_duplicates(subset=['date', 'country', 'city', 'cityId'], keep='last')
-            
-            # Sort by date
-            final_df = final_df.sort_values('date')
-        
-        # Apply final cleaning to ensure no "(not set)" values remain
-        final_df = final_df.replace("(not set)", "")
+        final_df = merge_data(new_df, existing_df)
         
         # Ensure the output path is absolute
         output_path = output_path.resolve()
@@ -190,6 +245,39 @@ def merge_and_save_data(new_df: pd.DataFrame, existing_df: pd.DataFrame, output_
         logging.error(f"Failed to save data: {e}")
         raise
 
+def merge_and_save_partitioned(new_df: pd.DataFrame, dataset_dir: Path, output_path: Path) -> None:
+    """Merge new data into the month-partitioned Parquet dataset.
+    
+    Args:
+        new_df (pd.DataFrame): New data from GA
+        dataset_dir (Path): Root directory of the Parquet dataset
+        output_path (Path): CSV file imported on first use and exported afterwards
+        
+    Raises:
+        Exception: If saving fails
+        
+    Note:
+        - Imports the existing CSV the first time the dataset is used
+        - Only rewrites the partitions that new_df falls in
+        - Rewrites the CSV from the first touched month on unless GA_EXPORT_CSV=0
+    """
+    try:
+        if not dataset_dir.exists() and output_path.exists():
+            existing_df = merge_data(new_df.iloc[:0], load_existing_data(output_path))
+            import_csv(existing_df, dataset_dir, 'date', COLUMN_DTYPES, DICTIONARY_COLUMNS)
+        
+        new_rows = save_partitioned(new_df, dataset_dir, 'date', merge_data, COLUMN_DTYPES, DICTIONARY_COLUMNS)
+        logging.info(f"Added {new_rows} new rows to the dataset")
+        
+        if EXPORT_CSV:
+            # Only the months from the earliest new row on can have changed
+            since = partition_keys(new_df['date']).min() if not new_df.empty else None
+            export_csv(dataset_dir, output_path, since)
+            
+    except Exception as e:
+        logging.error(f"Failed to save data: {e}")
+        raise
+
 def check_and_archive_data(dirname: Path, output_file: str) -> None:
     """Check if we need to archive the current data file.
     
@@ -201,6 +289,7 @@ def check_and_archive_data(dirname: Path, output_file: str) -> None:
         - Creates archive directory if it doesn't exist
         - Archives data if the latest archive is at least a month old
         - Names the archive with today's date
+        - Stores content-addressed chunks instead of a copy when GA_ARCHIVE_MODE=chunked
     """
     try:
         today = datetime.now()
@@ -209,25 +298,13 @@ def check_and_archive_data(dirname: Path, output_file: str) -> None:
         
         # Extract the base filename without extension from OUTPUT_FILE
         base_filename = Path(OUTPUT_FILE).stem
-        archive_pattern = re.compile(rf'{base_filename}_(\d{{4}}-\d{{2}}-\d{{2}})\.csv')
-        archive_files = []
-        
-        # Get all archived files
-        for file in archive_dir.glob('raw_data_*.csv'):
-            match = archive_pattern.match(file.name)
-            if match:
-                date_str = match.group(1)
-                archive_date = datetime.strptime(date_str, '%Y-%m-%d')
-                archive_files.append((file, archive_date))
-        
-        # Sort by date (newest first)
-        archive_files.sort(key=lambda x: x[1], reverse=True)
+        
+        # Get all archived snapshots (copies and chunk manifests), newest first
+        archive_files = list_snapshots(archive_dir, base_filename)
 
         # If archive_files is empty, create a new archive
         if not archive_files:
-            archive_filename = f"raw_data_{today.strftime('%Y-%m-%d')}.csv"
-            archive_path = archive_dir / archive_filename
-            shutil.copy2(dirname / OUTPUT_FILE, archive_path)
+            archive_path = archive_snapshot(dirname / OUTPUT_FILE, archive_dir, base_filename, today)
             logging.info(f"Archived current data to {archive_path}")
             return
         
@@ -242,77 +319,218 @@ def check_and_archive_data(dirname: Path, output_file: str) -> None:
                 logging.info(f"Latest archive is from {latest_archive_date.date()}, less than a month ago. Skipping archiving.")
         
         if should_archive:
-            # Create new archive file
-            archive_filename = f"raw_data_{today.strftime('%Y-%m-%d')}.csv"
-            archive_path = archive_dir / archive_filename
-            
             # Ensure source file exists and is absolute
             source_file = (dirname / output_file).resolve()
             if not source_file.exists():
                 logging.error(f"Source file {source_file} does not exist")
                 return
                 
-            # Copy current data to archive
-            shutil.copy2(source_file, archive_path)
+            # Copy current data to archive, or store its changed chunks
+            archive_path = archive_snapshot(source_file, archive_dir, base_filename, today)
             logging.info(f"Archived current data to {archive_path}")
     
     except Exception as e:
         logging.error(f"Failed to archive data: {e}")
         # Don't raise the exception to allow the main process to continue
 
+def create_incremental_request(dirname: Path) -> RunReportRequest:
+    """Create the report request for the window past the stored high-water mark.
+    
+    Args:
+        dirname (Path): Directory where the script is located
+        
+    Returns:
+        RunReportRequest: Request starting LOOKBACK_DAYS before the watermark
+    """
+    output_path = dirname / OUTPUT_FILE
+    dataset_dir = dirname / DATASET_DIR
+    use_parquet = STORAGE_BACKEND == 'parquet'
+    data_path = dataset_dir if use_parquet and dataset_dir.exists() else output_path
+    watermark = load_watermark(dirname / STATE_FILE, output_path.stem, data_path, TIME_COLUMN)
+    start_date = compute_start_date(watermark)
+    logging.info(f"Requesting {output_path.stem} from {start_date} (watermark: {watermark})")
+    return create_report_request(GA_ID, start_date)
+
+def save_new_data(new_df: pd.DataFrame, dirname: Path, recorder: RunRecorder) -> None:
+    """Store freshly fetched rows: enrich, merge, advance the watermark and archive.
+    
+    Args:
+        new_df (pd.DataFrame): Processed new data, sorted by TIME_COLUMN
+        dirname (Path): Directory where the script is located
+        recorder (RunRecorder): Records each stage of the run
+        
+    Raises:
+        Exception: If merging or saving fails
+    """
+    output_path = dirname / OUTPUT_FILE
+    dataset_dir = dirname / DATASET_DIR
+    use_parquet = STORAGE_BACKEND == 'parquet'
+    # With GA_MERGE_MODE=wal, rows go to the write-ahead log and reach the CSV on compaction
+    use_log = not use_parquet and MERGE_MODE == 'wal' and output_path.exists()
+    log = WriteAheadLog(dirname / WAL_DIR / output_path.stem) if use_log else None
+    
+    # Resolve cityIds seen for the first time against the geotargets table
+    with recorder.stage('enrich', rows_in=len(new_df)):
+        update_city_table(new_df, dirname / CITIES_FILE, dirname / '..' / GEOTARGETS_FILE)
+    
+    if use_parquet:
+        # Merge into the touched partitions only
+        with recorder.stage('merge', rows_in=len(new_df), backend='parquet'):
+            merge_and_save_partitioned(new_df, dataset_dir, output_path)
+    elif use_log:
+        # Append the rows not stored or logged yet (O(new rows), synced to disk);
+        # fold the log into the CSV once GA_WAL_COMPACT_ROWS rows are pending
+        with recorder.stage('unseen', rows_in=len(new_df)) as stage:
+            unseen_df = unseen_rows(new_df, output_path, None, log.row_hashes())
+            stage['rows_out'] = len(unseen_df)
+        if not unseen_df.empty:
+            with recorder.stage('log_append', rows_in=len(unseen_df)) as stage:
+                stage['bytes'] = log.append(unseen_df)
+        pending = log.pending_rows()
+        if pending and pending >= WAL_COMPACT_ROWS:
+            with recorder.stage('compact', rows_in=pending) as stage:
+                stage['rows_out'] = compact(output_path, log, TIME_COLUMN, merge_data)
+        elif pending:
+            logging.info(f"{pending} logged rows pending; the summary waits for compaction")
+    else:
+        # Upsert into the existing CSV (rewriting only the changed tail),
+        # or stream it through the merge in bounded-memory chunks
+        new_rows = None
+        if output_path.exists():
+            merge_csv = stream_merge_csv if MERGE_MODE == 'stream' else upsert_csv
+            with recorder.stage('merge', rows_in=len(new_df), backend=MERGE_MODE) as stage:
+                new_rows = merge_csv(new_df, output_path, TIME_COLUMN, merge_data)
+                stage['rows_out'] = new_rows
+        if new_rows is not None:
+            logging.info(f"Added {new_rows} new rows to the dataset")
+        else:
+            # Load existing data, merge and save results
+            with recorder.stage('load') as stage:
+                existing_df = load_existing_data(output_path)
+                stage['rows_out'] = len(existing_df)
+            with recorder.stage('merge', rows_in=len(new_df) + len(existing_df), backend='full'):
+                merge_and_save_data(new_df, existing_df, output_path)
+    
+    # Advance the high-water mark
+    if use_parquet:
+        latest = latest_value(dataset_dir, TIME_COLUMN)
+    else:
+        latest = read_last_value(output_path, TIME_COLUMN)
+        if log is not None:
+            latest = max(filter(None, [latest, log.latest_value()]), default=None)
+    if latest:
+        with recorder.stage('save_watermark'):
+            save_watermark(dirname / STATE_FILE, output_path.stem, latest)
+    
+    # Update the top-10 summary tables from the changed tail only
+    # (in WAL mode it runs after the compaction above and covers the folded rows)
+    if not use_parquet or EXPORT_CSV:
+        with recorder.stage('summary'):
+            update_summary(output_path, dirname / SUMMARY_STATE, dirname / SUMMARY_DIR)
+    
+    # Check if we need to archive the data
+    with recorder.stage('archive'):
+        check_and_archive_data(dirname, OUTPUT_FILE)
+
+def preview_new_data(new_df: pd.DataFrame, dirname: Path, recorder: RunRecorder) -> None:
+    """Report what save_new_data would change, without writing anything.
+    
+    Args:
+        new_df (pd.DataFrame): Processed new data, sorted by TIME_COLUMN
+        dirname (Path): Directory where the script is located
+        recorder (RunRecorder): Records each stage of the run
+    """
+    dataset_dir = dirname / DATASET_DIR if STORAGE_BACKEND == 'parquet' else None
+    with recorder.stage('diff', rows_in=len(new_df)) as stage:
+        diff = merge_diff(new_df, dirname / OUTPUT_FILE, TIME_COLUMN, KEY_COLUMNS, dataset_dir)
+        if diff is None:
+            logging.warning("Stored columns differ from the new data; a merge would rewrite the whole file")
+            return
+        if MERGE_MODE == 'wal':
+            pending = WriteAheadLog(dirname / WAL_DIR / Path(OUTPUT_FILE).stem).pending_rows()
+            if pending:
+                logging.warning(f"The diff is against the compacted CSV; {pending} logged rows are not folded in yet")
+        stage.update({k: v for k, v in diff.items() if k != 'examples'})
+    print(format_merge_diff(diff, Path(OUTPUT_FILE).name))
+
 def main():
     """Main function to run the GA data extraction process.
     
     Workflow:
-        1. Load existing data from CSV
-        2. Initialize GA client
-        3. Create and execute report request
-        4. Process response into DataFrame
-        5. Merge with existing data
-        6. Save results
-        7. Archive data if needed
+        1. Initialize GA client
+        2. Create and execute report request from the stored watermark
+        3. Fetch date shards in parallel, processing each page into a DataFrame
+        4. Look up new rows in the stored row index
+        5. Merge them into the changed CSV tail (or the touched Parquet partitions)
+        6. Save results and advance the watermark
+        7. Update the summary tables
+        8. Archive data if needed
+        
+    With GA_DRY_RUN=1, steps 4-8 are replaced by a report of the rows the
+    merge would add, replace and drop, and nothing is written.
+    
+    Every stage is measured and the run is recorded in ../data/runs.jsonl.
     
     Raises:
         Exception: If any step fails
     """
+    dirname = Path(os.path.dirname(os.path.abspath(sys.argv[0])))
+    recorder = RunRecorder(Path(OUTPUT_FILE).stem, dirname / RUN_LOG_FILE, dirname / PROFILE_DIR)
     try:
-        dirname = Path(os.path.dirname(os.path.abspath(sys.argv[0])))
         credentials_path = dirname / CREDENTIALS_PATH
-        output_path = dirname / OUTPUT_FILE
-        ga_id = GA_ID
-
+        
         # Validate credentials file exists
-        if not credentials_path.exists():
+        if not FAKE_GA and not credentials_path.exists():
             raise FileNotFoundError(f"Credentials file not found: {credentials_path}")
-
-        # Load existing data
-        existing_df = load_existing_data(output_path)
         
-        # Setup client and create request
-        client = setup_ga_client(str(credentials_path))
-        request = create_report_request(ga_id)
+        # Only request the window past the stored high-water mark
+        request = create_incremental_request(dirname)
+        
+        # Setup client
+        with recorder.stage('client_setup'):
+            client = setup_ga_client(str(credentials_path))
         
-        # Execute request and process response
-        logging.info("Executing Google Analytics request...")
-        response = client.run_report(request)
+        # Execute request and process each page as it arrives; pages already
+        # fetched by an interrupted run are read back from the checkpoint
+        checkpoint = FetchCheckpoint(dirname / CHECKPOINT_DIR / Path(OUTPUT_FILE).stem)
+        quota = QuotaTracker()
+        # Open-range pages are fetched fresh unless this is only a preview
+        cache = open_cache(dirname, serve_open=DRY_RUN)
+        decode = recorder.counter('decode', process_response, lambda response: len(response.rows))
+        with recorder.stage('api_call') as stage:
+            try:
+                frames = fetch_report_frames(client, request, decode, checkpoint=checkpoint, quota=quota,
+                                             cache=cache)
+            finally:
+                stage['quota'] = quota.summary()
+                if cache is not None:
+                    stage['cache'] = {'hits': cache.hits, 'misses': cache.misses}
+            stage['rows_out'] = sum(len(frame) for frame in frames)
         
         # Validate response
-        if not hasattr(response, 'rows') or len(response.rows) == 0:
+        if not frames:
             logging.warning("No data returned from Google Analytics")
+            checkpoint.clear()
+            recorder.finish('no_data')
             return
         
-        new_df = process_response(response)
+        new_df = pd.concat(frames, ignore_index=True).sort_values(TIME_COLUMN)
         logging.info(f"Processed {len(new_df)} rows of new data")
         
-        # Merge and save results
-        merge_and_save_data(new_df, existing_df, output_path)
+        if DRY_RUN:
+            # Keep the checkpoint, so the real run reuses the fetched pages
+            preview_new_data(new_df, dirname, recorder)
+            recorder.finish('dry_run')
+            return
         
-        # Check if we need to archive the data
-        check_and_archive_data(dirname, OUTPUT_FILE)
+        save_new_data(new_df, dirname, recorder)
+        checkpoint.clear()
+        recorder.finish()
         
     except Exception as e:
         logging.error(f"Error in main execution: {e}")
+        recorder.finish('error', e)
         sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
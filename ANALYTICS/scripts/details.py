@@ -5,15 +5,35 @@ from google.analytics.data_v1beta.types import (
     Metric,
     RunReportRequest
 )
+import numpy as np
 import pandas as pd
 import os
 import logging
 from pathlib import Path
-from tqdm import tqdm
-from typing import List, Dict
+from typing import List, Dict, Optional
 from datetime import datetime, timedelta
-import re
-import shutil
+
+from fake_ga import FAKE_GA, FakeAnalyticsClient
+from instrument import PROFILE_DIR, RUN_LOG_FILE, RunRecorder
+from ga_fetch import (
+    FIRST_DATE, STATE_FILE, QuotaTracker, compute_start_date, fetch_report_frames,
+    format_timestamps, load_watermark, read_last_value, response_to_frame,
+    save_watermark
+)
+from checkpoint import CHECKPOINT_DIR, FetchCheckpoint
+from codec import Codec, CodecError, is_encoded, load_codec
+from response_cache import open_cache
+from storage import (
+    CHUNK_ROWS, DRY_RUN, EXPORT_CSV, MERGE_MODE, STORAGE_BACKEND, export_csv,
+    format_merge_diff, import_csv, latest_value, merge_diff, partition_keys,
+    save_partitioned, stream_merge_csv, unseen_rows, upsert_csv
+)
+from wal import COMPACT_ROWS as WAL_COMPACT_ROWS, WAL_DIR, WriteAheadLog, compact
+from archive import archive_snapshot, list_snapshots
+from geotargets import GEOTARGETS_FILE, update_city_table
+from rollup import ROLLUP_DIR, update_rollup
+from sessions import SESSIONS_FILE, SESSIONS_STATE, update_sessions
+from sketches import SKETCH_FILE, update_sketches
 
 # Setup logging
 logging.basicConfig(
@@ -25,7 +45,17 @@ logging.basicConfig(
 CREDENTIALS_PATH = "my-website-analytics-b37a5d44bcc6.json"
 GA_ID = '434705894'
 OUTPUT_FILE = '../data/raw_data_detail.csv'
+TIME_COLUMN = 'time'  # Sort key and high-water mark column
+KEY_COLUMNS = None  # Rows are only ever added; whole rows are the key
 ARCHIVE_DIR = '../data/archive' 
+CITIES_FILE = '../data/cities.csv'
+DATASET_DIR = '../data/raw_data_detail'  # Parquet dataset used when GA_STORAGE=parquet
+COLUMN_DTYPES = {
+    'time': 'string', 'country': 'string', 'city': 'string', 'cityId': 'string',
+    'device': 'string', 'newUsers': 'string', 'page': 'string', 'fileName': 'string',
+    'linkUrl': 'string'
+}
+DICTIONARY_COLUMNS = ['country', 'city', 'cityId', 'device', 'newUsers', 'page', 'fileName']
 
 def setup_ga_client(credentials_path: str) -> BetaAnalyticsDataClient:
     """Initialize the Google Analytics client with credentials.
@@ -36,27 +66,35 @@ def setup_ga_client(credentials_path: str) -> BetaAnalyticsDataClient:
     Returns:
         BetaAnalyticsDataClient: Initialized GA client
         
+    Note:
+        With GA_FAKE=1 an offline FakeAnalyticsClient is returned instead,
+        configured through the GA_FAKE_* environment variables.
+        
     Raises:
         Exception: If client initialization fails
     """
     try:
+        if FAKE_GA:
+            logging.info("Using the offline fake GA client")
+            return FakeAnalyticsClient.from_env()
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_path
         return BetaAnalyticsDataClient()
     except Exception as e:
         logging.error(f"Failed to initialize GA client: {e}")
         raise
 
-def create_report_request(ga_id: str) -> RunReportRequest:
+def create_report_request(ga_id: str, start_date: str = FIRST_DATE) -> RunReportRequest:
     """Create a report request with specified dimensions and metrics.
     
     Args:
         ga_id (str): Google Analytics property ID
+        start_date (str): First date to request, in YYYY-MM-DD format
         
     Returns:
         RunReportRequest: Configured request object with:
             - Dimensions: dateHourMinute, country, city, cityId, deviceCategory, deviceModel, pagePathPlusQueryString, fileName, linkUrl
             - Metrics: activeUsers, newUsers
-            - Date range: from 2020-04-01 to today
+            - Date range: from start_date to today
     """
     return RunReportRequest(
         property=f"properties/{ga_id}",
@@ -75,12 +113,15 @@ def create_report_request(ga_id: str) -> RunReportRequest:
             Metric(name="activeUsers"),
             Metric(name="newUsers")
         ],
-        date_ranges=[DateRange(start_date="2020-04-01", end_date="today")],
+        date_ranges=[DateRange(start_date=start_date, end_date="today")],
     )
 
 def process_response(response) -> pd.DataFrame:
     """Process the GA response into a pandas DataFrame.
     
+    The response is decoded column by column and every cleaning rule is a
+    vectorized expression, so there is no per-row Python work after decoding.
+    
     Args:
         response: Google Analytics API response object
         
@@ -91,42 +132,45 @@ def process_response(response) -> pd.DataFrame:
             - Numeric metrics
             - Properly formatted datetime (YYYYMMDDHHMM format)
     """
-    data = []
-    for row in tqdm(response.rows, desc="Processing rows"):
-        dimension_values = [value.value for value in row.dimension_values]
-        metric_values = [value.value for value in row.metric_values]
-        data.append(dimension_values + metric_values)
-
-    columns = [dim.name for dim in response.dimension_headers] + [metric.name for metric in response.metric_headers]
-    df = pd.DataFrame(data, columns=columns)
+    return process_frame(response_to_frame(response))
+
+def process_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Clean a decoded report (all values as strings) into the stored format.
     
+    Args:
+        df (pd.DataFrame): Report columns as returned by response_to_frame
+        
+    Returns:
+        pd.DataFrame: Processed DataFrame, see process_response
+    """
     # Rename columns
     df = df.rename(columns={'pagePathPlusQueryString': 'page',
                             'dateHourMinute': 'time'})
     
     # Format dateHourMinute (YYYYMMDDHHMM) to match archive format "YYYY-MM-DD HH:MM:SS"
-    df['time'] = pd.to_datetime(df['time'].astype(str), format="%Y%m%d%H%M").dt.strftime('%Y-%m-%d %H:%M:%S')
+    df['time'] = format_timestamps(df['time'], "%Y%m%d%H%M", '%Y-%m-%d %H:%M:%S')
     
     # Create device column combining deviceCategory and deviceModel
-    df['device'] = df.apply(
-        lambda row: 
-        "(not set)" if row['deviceCategory'] == "(not set)" and row['deviceModel'] == "(not set)" else
-        row['deviceCategory'] if row['deviceModel'] == "(not set)" or row['deviceModel'] == "" else
-        f"{row['deviceCategory']} ({row['deviceModel']})",
-        axis=1
+    category = df['deviceCategory']
+    model = df['deviceModel']
+    df['device'] = np.select(
+        [(category == "(not set)") & (model == "(not set)"),
+         (model == "(not set)") | (model == "")],
+        ["(not set)", category],
+        default=category + " (" + model + ")"
     )
 
     # Drop deviceCategory and deviceModel columns
     df = df.drop(columns=['deviceCategory', 'deviceModel'])
     
-    # Convert newUsers=1 to "New" and newUsers=0 to ""
-    df['newUsers'] = df['newUsers'].apply(lambda x: "New" if x == "1" else "Return")
+    # Convert newUsers=1 to "New" and anything else to "Return"
+    df['newUsers'] = np.where(df['newUsers'] == "1", "New", "Return")
 
     # Sort by time
     df = df.sort_values('time')
 
     # Replace linkUrl with "" in linkUrl column if it is in my website
-    df['linkUrl'] = df['linkUrl'].apply(lambda x: "" if "shunsukematsuno.github.io" in x else x)
+    df.loc[df['linkUrl'].str.contains("shunsukematsuno.github.io", regex=False), 'linkUrl'] = ""
 
     # Replace "(not set)" with ""
     df = df.replace("(not set)", "")
@@ -138,16 +182,36 @@ def process_response(response) -> pd.DataFrame:
     df = df[['time', 'country', 'city', 'cityId', 'device', 'newUsers', 'page', 'fileName', 'linkUrl']]
     return df
 
-def load_existing_data(file_path: Path) -> pd.DataFrame:
+def load_existing_data(file_path: Path, codec: Optional[Codec] = None) -> pd.DataFrame:
     """Load existing data from CSV file if it exists.
     
     Args:
         file_path (Path): Path to the existing CSV file
+        codec (Optional[Codec]): Encode the rows (see open_codec) instead of keeping strings
         
     Returns:
         pd.DataFrame: Loaded DataFrame with time column as string to match format,
-            or empty DataFrame if file doesn't exist
+            or encoded with codec, or empty DataFrame if file doesn't exist
+        
+    Note:
+        The encoded frame is built chunk by chunk, so the strings of the whole
+        file never exist at once. Files the codec cannot encode are loaded as
+        strings.
     """
+    if file_path.exists() and codec is not None:
+        try:
+            parts = []
+            for chunk in pd.read_csv(file_path, dtype=str, keep_default_na=False, chunksize=CHUNK_ROWS):
+                # Same compatibility fixes as below and in merge_data
+                if 'cityId' not in chunk.columns:
+                    chunk['cityId'] = ''
+                parts.append(codec.encode(chunk.drop(columns=['activeUsers'], errors='ignore')))
+            if parts:
+                if 'cityId' not in pd.read_csv(file_path, nrows=0).columns:
+                    logging.info("Added cityId column with empty values for backward compatibility")
+                return pd.concat(parts, ignore_index=True)
+        except CodecError as e:
+            logging.warning(f"Could not encode {file_path}, loading it as strings: {e}")
     if file_path.exists():
         df = pd.read_csv(file_path)
         # Add cityId column if it doesn't exist (for backward compatibility with archived data)
@@ -158,58 +222,116 @@ def load_existing_data(file_path: Path) -> pd.DataFrame:
         return df
     return pd.DataFrame()
 
-def merge_and_save_data(new_df: pd.DataFrame, existing_df: pd.DataFrame, output_path: Path) -> None:
-    """Merge new data with existing data and save to CSV.
+def open_codec(csv_path: Path) -> Codec:
+    """The codec the merges encode detail rows with (see codec.py)."""
+    return load_codec(csv_path, clean_stored_values)
+
+def clean_stored_values(column: str, values: np.ndarray) -> np.ndarray:
+    """Apply the cleaning merge_data does to the distinct values of a column before encoding."""
+    values = np.where(values == "(not set)", "", values).astype(object)
+    if column == 'cityId':
+        values = pd.Series(values, dtype=object).str.replace(r'\.0$', '', regex=True).to_numpy(dtype=object)
+    return values
+
+def merge_data(new_df: pd.DataFrame, existing_df: pd.DataFrame) -> pd.DataFrame:
+    """Merge new data with existing data.
     
     Args:
         new_df (pd.DataFrame): New data from GA
-        existing_df (pd.DataFrame): Existing data from CSV
-        output_path (Path): Path where to save the merged data
+        existing_df (pd.DataFrame): Existing data
         
-    Raises:
-        Exception: If saving fails
+    Returns:
+        pd.DataFrame: Merged data
         
     Note:
         - Removes duplicates based on all columns
         - Keeps the most recent version of duplicate entries
         - Sorts final data by time
-        - Creates output directory if it doesn't exist
+        - Encoded frames (see open_codec) were cleaned when encoded, so
+          deduplicating and sorting them compares integers only
     """
-    try:
+    if is_encoded(new_df) or is_encoded(existing_df):
         if existing_df.empty:
-            final_df = new_df
-            logging.info("No existing data found!")
-        else:
-            # Combine existing and new data
-            combined_df = pd.concat([existing_df, new_df])
+            return new_df
+        combined_df = pd.concat([existing_df, new_df], ignore_index=True)
+        return combined_df.drop_duplicates().sort_values('time', kind='stable')
 
-            # Drop activeUsers column if it exists
-            if 'activeUsers' in combined_df.columns:
-                combined_df = combined_df.drop(columns=['activeUsers'])
+    if existing_df.empty:
+        final_df = new_df
+    else:
+        # Combine existing and new data
+        combined_df = pd.concat([existing_df, new_df])
 
-            # Replace NaN with ""
-            combined_df = combined_df.fillna("")
-            
-            # Replace "(not set)" with "" in combined data (both new and existing)
-            combined_df = combined_df.replace("(not set)", "")
+        # Drop activeUsers column if it exists
+        if 'activeUsers' in combined_df.columns:
+            combined_df = combined_df.drop(columns=['activeUsers'])
 
-            # Clean cityId by removing .0 suffix if present (for existing data compatibility)
-            combined_df['cityId'] = combined_df['cityId'].astype(str).str.replace(r'\.0$', '', regex=True)
+        # Replace NaN with ""
+        combined_df = combined_df.fillna("")
+        
+        # Replace "(not set)" with "" in combined data (both new and existing)
+        combined_df = combined_df.replace("(not set)", "")
 
-            # Remove duplicates based on all columns
-            final_df = combined_df.drop_duplicates()
-            
-            # Sort by time
-            final_df = final_df.sort_values('time')
-            
-        # Apply final cleaning to ensure no "(not set)" values remain
-        final_df = final_df.replace("(not set)", "")
+        # Clean cityId by removing .0 suffix if present (for existing data compatibility)
+        combined_df['cityId'] = combined_df['cityId'].astype(str).str.replace(r'\.0$', '', regex=True)
+
+        # Remove duplicates based on all columns
+        final_df = combined_df.drop_duplicates()
+        
+        # Sort by time
+        final_df = final_df.sort_values('time')
+        
+    # Apply final cleaning to ensure no "(not set)" values remain
+    return final_df.replace("(not set)", "")
+
+def merge_and_save_data(new_df: pd.DataFrame, existing_df: pd.DataFrame, output_path: Path,
+                        codec: Optional[Codec] = None) -> None:
+    """Merge new data with existing data and save to CSV.
+    
+    Args:
+        new_df (pd.DataFrame): New data from GA
+        existing_df (pd.DataFrame): Existing data from CSV, encoded with codec if given
+        output_path (Path): Path where to save the merged data
+        codec (Optional[Codec]): Codec existing_df was loaded with (see load_existing_data)
+        
+    Raises:
+        Exception: If saving fails
+        
+    Note:
+        - Merges with merge_data
+        - Creates output directory if it doesn't exist
+    """
+    try:
+        if existing_df.empty:
+            logging.info("No existing data found!")
+        
+        if codec is not None and is_encoded(existing_df):
+            # New columns (or values the codec cannot hold) need the string merge
+            encoded_df = None
+            if set(new_df.columns) == set(existing_df.columns):
+                try:
+                    encoded_df = codec.encode(new_df[list(existing_df.columns)])
+                except CodecError as e:
+                    logging.warning(f"Merging as strings: {e}")
+            if encoded_df is not None:
+                new_df = encoded_df
+            else:
+                existing_df = codec.decode(existing_df)
+        
+        final_df = merge_data(new_df, existing_df)
             
         # Ensure the output path is absolute
         output_path = output_path.resolve()
         
-        # Save to file
-        final_df.to_csv(output_path, index=False)
+        # Save to file, decoding encoded rows chunk by chunk
+        if is_encoded(final_df):
+            with open(output_path, "w", newline="") as f:
+                f.write(",".join(final_df.columns) + "\n")
+                for start in range(0, len(final_df), CHUNK_ROWS):
+                    f.write(codec.to_csv(final_df.iloc[start:start + CHUNK_ROWS]))
+            codec.save()
+        else:
+            final_df.to_csv(output_path, index=False)
         logging.info(f"Data saved successfully to {output_path}")
 
         # Log summary of changes
@@ -221,6 +343,39 @@ def merge_and_save_data(new_df: pd.DataFrame, existing_df: pd.DataFrame, output_
         logging.error(f"Failed to save data: {e}")
         raise
 
+def merge_and_save_partitioned(new_df: pd.DataFrame, dataset_dir: Path, output_path: Path) -> None:
+    """Merge new data into the month-partitioned Parquet dataset.
+    
+    Args:
+        new_df (pd.DataFrame): New data from GA
+        dataset_dir (Path): Root directory of the Parquet dataset
+        output_path (Path): CSV file imported on first use and exported afterwards
+        
+    Raises:
+        Exception: If saving fails
+        
+    Note:
+        - Imports the existing CSV the first time the dataset is used
+        - Only rewrites the partitions that new_df falls in
+        - Rewrites the CSV from the first touched month on unless GA_EXPORT_CSV=0
+    """
+    try:
+        if not dataset_dir.exists() and output_path.exists():
+            existing_df = merge_data(new_df.iloc[:0], load_existing_data(output_path))
+            import_csv(existing_df, dataset_dir, 'time', COLUMN_DTYPES, DICTIONARY_COLUMNS)
+        
+        new_rows = save_partitioned(new_df, dataset_dir, 'time', merge_data, COLUMN_DTYPES, DICTIONARY_COLUMNS)
+        logging.info(f"Added {new_rows} new rows to the dataset")
+        
+        if EXPORT_CSV:
+            # Only the months from the earliest new row on can have changed
+            since = partition_keys(new_df['time']).min() if not new_df.empty else None
+            export_csv(dataset_dir, output_path, since)
+            
+    except Exception as e:
+        logging.error(f"Failed to save data: {e}")
+        raise
+
 def check_and_archive_data(dirname: Path, output_file: str) -> None:
     """Check if we need to archive the current data file.
     
@@ -232,6 +387,7 @@ def check_and_archive_data(dirname: Path, output_file: str) -> None:
         - Creates archive directory if it doesn't exist
         - Archives data if the latest archive is at least a month old
         - Names the archive with today's date
+        - Stores content-addressed chunks instead of a copy when GA_ARCHIVE_MODE=chunked
     """
     try:
         today = datetime.now()
@@ -240,25 +396,13 @@ def check_and_archive_data(dirname: Path, output_file: str) -> None:
         
         # Extract the base filename without extension from OUTPUT_FILE
         base_filename = Path(OUTPUT_FILE).stem
-        archive_pattern = re.compile(rf'{base_filename}_(\d{{4}}-\d{{2}}-\d{{2}})\.csv')
-        archive_files = []
-        
-        # Get all archived files
-        for file in archive_dir.glob('raw_data_detail_*.csv'):
-            match = archive_pattern.match(file.name)
-            if match:
-                date_str = match.group(1)
-                archive_date = datetime.strptime(date_str, '%Y-%m-%d')
-                archive_files.append((file, archive_date))
         
-        # Sort by date (newest first)
-        archive_files.sort(key=lambda x: x[1], reverse=True)
+        # Get all archived snapshots (copies and chunk manifests), newest first
+        archive_files = list_snapshots(archive_dir, base_filename)
 
         # If archive_files is empty, create a new archive
         if not archive_files:
-            archive_filename = f"raw_data_detail_{today.strftime('%Y-%m-%d')}.csv"
-            archive_path = archive_dir / archive_filename
-            shutil.copy2(dirname / OUTPUT_FILE, archive_path)
+            archive_path = archive_snapshot(dirname / OUTPUT_FILE, archive_dir, base_filename, today)
             logging.info(f"Archived current data to {archive_path}")
             return
         
@@ -273,76 +417,227 @@ def check_and_archive_data(dirname: Path, output_file: str) -> None:
                 logging.info(f"Latest archive is from {latest_archive_date.date()}, less than a month ago. Skipping archiving.")
         
         if should_archive:
-            # Create new archive file
-            archive_filename = f"raw_data_detail_{today.strftime('%Y-%m-%d')}.csv"
-            archive_path = archive_dir / archive_filename
-            
             # Ensure source file exists and is absolute
             source_file = (dirname / output_file).resolve()
             if not source_file.exists():
                 logging.error(f"Source file {source_file} does not exist")
                 return
                 
-            # Copy current data to archive
-            shutil.copy2(source_file, archive_path)
+            # Copy current data to archive, or store its changed chunks
+            archive_path = archive_snapshot(source_file, archive_dir, base_filename, today)
             logging.info(f"Archived current data to {archive_path}")
     
     except Exception as e:
         logging.error(f"Failed to archive data: {e}")
         # Don't raise the exception to allow the main process to continue
 
+def create_incremental_request(dirname: Path) -> RunReportRequest:
+    """Create the report request for the window past the stored high-water mark.
+    
+    Args:
+        dirname (Path): Directory where the script is located
+        
+    Returns:
+        RunReportRequest: Request starting LOOKBACK_DAYS before the watermark
+    """
+    output_path = dirname / OUTPUT_FILE
+    dataset_dir = dirname / DATASET_DIR
+    use_parquet = STORAGE_BACKEND == 'parquet'
+    data_path = dataset_dir if use_parquet and dataset_dir.exists() else output_path
+    watermark = load_watermark(dirname / STATE_FILE, output_path.stem, data_path, TIME_COLUMN)
+    start_date = compute_start_date(watermark)
+    logging.info(f"Requesting {output_path.stem} from {start_date} (watermark: {watermark})")
+    return create_report_request(GA_ID, start_date)
+
+def save_new_data(new_df: pd.DataFrame, dirname: Path, recorder: RunRecorder) -> None:
+    """Store freshly fetched rows: enrich, merge, advance the watermark and archive.
+    
+    Args:
+        new_df (pd.DataFrame): Processed new data, sorted by TIME_COLUMN
+        dirname (Path): Directory where the script is located
+        recorder (RunRecorder): Records each stage of the run
+        
+    Raises:
+        Exception: If merging or saving fails
+    """
+    output_path = dirname / OUTPUT_FILE
+    dataset_dir = dirname / DATASET_DIR
+    use_parquet = STORAGE_BACKEND == 'parquet'
+    # With GA_MERGE_MODE=wal, rows go to the write-ahead log and reach the CSV on compaction
+    use_log = not use_parquet and MERGE_MODE == 'wal' and output_path.exists()
+    log = WriteAheadLog(dirname / WAL_DIR / output_path.stem) if use_log else None
+    
+    # Resolve cityIds seen for the first time against the geotargets table
+    with recorder.stage('enrich', rows_in=len(new_df)):
+        update_city_table(new_df, dirname / CITIES_FILE, dirname / '..' / GEOTARGETS_FILE)
+    
+    # Rows not stored yet; merges only ever add rows, so these are what the
+    # merge below adds and what the sketches have not counted
+    with recorder.stage('unseen', rows_in=len(new_df)) as stage:
+        unseen_df = unseen_rows(new_df, output_path, dataset_dir if use_parquet else None,
+                                log.row_hashes() if log is not None else None)
+        stage['rows_out'] = len(unseen_df)
+    
+    if use_parquet:
+        # Merge into the touched partitions only
+        with recorder.stage('merge', rows_in=len(new_df), backend='parquet'):
+            merge_and_save_partitioned(new_df, dataset_dir, output_path)
+    elif use_log:
+        # Append the unseen rows to the log (O(new rows), synced to disk);
+        # fold it into the CSV once GA_WAL_COMPACT_ROWS rows are pending
+        if not unseen_df.empty:
+            with recorder.stage('log_append', rows_in=len(unseen_df)) as stage:
+                stage['bytes'] = log.append(unseen_df)
+        pending = log.pending_rows()
+        if pending and pending >= WAL_COMPACT_ROWS:
+            with recorder.stage('compact', rows_in=pending) as stage:
+                stage['rows_out'] = compact(output_path, log, TIME_COLUMN, merge_data, open_codec(output_path))
+        elif pending:
+            logging.info(f"{pending} logged rows pending; rollups and sessions wait for compaction")
+    else:
+        # Upsert into the existing CSV (rewriting only the changed tail),
+        # or stream it through the merge in bounded-memory chunks
+        new_rows = None
+        if output_path.exists():
+            merge_csv = stream_merge_csv if MERGE_MODE == 'stream' else upsert_csv
+            with recorder.stage('merge', rows_in=len(new_df), backend=MERGE_MODE) as stage:
+                new_rows = merge_csv(new_df, output_path, TIME_COLUMN, merge_data, codec=open_codec(output_path))
+                stage['rows_out'] = new_rows
+        if new_rows is not None:
+            logging.info(f"Added {new_rows} new rows to the dataset")
+        else:
+            # Load existing data, merge and save results
+            with recorder.stage('load') as stage:
+                existing_df = load_existing_data(output_path, open_codec(output_path))
+                stage['rows_out'] = len(existing_df)
+            with recorder.stage('merge', rows_in=len(new_df) + len(existing_df), backend='full'):
+                merge_and_save_data(new_df, existing_df, output_path, open_codec(output_path))
+    
+    # Advance the high-water mark
+    if use_parquet:
+        latest = latest_value(dataset_dir, TIME_COLUMN)
+    else:
+        latest = read_last_value(output_path, TIME_COLUMN)
+        if log is not None:
+            latest = max(filter(None, [latest, log.latest_value()]), default=None)
+    if latest:
+        with recorder.stage('save_watermark'):
+            save_watermark(dirname / STATE_FILE, output_path.stem, latest)
+    
+    # Count the added rows in the top-K and distinct-count sketches
+    with recorder.stage('sketch', rows_in=len(unseen_df)):
+        update_sketches(unseen_df, dirname / SKETCH_FILE)
+    
+    # Fold the changed tail into the hour/day/month rollups and the sessions
+    # (in WAL mode they run after the compaction above and cover the folded rows)
+    if not use_parquet or EXPORT_CSV:
+        with recorder.stage('rollup'):
+            update_rollup(output_path, dirname / ROLLUP_DIR)
+        with recorder.stage('sessions'):
+            update_sessions(output_path, dirname / SESSIONS_FILE, dirname / SESSIONS_STATE)
+    
+    # Check if we need to archive the data
+    with recorder.stage('archive'):
+        check_and_archive_data(dirname, OUTPUT_FILE)
+
+def preview_new_data(new_df: pd.DataFrame, dirname: Path, recorder: RunRecorder) -> None:
+    """Report what save_new_data would change, without writing anything.
+    
+    Args:
+        new_df (pd.DataFrame): Processed new data, sorted by TIME_COLUMN
+        dirname (Path): Directory where the script is located
+        recorder (RunRecorder): Records each stage of the run
+    """
+    dataset_dir = dirname / DATASET_DIR if STORAGE_BACKEND == 'parquet' else None
+    with recorder.stage('diff', rows_in=len(new_df)) as stage:
+        diff = merge_diff(new_df, dirname / OUTPUT_FILE, TIME_COLUMN, KEY_COLUMNS, dataset_dir)
+        if diff is None:
+            logging.warning("Stored columns differ from the new data; a merge would rewrite the whole file")
+            return
+        if MERGE_MODE == 'wal':
+            pending = WriteAheadLog(dirname / WAL_DIR / Path(OUTPUT_FILE).stem).pending_rows()
+            if pending:
+                logging.warning(f"The diff is against the compacted CSV; {pending} logged rows are not folded in yet")
+        stage.update({k: v for k, v in diff.items() if k != 'examples'})
+    print(format_merge_diff(diff, Path(OUTPUT_FILE).name))
+
 def main():
     """Main function to run the GA data extraction process.
     
     Workflow:
         1. Initialize GA client
-        2. Create and execute report request
-        3. Process response into DataFrame
-        4. Load existing data from CSV
-        5. Merge with existing data
-        6. Save results
-        7. Archive data if needed
+        2. Create and execute report request from the stored watermark
+        3. Fetch date shards in parallel, processing each page into a DataFrame
+        4. Look up new rows in the stored row index
+        5. Merge them into the changed CSV tail (or the touched Parquet partitions)
+        6. Save results and advance the watermark
+        7. Update the sketches, the hour/day/month rollups and the sessions
+        8. Archive data if needed
+        
+    With GA_DRY_RUN=1, steps 4-8 are replaced by a report of the rows the
+    merge would add, replace and drop, and nothing is written.
+    
+    Every stage is measured and the run is recorded in ../data/runs.jsonl.
     
     Raises:
         Exception: If any step fails
     """
+    dirname = Path(os.path.dirname(os.path.abspath(__file__)))
+    recorder = RunRecorder(Path(OUTPUT_FILE).stem, dirname / RUN_LOG_FILE, dirname / PROFILE_DIR)
     try:
-        dirname = Path(os.path.dirname(os.path.abspath(__file__)))
         credentials_path = dirname / CREDENTIALS_PATH
-        output_path = dirname / OUTPUT_FILE
         
         # Validate credentials file exists
-        if not credentials_path.exists():
+        if not FAKE_GA and not credentials_path.exists():
             raise FileNotFoundError(f"Credentials file not found: {credentials_path}")
         
+        # Only request the window past the stored high-water mark
+        request = create_incremental_request(dirname)
+        
         # Setup client
-        client = setup_ga_client(str(credentials_path))
+        with recorder.stage('client_setup'):
+            client = setup_ga_client(str(credentials_path))
         
-        # Create and execute request
-        request = create_report_request(GA_ID)
-        logging.info("Executing Google Analytics request...")
-        response = client.run_report(request)
+        # Execute request and process each page as it arrives; pages already
+        # fetched by an interrupted run are read back from the checkpoint
+        checkpoint = FetchCheckpoint(dirname / CHECKPOINT_DIR / Path(OUTPUT_FILE).stem)
+        quota = QuotaTracker()
+        # Open-range pages are fetched fresh unless this is only a preview
+        cache = open_cache(dirname, serve_open=DRY_RUN)
+        decode = recorder.counter('decode', process_response, lambda response: len(response.rows))
+        with recorder.stage('api_call') as stage:
+            try:
+                frames = fetch_report_frames(client, request, decode, checkpoint=checkpoint, quota=quota,
+                                             cache=cache)
+            finally:
+                stage['quota'] = quota.summary()
+                if cache is not None:
+                    stage['cache'] = {'hits': cache.hits, 'misses': cache.misses}
+            stage['rows_out'] = sum(len(frame) for frame in frames)
         
         # Validate response
-        if not hasattr(response, 'rows') or len(response.rows) == 0:
+        if not frames:
             logging.warning("No data returned from Google Analytics")
+            checkpoint.clear()
+            recorder.finish('no_data')
             return
         
-        # Process response
-        new_df = process_response(response)
+        new_df = pd.concat(frames, ignore_index=True).sort_values(TIME_COLUMN)
         logging.info(f"Processed {len(new_df)} rows of new data")
         
-        # Load existing data and merge
-        existing_df = load_existing_data(output_path)
-        
-        # Merge and save results
-        merge_and_save_data(new_df, existing_df, output_path)
+        if DRY_RUN:
+            # Keep the checkpoint, so the real run reuses the fetched pages
+            preview_new_data(new_df, dirname, recorder)
+            recorder.finish('dry_run')
+            return
         
-        # Check if we need to archive the data
-        check_and_archive_data(dirname, OUTPUT_FILE)
+        save_new_data(new_df, dirname, recorder)
+        checkpoint.clear()
+        recorder.finish()
         
     except Exception as e:
         logging.error(f"Error in main execution: {e}")
+        recorder.finish('error', e)
         raise
 
 if __name__ == "__main__":
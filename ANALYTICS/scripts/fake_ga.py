@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""Offline stand-in for the GA Data API client.
+
+Set GA_FAKE=1 and setup_ga_client in daily-user.py, details.py and test.py
+returns a FakeAnalyticsClient instead of a BetaAnalyticsDataClient, so the
+scripts run end to end without credentials. The fake answers run_report and
+batch_run_reports with real RunReportResponse messages built from synthetic
+data, honouring date ranges, dimensions, metrics, limit and offset.
+
+The data is deterministic: a given day always yields the same events, so
+overlapping requests, date shards and repeated runs agree with each other.
+Events later than the current minute are left out, so today's report grows
+during the day and future dates are empty, as with the real API.
+Events are aggregated over the requested dimensions like GA does.
+
+Configuration (environment variables):
+    GA_FAKE_ROWS_PER_DAY    events generated per day (default 200)
+    GA_FAKE_COUNTRIES       number of distinct countries (default 20)
+    GA_FAKE_CITIES          number of distinct cities (default 200)
+    GA_FAKE_PAGES           number of distinct pages (default 50)
+    GA_FAKE_DEVICES         number of distinct device models (default 30)
+    GA_FAKE_NOT_SET_RATE    share of "(not set)" values (default 0.05)
+    GA_FAKE_SKEW            Zipf exponent of city/page/device popularity;
+                            values <= 1 mean uniform (default 1.5)
+    GA_FAKE_PAGE_SIZE       server-side cap on rows per response (default 100000)
+    GA_FAKE_SEED            random seed (default 0)
+    GA_FAKE_FAIL_RATE       share of calls failing with ServiceUnavailable,
+                            chosen deterministically from the call number (default 0)
+    GA_FAKE_FAIL_AFTER      fail every call after this many, like an outage (default: never)
+
+Responses report property_quota when asked, counting one token per
+started thousand rows against the standard 200,000/day and 40,000/hour.
+
+Usage:
+    python fake_ga.py [start_date] [end_date]    # print a sample daily report
+"""
+import hashlib
+import os
+import sys
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from google.analytics.data_v1beta.types import (
+    BatchRunReportsResponse, DimensionHeader, MetricHeader, MetricType,
+    PropertyQuota, QuotaStatus, RunReportResponse
+)
+from google.api_core.exceptions import ServiceUnavailable
+
+from ga_fetch import _resolve_date
+
+# Configuration
+FAKE_GA = os.environ.get("GA_FAKE", "") == "1"
+
+COUNTRY_NAMES = [
+    "Japan", "United States", "United Kingdom", "Germany", "China", "South Korea",
+    "Canada", "France", "India", "Australia", "Singapore", "Taiwan", "Netherlands",
+    "Italy", "Spain", "Brazil", "Switzerland", "Sweden", "Hong Kong", "Mexico",
+]
+BASE_PAGES = ["/", "/research/", "/ja/", "/papers/", "/cv/"]
+FILE_NAMES = ["", "", "", "", "/static/papers/JMP_matsuno.pdf", "/static/cv/cv.pdf"]
+LINK_URLS = ["", "", "", "https://shunsukematsuno.github.io/research/", "https://scholar.google.com/",
+             "https://github.com/ShunsukeMatsuno"]
+DEVICE_CATEGORIES = ["desktop", "mobile", "tablet"]
+NOT_SET = "(not set)"
+TOKENS_PER_DAY = 200000
+TOKENS_PER_HOUR = 40000
+TABLE_CACHE_SIZE = 32
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.environ.get(name, default))
+
+
+class FakeAnalyticsClient:
+    """Generates GA-shaped reports from deterministic synthetic events."""
+
+    def __init__(self, rows_per_day: int = 200, countries: int = 20, cities: int = 200,
+                 pages: int = 50, devices: int = 30, not_set_rate: float = 0.05,
+                 page_size: int = 100000, seed: int = 0, skew: float = 1.5,
+                 fail_rate: float = 0.0, fail_after: int = 0):
+        self.rows_per_day = rows_per_day
+        self.countries = countries
+        self.cities = cities
+        self.pages = pages
+        self.devices = devices
+        self.not_set_rate = not_set_rate
+        self.page_size = page_size
+        self.seed = seed
+        self.skew = skew
+        self.fail_rate = fail_rate
+        self.fail_after = fail_after
+        self.calls = 0
+        self.tokens = 0
+        self._lock = threading.Lock()
+        # Aggregated reports by request, least recently used first
+        self._tables = OrderedDict()
+
+        self.country_names = np.array(
+            [COUNTRY_NAMES[i] if i < len(COUNTRY_NAMES) else f"Country {i}" for i in range(countries)],
+            dtype=object)
+        self.city_names = np.array([f"City {i}" for i in range(cities)], dtype=object)
+        self.city_ids = np.array([str(1000000 + i) for i in range(cities)], dtype=object)
+        # Every city belongs to one country
+        self.city_country = np.arange(cities) % max(countries, 1)
+        self.page_paths = np.array(
+            [BASE_PAGES[i] if i < len(BASE_PAGES) else f"/posts/{i}/?ref={i % 7}" for i in range(pages)],
+            dtype=object)
+        self.device_models = np.array(
+            [NOT_SET if i == 0 else f"Model {i}" for i in range(devices)], dtype=object)
+
+    @classmethod
+    def from_env(cls) -> "FakeAnalyticsClient":
+        """Build a client from the GA_FAKE_* environment variables."""
+        return cls(
+            rows_per_day=_env_int("GA_FAKE_ROWS_PER_DAY", 200),
+            countries=_env_int("GA_FAKE_COUNTRIES", 20),
+            cities=_env_int("GA_FAKE_CITIES", 200),
+            pages=_env_int("GA_FAKE_PAGES", 50),
+            devices=_env_int("GA_FAKE_DEVICES", 30),
+            not_set_rate=float(os.environ.get("GA_FAKE_NOT_SET_RATE", 0.05)),
+            page_size=_env_int("GA_FAKE_PAGE_SIZE", 100000),
+            seed=_env_int("GA_FAKE_SEED", 0),
+            skew=float(os.environ.get("GA_FAKE_SKEW", 1.5)),
+            fail_rate=float(os.environ.get("GA_FAKE_FAIL_RATE", 0)),
+            fail_after=_env_int("GA_FAKE_FAIL_AFTER", 0),
+        )
+
+    def _events(self, day: date) -> pd.DataFrame:
+        """Synthetic events of one day, always the same for a given day and seed."""
+        rng = np.random.default_rng([self.seed, day.toordinal()])
+        n = self.rows_per_day
+
+        def skewed(size):
+            # Zipf-like popularity: a few values get most of the traffic
+            if self.skew <= 1:
+                return rng.integers(0, size, n)
+            return np.minimum(rng.zipf(self.skew, n) - 1, size - 1)
+
+        city = skewed(self.cities)
+        events = pd.DataFrame({
+            "day": np.full(n, day.toordinal()),
+            "minute": rng.integers(0, 24 * 60, n),
+            "city": city,
+            "country": self.city_country[city],
+            "device_category": rng.integers(0, len(DEVICE_CATEGORIES), n),
+            "device_model": skewed(self.devices),
+            "page": skewed(self.pages),
+            "file": rng.integers(0, len(FILE_NAMES), n),
+            "link": rng.integers(0, len(LINK_URLS), n),
+            "new": (rng.random(n) < 0.6).astype(np.int64),
+        })
+        # -1 marks "(not set)"
+        for column in ("city", "country", "device_model"):
+            events.loc[rng.random(n) < self.not_set_rate, column] = -1
+        # Like GA, report nothing that has not happened yet
+        now = datetime.now()
+        if day >= now.date():
+            events = events[(day == now.date()) & (events["minute"] <= now.hour * 60 + now.minute)]
+            events = events.reset_index(drop=True)
+        return events
+
+    def _dimension(self, name: str, events: pd.DataFrame) -> np.ndarray:
+        """String values of one dimension for every event."""
+        def lookup(values, codes):
+            out = np.where(codes >= 0, values[np.maximum(codes, 0)], NOT_SET)
+            return out.astype(object)
+
+        days = events["day"].to_numpy()
+        minutes = events["minute"].to_numpy()
+        if name in ("date", "dateHour", "dateHourMinute"):
+            unique_days, inverse = np.unique(days, return_inverse=True)
+            stamps = np.array([date.fromordinal(int(d)).strftime("%Y%m%d") for d in unique_days], dtype=object)
+            out = stamps[inverse]
+            if name == "date":
+                return out
+            hours = np.char.zfill((minutes // 60).astype(str), 2).astype(object)
+            if name == "dateHour":
+                return out + hours
+            return out + hours + np.char.zfill((minutes % 60).astype(str), 2).astype(object)
+        if name == "country":
+            return lookup(self.country_names, events["country"].to_numpy())
+        if name == "city":
+            return lookup(self.city_names, events["city"].to_numpy())
+        if name == "cityId":
+            return lookup(self.city_ids, events["city"].to_numpy())
+        if name == "deviceCategory":
+            return np.array(DEVICE_CATEGORIES, dtype=object)[events["device_category"].to_numpy()]
+        if name == "deviceModel":
+            return lookup(self.device_models, events["device_model"].to_numpy())
+        if name == "pagePathPlusQueryString":
+            return self.page_paths[events["page"].to_numpy()]
+        if name == "fileName":
+            return np.array(FILE_NAMES, dtype=object)[events["file"].to_numpy()]
+        if name == "linkUrl":
+            return np.array(LINK_URLS, dtype=object)[events["link"].to_numpy()]
+        raise ValueError(f"Fake client does not support dimension {name!r}")
+
+    def _table(self, request) -> pd.DataFrame:
+        """Aggregated report rows for a request, ignoring limit and offset."""
+        dimensions = [d.name for d in request.dimensions]
+        metrics = [m.name for m in request.metrics]
+        ranges = [(_resolve_date(r.start_date), _resolve_date(r.end_date)) for r in request.date_ranges]
+        # Today's events grow by the minute, so a table covering today is only reused within it
+        now = datetime.now()
+        cutoff = now.strftime("%Y%m%d%H%M") if any(last >= now.date() for _, last in ranges) else None
+        key = hashlib.sha256(repr((dimensions, metrics, ranges, cutoff)).encode()).hexdigest()
+        with self._lock:
+            if key in self._tables:
+                self._tables.move_to_end(key)
+                return self._tables[key]
+
+        frames = []
+        for day, last in ranges:
+            while day <= last:
+                frames.append(self._events(day))
+                day += timedelta(days=1)
+        events = pd.concat(frames, ignore_index=True) if frames else self._events(date.today()).iloc[:0]
+
+        columns = {name: self._dimension(name, events) for name in dimensions}
+        columns["activeUsers"] = np.ones(len(events), dtype=np.int64)
+        columns["newUsers"] = events["new"].to_numpy()
+        for name in metrics:
+            if name not in ("activeUsers", "newUsers"):
+                raise ValueError(f"Fake client does not support metric {name!r}")
+
+        table = pd.DataFrame(columns)
+        if dimensions:
+            table = table.groupby(dimensions, sort=True, as_index=False)[["activeUsers", "newUsers"]].sum()
+        else:
+            table = table[["activeUsers", "newUsers"]].sum().to_frame().T
+        table = table[dimensions + metrics]
+        with self._lock:
+            self._tables[key] = table
+            # A long-lived client (the daemon) sees a new date range every day
+            while len(self._tables) > TABLE_CACHE_SIZE:
+                self._tables.popitem(last=False)
+        return table
+
+    def report_frame(self, request) -> pd.DataFrame:
+        """The whole report as strings, as response_to_frame would decode it.
+
+        Ignores limit and offset and skips building protobuf messages, which
+        makes it the cheap way to produce large synthetic datasets.
+        """
+        return self._table(request).astype(str).astype(object)
+
+    def run_report(self, request) -> RunReportResponse:
+        """Answer one report request, one page at a time like the real API."""
+        with self._lock:
+            self.calls += 1
+            call = self.calls
+        if self.fail_after and call > self.fail_after:
+            raise ServiceUnavailable(f"Fake outage after {self.fail_after} calls")
+        draw = int.from_bytes(hashlib.sha256(f"{self.seed}:{call}".encode()).digest()[:8], "big") / 2 ** 64
+        if draw < self.fail_rate:
+            raise ServiceUnavailable(f"Fake transient failure on call {call}")
+        table = self._table(request)
+        dimensions = [d.name for d in request.dimensions]
+        metrics = [m.name for m in request.metrics]
+
+        limit = request.limit or 10000
+        limit = min(limit, self.page_size)
+        page = table.iloc[request.offset:request.offset + limit]
+
+        response = RunReportResponse(
+            dimension_headers=[DimensionHeader(name=name) for name in dimensions],
+            metric_headers=[MetricHeader(name=name, type_=MetricType.TYPE_INTEGER) for name in metrics],
+            row_count=len(table),
+        )
+        if request.return_property_quota:
+            tokens = 1 + len(page) // 1000
+            with self._lock:
+                self.tokens += tokens
+                used = self.tokens
+            response.property_quota = PropertyQuota(
+                tokens_per_day=QuotaStatus(consumed=tokens, remaining=max(TOKENS_PER_DAY - used, 0)),
+                tokens_per_hour=QuotaStatus(consumed=tokens, remaining=max(TOKENS_PER_HOUR - used, 0)),
+            )
+        pb = RunReportResponse.pb(response)
+        dim_values = [page[name].astype(str).tolist() for name in dimensions]
+        metric_values = [page[name].astype(str).tolist() for name in metrics]
+        for i in range(len(page)):
+            row = pb.rows.add()
+            for values in dim_values:
+                row.dimension_values.add(value=values[i])
+            for values in metric_values:
+                row.metric_values.add(value=values[i])
+        return response
+
+    def batch_run_reports(self, request) -> BatchRunReportsResponse:
+        """Answer several report requests in one call."""
+        return BatchRunReportsResponse(reports=[self.run_report(r) for r in request.requests])
+
+
+def main():
+    from google.analytics.data_v1beta.types import DateRange, Dimension, Metric, RunReportRequest
+
+    start = sys.argv[1] if len(sys.argv) > 1 else "7daysAgo"
+    end = sys.argv[2] if len(sys.argv) > 2 else "today"
+    request = RunReportRequest(
+        property="properties/0",
+        dimensions=[Dimension(name=name) for name in ("date", "country", "city", "cityId")],
+        metrics=[Metric(name="activeUsers"), Metric(name="newUsers")],
+        date_ranges=[DateRange(start_date=start, end_date=end)],
+    )
+    response = FakeAnalyticsClient.from_env().run_report(request)
+    print(f"row_count: {response.row_count}")
+    for row in list(response.rows)[:10]:
+        print([v.value for v in row.dimension_values] + [v.value for v in row.metric_values])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,68 @@
 #!/usr/bin/env python3
 
-import pandas as pd
+import argparse
 import sys
+from pathlib import Path
 
-def filter_geotargets(csv_file, search_string):
+from geotargets import GEOTARGETS_FILE, GeotargetIndex
+
+def filter_geotargets(csv_file, search_string, mode="substring"):
     """
     Filter geotargets CSV by checking if Criteria ID or Parent ID contains the search string.
-    
+
+    Uses the on-disk index next to the CSV (built on first use), so only the
+    matching rows are read.
+
     Args:
         csv_file (str): Path to the CSV file
         search_string (str): String to search for in Criteria ID or Parent ID
-    
+        mode (str): "substring" (default), "prefix" or "exact"
+
     Returns:
         pd.DataFrame: Filtered dataframe
     """
-    df = pd.read_csv(csv_file)
-    
-    # Convert Criteria ID and Parent ID to strings for string matching
-    criteria_matches = df['Criteria ID'].astype(str).str.contains(search_string, na=False)
-    parent_matches = df['Parent ID'].astype(str).str.contains(search_string, na=False)
-    
-    # Filter rows where either Criteria ID or Parent ID contains the search string
-    filtered_df = df[criteria_matches | parent_matches]
-    
-    return filtered_df
+    return GeotargetIndex(Path(csv_file)).lookup(search_string, mode)
 
-def main():
-    csv_file = "geotargets-2025-07-15.csv"
-    
-    if len(sys.argv) > 1:
-        search_string = sys.argv[1]
+def print_records(result, search_string):
+    if len(result) > 0:
+        print(f"\nFound {len(result)} matching records:")
+
+        # Convert to long format: each variable becomes a row
+        for idx, row in result.iterrows():
+            print(f"\n--- Record {idx + 1} ---")
+            for column, value in row.items():
+                print(f"{column:<15}: {value}")
     else:
-        search_string = input("Enter the number to search for: ")
-    
+        print(f"\nNo records found containing '{search_string}' in Criteria ID or Parent ID")
+
+def main():
+    parser = argparse.ArgumentParser(description="Filter geotargets data by Criteria ID or Parent ID")
+    parser.add_argument("search_strings", nargs="*", help="Numbers to search for")
+    parser.add_argument("--mode", choices=["substring", "prefix", "exact"], default="substring",
+                        help="How to match the search strings (default: substring)")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="Resolve every Criteria ID listed in FILE (one per line, '-' for stdin) as CSV")
+    args = parser.parse_args()
+
+    csv_file = GEOTARGETS_FILE
+
     try:
-        result = filter_geotargets(csv_file, search_string)
-        
-        if len(result) > 0:
-            print(f"\nFound {len(result)} matching records:")
-            
-            # Convert to long format: each variable becomes a row
-            for idx, row in result.iterrows():
-                print(f"\n--- Record {idx + 1} ---")
-                for column, value in row.items():
-                    print(f"{column:<15}: {value}")
-        else:
-            print(f"\nNo records found containing '{search_string}' in Criteria ID or Parent ID")
-            
+        if args.batch:
+            source = sys.stdin if args.batch == "-" else open(args.batch)
+            with source:
+                ids = [line.strip() for line in source if line.strip()]
+            GeotargetIndex(Path(csv_file)).lookup_many(ids).to_csv(sys.stdout, index=False)
+            return
+
+        search_strings = args.search_strings or [input("Enter the number to search for: ")]
+        index = GeotargetIndex(Path(csv_file))
+        for search_string in search_strings:
+            print_records(index.lookup(search_string, args.mode), search_string)
+
     except FileNotFoundError:
         print(f"Error: {csv_file} not found")
     except Exception as e:
         print(f"Error: {e}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,647 @@
+"""Fetch helpers shared by daily-user.py and details.py.
+
+The scripts are run directly (``python scripts/details.py``), so this
+directory is on ``sys.path`` and the module can be imported by name.
+"""
+import csv
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+# Configuration
+FIRST_DATE = "2020-04-01"
+STATE_FILE = '../data/fetch_state.json'
+# GA keeps revising the last couple of days, so always re-request a few
+# days before the high-water mark.
+LOOKBACK_DAYS = int(os.environ.get("GA_LOOKBACK_DAYS", "3"))
+# Set GA_FULL_REFRESH=1 to ignore the watermark and pull from FIRST_DATE
+FULL_REFRESH = os.environ.get("GA_FULL_REFRESH", "") == "1"
+# Rows requested per page (the Data API caps a single response at 250,000)
+PAGE_SIZE = int(os.environ.get("GA_PAGE_SIZE", "100000"))
+# Date-range sharding: "month", "week" or "none"
+SHARD_BY = os.environ.get("GA_SHARD_BY", "month")
+MAX_WORKERS = int(os.environ.get("GA_MAX_WORKERS", "4"))
+SHARD_RETRIES = int(os.environ.get("GA_SHARD_RETRIES", "5"))
+# Exponential backoff between attempts: base * 2^(attempt - 1), capped, with jitter
+BACKOFF_BASE = float(os.environ.get("GA_BACKOFF_BASE", "1"))
+BACKOFF_MAX = float(os.environ.get("GA_BACKOFF_MAX", "60"))
+# Stop fetching when this few property tokens are left for the day or hour
+QUOTA_RESERVE = int(os.environ.get("GA_QUOTA_RESERVE", "0"))
+# API errors that retrying cannot fix
+PERMANENT_ERRORS = {"InvalidArgument", "PermissionDenied", "Unauthenticated", "NotFound", "FailedPrecondition"}
+# The Data API accepts at most 5 reports per batchRunReports call
+BATCH_LIMIT = 5
+
+
+def read_last_value(csv_path: Path, column: str, block_size: int = 8192) -> Optional[str]:
+    """Read one column of the last row of a CSV without parsing the whole file.
+
+    The data files are kept sorted by date/time, so the last line holds the
+    high-water mark.
+
+    Args:
+        csv_path (Path): Path to the CSV file
+        column (str): Column name to read
+        block_size (int): Number of bytes read per step from the end of the file
+
+    Returns:
+        Optional[str]: The value, or None if the file/column is missing or empty
+    """
+    if not csv_path.exists():
+        return None
+
+    with open(csv_path, 'rb') as f:
+        header = f.readline().decode('utf-8')
+        header_end = f.tell()
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        if end <= header_end:
+            return None
+
+        # Read backwards until the buffer holds a complete last line
+        buffer = b''
+        pos = end
+        while pos > header_end:
+            step = min(block_size, pos - header_end)
+            pos -= step
+            f.seek(pos)
+            buffer = f.read(step) + buffer
+            if buffer.rstrip(b'\r\n').count(b'\n') >= 1:
+                break
+
+    lines = buffer.rstrip(b'\r\n').split(b'\n')
+    last_line = lines[-1].decode('utf-8')
+
+    columns = next(csv.reader([header]))
+    if column not in columns:
+        return None
+    values = next(csv.reader([last_line]), [])
+    index = columns.index(column)
+    if index >= len(values) or values[index] == '':
+        return None
+    return values[index]
+
+
+def load_watermark(state_path: Path, key: str, data_path: Path, column: str) -> Optional[str]:
+    """Load the high-water mark for a dataset.
+
+    Args:
+        state_path (Path): Path to the JSON state file
+        key (str): Dataset name inside the state file (e.g. "raw_data")
+        data_path (Path): CSV file or Parquet dataset directory, used as a
+            fallback source
+        column (str): Date/time column of the data file
+
+    Returns:
+        Optional[str]: Latest date/time already stored, or None if unknown
+
+    Note:
+        The stored mark is never trusted beyond the data: if the data file
+        was restored from an older backup, its own last value is used, so
+        the fetch does not leave a gap.
+    """
+    # Without a data file the stored mark is stale; fetch everything again
+    if not data_path.exists():
+        return None
+
+    if data_path.is_dir():
+        from storage import latest_value
+        stored = latest_value(data_path, column)
+    else:
+        stored = read_last_value(data_path, column)
+
+    if state_path.exists():
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            if key in state:
+                if stored is not None and state[key] > stored:
+                    logging.warning(f"Watermark {state[key]} of {key} is past the data ({stored}); using the data")
+                    return stored
+                return state[key]
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read state file {state_path}: {e}")
+
+    return stored
+
+
+def save_watermark(state_path: Path, key: str, value: str) -> None:
+    """Persist the high-water mark for a dataset.
+
+    Args:
+        state_path (Path): Path to the JSON state file
+        key (str): Dataset name inside the state file
+        value (str): Latest date/time now stored
+    """
+    state = {}
+    if state_path.exists():
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+
+    state[key] = str(value)
+    state_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = state_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+
+def compute_start_date(watermark: Optional[str], lookback_days: int = LOOKBACK_DAYS) -> str:
+    """Compute the first date to request from GA.
+
+    Args:
+        watermark (Optional[str]): Latest date ("YYYY-MM-DD") or time
+            ("YYYY-MM-DD HH:MM:SS") already stored
+        lookback_days (int): Number of days before the watermark to re-request
+
+    Returns:
+        str: Start date in "YYYY-MM-DD" format, never earlier than FIRST_DATE
+    """
+    if FULL_REFRESH or not watermark:
+        return FIRST_DATE
+
+    try:
+        latest = datetime.strptime(str(watermark)[:10], '%Y-%m-%d')
+    except ValueError:
+        logging.warning(f"Invalid watermark {watermark!r}, fetching full history")
+        return FIRST_DATE
+
+    start = (latest - timedelta(days=lookback_days)).strftime('%Y-%m-%d')
+    return max(start, FIRST_DATE)
+
+
+class DecodedPage:
+    """A report page that is already decoded, e.g. read from a ResponseCache.
+
+    Stands in for a RunReportResponse where pages are processed:
+    response_to_frame returns its frame, and rows and row_count give the
+    page length and the report size.
+    """
+
+    def __init__(self, frame: pd.DataFrame, row_count: int):
+        self.frame = frame
+        self.row_count = row_count
+        self.rows = range(len(frame))
+
+
+class QuotaExhausted(RuntimeError):
+    """The property has (almost) no tokens left for the day or the hour."""
+
+
+class QuotaTracker:
+    """Property token usage, as reported in the property_quota of each response.
+
+    Requests made with a tracker ask for return_property_quota. The tokens
+    consumed by this run are summed and the last reported remaining amount
+    is kept for every quota.
+    """
+
+    QUOTAS = ['tokens_per_day', 'tokens_per_hour', 'tokens_per_project_per_hour',
+              'concurrent_requests', 'server_errors_per_project_per_hour',
+              'potentially_thresholded_requests_per_hour']
+
+    def __init__(self, reserve: int = QUOTA_RESERVE):
+        self.reserve = reserve
+        self.responses = 0
+        self.consumed = {name: 0 for name in self.QUOTAS}
+        self.remaining: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def update(self, response) -> None:
+        pb = type(response).pb(response)
+        if not pb.HasField("property_quota"):
+            return
+        quota = pb.property_quota
+        with self._lock:
+            self.responses += 1
+            for name in self.QUOTAS:
+                if quota.HasField(name):
+                    status = getattr(quota, name)
+                    self.consumed[name] += status.consumed
+                    self.remaining[name] = status.remaining
+
+    def exhausted(self) -> bool:
+        with self._lock:
+            return any(self.remaining.get(name, self.reserve + 1) <= self.reserve
+                       for name in ('tokens_per_day', 'tokens_per_hour'))
+
+    def check(self) -> None:
+        """Raise QuotaExhausted instead of sending requests that would be refused."""
+        if self.exhausted():
+            raise QuotaExhausted(f"Property quota exhausted: {self.remaining}")
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {"responses": self.responses, "consumed": dict(self.consumed), "remaining": dict(self.remaining)}
+
+
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_MAX) -> float:
+    """Seconds to wait after a failed attempt: exponential, capped, with full jitter in the upper half."""
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def call_with_retry(fn: Callable, what: str, retries: int = SHARD_RETRIES, quota: Optional[QuotaTracker] = None):
+    """Call fn, retrying transient failures with exponential backoff.
+
+    Errors in PERMANENT_ERRORS, and quota errors once the tracked quota is
+    used up, are raised at once.
+    """
+    for attempt in range(1, retries + 1):
+        if quota is not None:
+            quota.check()
+        try:
+            return fn()
+        except Exception as e:
+            if type(e).__name__ in PERMANENT_ERRORS or attempt == retries:
+                raise
+            if quota is not None and quota.exhausted():
+                raise QuotaExhausted(f"Property quota exhausted: {quota.remaining}") from e
+            delay = backoff_delay(attempt)
+            logging.warning(f"{what} failed (attempt {attempt}/{retries}): {e}. Retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def _cached_call(call: Callable, page_request, cache, quota: Optional[QuotaTracker]):
+    """Answer a page request from the cache, or call the API and cache the decoded page."""
+    if cache is not None:
+        page = cache.get(page_request)
+        if page is not None:
+            return page
+    response = call()
+    if quota is not None:
+        quota.update(response)
+    if cache is None:
+        return response
+    page = DecodedPage(response_to_frame(response), response.row_count)
+    cache.put(page_request, page)
+    return page
+
+
+def iter_report_pages(client, request, page_size: int = PAGE_SIZE, offset: int = 0,
+                      retries: int = SHARD_RETRIES, quota: Optional[QuotaTracker] = None,
+                      cache=None) -> Iterator:
+    """Run a report page by page using limit/offset.
+
+    A single run_report call silently truncates large reports, so keep asking
+    for the next page until row_count rows have been pulled. Pages are yielded
+    as they arrive, so the caller can process one while the rest are pending.
+    Each page is retried on its own with call_with_retry.
+
+    Args:
+        client: Google Analytics client exposing run_report
+        request: RunReportRequest to execute; it is copied, not modified
+        page_size (int): Number of rows requested per page
+        offset (int): Row to start from, e.g. when resuming from a checkpoint
+        retries (int): Attempts per page before giving up
+        quota (Optional[QuotaTracker]): Records the property quota of every page
+        cache (Optional[ResponseCache]): Decoded pages to reuse instead of calling the API
+
+    Yields:
+        RunReportResponse: One response per non-empty page, or a DecodedPage
+            when a cache is used
+    """
+    pages = 0
+    row_count = None
+    while row_count is None or offset < row_count:
+        page_request = type(request)(request)
+        page_request.limit = page_size
+        page_request.offset = offset
+        page_request.return_property_quota = quota is not None
+
+        response = _cached_call(
+            lambda: call_with_retry(lambda: client.run_report(page_request), f"Page at offset {offset}",
+                                    retries, quota),
+            page_request, cache, quota)
+        row_count = response.row_count
+        n_rows = len(response.rows)
+        if n_rows == 0:
+            break
+
+        pages += 1
+        offset += n_rows
+        logging.info(f"Fetched page {pages}: {offset}/{row_count} rows")
+        yield response
+
+    logging.info(f"Pulled {offset} rows in {pages} page(s)")
+
+
+def _resolve_date(value: str) -> date:
+    """Turn a GA date string ("YYYY-MM-DD", "today", "yesterday", "NdaysAgo") into a date."""
+    today = date.today()
+    if value == "today":
+        return today
+    if value == "yesterday":
+        return today - timedelta(days=1)
+    if value.endswith("daysAgo"):
+        return today - timedelta(days=int(value[:-len("daysAgo")]))
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def split_date_range(start_date: str, end_date: str, shard_by: str = SHARD_BY) -> List[Tuple[str, str]]:
+    """Split a date range into consecutive calendar shards.
+
+    Args:
+        start_date (str): First date, in any format accepted by DateRange
+        end_date (str): Last date (inclusive), in any format accepted by DateRange
+        shard_by (str): "month", "week" or "none"
+
+    Returns:
+        List[Tuple[str, str]]: (start, end) pairs in YYYY-MM-DD format, in order
+    """
+    start = _resolve_date(start_date)
+    end = _resolve_date(end_date)
+    if shard_by == "none" or start > end:
+        return [(start.isoformat(), end.isoformat())]
+    if shard_by not in ("month", "week"):
+        raise ValueError(f"Unknown shard size: {shard_by}")
+
+    shards = []
+    current = start
+    while current <= end:
+        if shard_by == "month":
+            next_start = (current.replace(day=1) + timedelta(days=32)).replace(day=1)
+        else:
+            # Weeks run Monday to Sunday
+            next_start = current + timedelta(days=7 - current.weekday())
+        shard_end = min(next_start - timedelta(days=1), end)
+        shards.append((current.isoformat(), shard_end.isoformat()))
+        current = next_start
+    return shards
+
+
+def _fetch_shard(client, request, process: Callable, retries: int,
+                 checkpoint=None, quota: Optional[QuotaTracker] = None, cache=None) -> list:
+    """Fetch and process every page of one shard, continuing from its checkpoint."""
+    shard = f"{request.date_ranges[0].start_date}..{request.date_ranges[0].end_date}"
+    frames, offset, complete = checkpoint.load(request) if checkpoint is not None else ([], 0, False)
+    if complete:
+        logging.info(f"Shard {shard} loaded from checkpoint ({offset} rows)")
+        return frames
+    if offset:
+        logging.info(f"Resuming shard {shard} at row {offset}")
+    for page in iter_report_pages(client, request, offset=offset, retries=retries, quota=quota, cache=cache):
+        frame = process(page)
+        frames.append(frame)
+        if checkpoint is not None:
+            checkpoint.save_page(request, offset, len(page.rows), frame)
+        offset += len(page.rows)
+    if checkpoint is not None:
+        checkpoint.complete(request)
+    return frames
+
+
+def _shard_requests(request, shard_by: str) -> Tuple[List[Tuple[str, str]], list]:
+    """Split a single-range request into one copy per date shard."""
+    date_range = request.date_ranges[0]
+    shards = split_date_range(date_range.start_date, date_range.end_date, shard_by)
+    shard_requests = []
+    for start, end in shards:
+        shard_request = type(request)(request)
+        del shard_request.date_ranges[:]
+        shard_request.date_ranges.append(type(date_range)(start_date=start, end_date=end))
+        shard_requests.append(shard_request)
+    return shards, shard_requests
+
+
+def fetch_report_frames(client, request, process: Callable, shard_by: str = SHARD_BY,
+                        max_workers: int = MAX_WORKERS, retries: int = SHARD_RETRIES,
+                        checkpoint=None, quota: Optional[QuotaTracker] = None, cache=None) -> list:
+    """Run a report as date shards on a bounded thread pool.
+
+    Each shard is paged with iter_report_pages and every page is passed to
+    process as soon as it arrives. A failing page is retried on its own;
+    with a checkpoint, the pages and shards already fetched are kept on disk
+    and the next run continues from them. Pages found in the cache are not
+    requested at all.
+
+    Args:
+        client: Google Analytics client exposing run_report
+        request: RunReportRequest with a single date range
+        process (Callable): Function turning a response page into a DataFrame
+        shard_by (str): "month", "week" or "none"
+        max_workers (int): Maximum number of shards fetched at the same time
+        retries (int): Attempts per page before giving up
+        checkpoint (Optional[FetchCheckpoint]): Where processed pages are kept
+        quota (Optional[QuotaTracker]): Records the property quota of every page
+        cache (Optional[ResponseCache]): Decoded pages to reuse instead of calling the API
+
+    Returns:
+        list: Processed frames, ordered by shard and then by page
+
+    Raises:
+        QuotaExhausted: If the property quota ran out
+        RuntimeError: If any shard still fails after all retries
+    """
+    shards, shard_requests = _shard_requests(request, shard_by)
+    logging.info(f"Fetching {len(shards)} shard(s) with up to {max_workers} worker(s)")
+
+    results = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {
+            executor.submit(_fetch_shard, client, shard_request, process, retries, checkpoint, quota, cache): i
+            for i, shard_request in enumerate(shard_requests)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except QuotaExhausted:
+                raise
+            except Exception as e:
+                logging.error(f"Shard {shards[i][0]}..{shards[i][1]} failed: {e}")
+                failed.append(shards[i])
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} shard(s) failed: {sorted(failed)}")
+
+    # Merge in shard order so the result does not depend on completion order
+    return [frame for i in range(len(shards)) for frame in results[i]]
+
+
+def _run_batch(client, requests: list, retries: int, quota: Optional[QuotaTracker] = None) -> list:
+    """Send page requests of one property as a single batch_run_reports call."""
+    from google.analytics.data_v1beta.types import BatchRunReportsRequest
+
+    batch = BatchRunReportsRequest(property=requests[0].property, requests=requests)
+    reports = call_with_retry(lambda: list(client.batch_run_reports(batch).reports),
+                              f"Batch of {len(requests)} report(s)", retries, quota)
+    if quota is not None:
+        for report in reports:
+            quota.update(report)
+    return reports
+
+
+def fetch_batch_frames(client, requests: Dict[str, object], processors: Dict[str, Callable],
+                       shard_by: str = SHARD_BY, max_workers: int = MAX_WORKERS,
+                       retries: int = SHARD_RETRIES, page_size: int = PAGE_SIZE,
+                       checkpoints: Optional[Dict[str, object]] = None,
+                       quota: Optional[QuotaTracker] = None, cache=None) -> Dict[str, list]:
+    """Run several reports together through batch_run_reports.
+
+    Every report is split into date shards like fetch_report_frames, and the
+    next page of every unfinished shard is sent in batches of up to
+    BATCH_LIMIT reports, on a bounded thread pool, until all row_counts are
+    reached. Each page is passed to the processor of its report as soon as
+    it arrives, and kept in the report's checkpoint, if any, so a later run
+    continues where this one stopped. Pages found in the cache are left out
+    of the batches.
+
+    Args:
+        client: Google Analytics client exposing batch_run_reports
+        requests (Dict[str, RunReportRequest]): Reports by name, each with a single date range
+        processors (Dict[str, Callable]): Page processor for each report name
+        shard_by (str): "month", "week" or "none"
+        max_workers (int): Maximum number of batches in flight
+        retries (int): Attempts per batch before giving up
+        page_size (int): Number of rows requested per page
+        checkpoints (Optional[Dict[str, FetchCheckpoint]]): Checkpoint of each report name
+        quota (Optional[QuotaTracker]): Records the property quota of every page
+        cache (Optional[ResponseCache]): Decoded pages to reuse instead of calling the API
+
+    Returns:
+        Dict[str, list]: Processed frames of each report, ordered by shard and then by page
+
+    Raises:
+        QuotaExhausted: If the property quota ran out
+        RuntimeError: If any batch still fails after all retries
+    """
+    checkpoints = checkpoints or {}
+    cursors = []
+    for name, request in requests.items():
+        shards, shard_requests = _shard_requests(request, shard_by)
+        checkpoint = checkpoints.get(name)
+        for shard, shard_request in zip(shards, shard_requests):
+            frames, offset, complete = checkpoint.load(shard_request) if checkpoint is not None else ([], 0, False)
+            cursors.append({"name": name, "shard": shard, "request": shard_request, "checkpoint": checkpoint,
+                            "offset": offset, "row_count": offset if complete else None, "frames": frames})
+    logging.info(f"Fetching {len(requests)} report(s) as {len(cursors)} shard(s) in batches of {BATCH_LIMIT}")
+
+    def run(batch):
+        page_requests = []
+        for cursor in batch:
+            page_request = type(cursor["request"])(cursor["request"])
+            page_request.limit = page_size
+            page_request.offset = cursor["offset"]
+            page_request.return_property_quota = quota is not None
+            page_requests.append(page_request)
+        pages = [cache.get(r) if cache is not None else None for r in page_requests]
+        missing = [i for i, page in enumerate(pages) if page is None]
+        if missing:
+            responses = _run_batch(client, [page_requests[i] for i in missing], retries, quota)
+            for i, response in zip(missing, responses):
+                if cache is not None:
+                    response = DecodedPage(response_to_frame(response), response.row_count)
+                    cache.put(page_requests[i], response)
+                pages[i] = response
+        return bool(missing), [(page, processors[cursor["name"]](page) if len(page.rows) else None)
+                               for cursor, page in zip(batch, pages)]
+
+    calls = 0
+    pending = [c for c in cursors if c["row_count"] is None]
+    if len(pending) < len(cursors):
+        logging.info(f"{len(cursors) - len(pending)} shard(s) loaded from checkpoints")
+    while pending:
+        # Reports of different properties cannot share a batch
+        by_property = {}
+        for cursor in pending:
+            by_property.setdefault(cursor["request"].property, []).append(cursor)
+        batches = [group[i:i + BATCH_LIMIT] for group in by_property.values()
+                   for i in range(0, len(group), BATCH_LIMIT)]
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = {executor.submit(run, batch): batch for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    called, results = future.result()
+                except QuotaExhausted:
+                    raise
+                except Exception as e:
+                    logging.error(f"Batch failed: {e}")
+                    failed.extend(f"{c['name']} {c['shard'][0]}..{c['shard'][1]}" for c in batch)
+                    continue
+                for cursor, (response, frame) in zip(batch, results):
+                    checkpoint = cursor["checkpoint"]
+                    cursor["row_count"] = response.row_count
+                    if frame is not None:
+                        if checkpoint is not None:
+                            checkpoint.save_page(cursor["request"], cursor["offset"], len(response.rows), frame)
+                        cursor["offset"] += len(response.rows)
+                        cursor["frames"].append(frame)
+                    else:
+                        # An empty page ends the report even if row_count disagrees
+                        cursor["row_count"] = cursor["offset"]
+                    if checkpoint is not None and cursor["offset"] >= cursor["row_count"]:
+                        checkpoint.complete(cursor["request"])
+                calls += called
+
+        if failed:
+            raise RuntimeError(f"{len(failed)} shard(s) failed: {sorted(failed)}")
+        pending = [c for c in pending if c["offset"] < c["row_count"]]
+
+    logging.info(f"Pulled {sum(c['offset'] for c in cursors)} rows in {calls} batch call(s)")
+    return {name: [frame for c in cursors if c["name"] == name for frame in c["frames"]]
+            for name in requests}
+
+
+def response_to_frame(response) -> pd.DataFrame:
+    """Decode a report response into a DataFrame, one column at a time.
+
+    Reads the underlying protobuf message directly instead of going through
+    the proto-plus row wrappers, and builds each column in a single pass.
+    All values stay strings, exactly as returned by the API.
+
+    Args:
+        response: RunReportResponse (proto-plus or raw protobuf), or a DecodedPage
+
+    Returns:
+        pd.DataFrame: One column per dimension followed by one per metric
+    """
+    if isinstance(response, DecodedPage):
+        return response.frame.copy()
+    pb = type(response).pb(response) if hasattr(type(response), 'pb') else response
+    rows = pb.rows
+
+    columns = {}
+    for i, header in enumerate(pb.dimension_headers):
+        columns[header.name] = [row.dimension_values[i].value for row in rows]
+    for i, header in enumerate(pb.metric_headers):
+        columns[header.name] = [row.metric_values[i].value for row in rows]
+
+    names = [h.name for h in pb.dimension_headers] + [h.name for h in pb.metric_headers]
+    return pd.DataFrame(columns, columns=names, dtype=object)
+
+
+def format_timestamps(values: pd.Series, in_format: str, out_format: str) -> pd.Series:
+    """Reformat GA date/time strings, parsing each distinct value only once.
+
+    Report rows share few distinct timestamps (at most one per minute), so
+    factorizing first makes the slow strftime step proportional to the number
+    of distinct values rather than to the number of rows.
+
+    Args:
+        values (pd.Series): Date strings such as "20250126" or "202501260215"
+        in_format (str): strptime format of the input
+        out_format (str): strftime format of the output
+
+    Returns:
+        pd.Series: Reformatted strings, aligned with values
+    """
+    codes, uniques = pd.factorize(values.astype(str))
+    formatted = pd.to_datetime(pd.Series(uniques), format=in_format).dt.strftime(out_format)
+    return pd.Series(formatted.to_numpy(dtype=object)[codes], index=values.index)
@@ -0,0 +1,365 @@
+"""On-disk index over the Google Ads geotargets CSV.
+
+The first lookup builds an index directory next to the CSV; later lookups
+memory-map it and only parse the rows they return:
+
+    - criteria_ids.npy / criteria_rows.npy: Criteria IDs sorted, with row numbers
+    - parent_ids.npy / parent_rows.npy: Parent IDs sorted, with row numbers
+    - ngram_keys.npy / ngram_offsets.npy / ngram_rows.npy: trigram postings of
+      both ID columns (as decimal strings) for substring search
+    - rows.bin / row_offsets.npy: the raw CSV lines, addressed by row number
+    - table.pkl: the columns used to enrich report rows, in file order
+
+The index is rebuilt automatically when the CSV changes.
+
+enrich_city_ids joins report cityIds against the table in one vectorized
+pass; update_city_table keeps a small cityId dimension file next to the
+raw data so the raw CSVs themselves keep their columns.
+"""
+import io
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Iterable, List
+
+import numpy as np
+import pandas as pd
+
+# Configuration
+GEOTARGETS_FILE = "geotargets-2025-07-15.csv"
+INDEX_SUFFIX = ".index"
+NGRAM = 3
+INDEX_VERSION = 2
+ID_COLUMNS = ("Criteria ID", "Parent ID")
+TABLE_COLUMNS = ["Criteria ID", "Canonical Name", "Parent ID", "Country Code", "Target Type"]
+CITY_COLUMNS = ["cityId", "geoName", "geoParentId", "geoParentName", "geoCountryCode", "geoTargetType"]
+
+
+def _index_dir(csv_file: Path) -> Path:
+    return csv_file.with_name(csv_file.name + INDEX_SUFFIX)
+
+
+def _source_stamp(csv_file: Path) -> dict:
+    stat = csv_file.stat()
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _id_strings(values: np.ndarray) -> List[str]:
+    """Decimal strings of an ID column, "" for missing IDs (stored as -1)."""
+    return ["" if v < 0 else str(v) for v in values.tolist()]
+
+
+def build_index(csv_file: Path) -> Path:
+    """Build the index directory for a geotargets CSV.
+
+    Args:
+        csv_file (Path): Path to the geotargets CSV
+
+    Returns:
+        Path: The index directory
+    """
+    index_dir = _index_dir(csv_file)
+    tmp_dir = index_dir.with_name(index_dir.name + ".tmp")
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+
+    with open(csv_file, "rb") as f:
+        header = f.readline()
+        lines = f.read().split(b"\n")
+    if lines and lines[-1] == b"":
+        lines.pop()
+
+    df = pd.read_csv(io.BytesIO(header + b"\n".join(lines)))
+    if len(df) != len(lines):
+        raise ValueError(f"{csv_file} has quoted line breaks; cannot index it line by line")
+    table = df[[c for c in TABLE_COLUMNS if c in df.columns]].copy()
+    table["Parent ID"] = table["Parent ID"].astype("Int64")
+    table.to_pickle(tmp_dir / "table.pkl")
+
+    # Raw rows, addressed by offset
+    offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    np.cumsum([len(line) + 1 for line in lines], out=offsets[1:])
+    with open(tmp_dir / "rows.bin", "wb") as f:
+        f.write(b"\n".join(lines) + b"\n")
+    np.save(tmp_dir / "row_offsets.npy", offsets)
+
+    # Sorted ID arrays for exact, prefix and batch lookups
+    ngram_keys = []
+    ngram_rows = []
+    for column, name in zip(ID_COLUMNS, ("criteria", "parent")):
+        ids = df[column].fillna(-1).astype(np.int64).to_numpy()
+        order = np.argsort(ids, kind="stable")
+        np.save(tmp_dir / f"{name}_ids.npy", ids[order])
+        np.save(tmp_dir / f"{name}_rows.npy", order.astype(np.int64))
+
+        for row, text in enumerate(_id_strings(ids)):
+            for i in range(len(text) - NGRAM + 1):
+                ngram_keys.append(int(text[i:i + NGRAM]))
+                ngram_rows.append(row)
+
+    # Trigram postings: unique (trigram, row) pairs grouped by trigram
+    pairs = np.unique(np.array([ngram_keys, ngram_rows], dtype=np.int64).T, axis=0) \
+        if ngram_keys else np.empty((0, 2), dtype=np.int64)
+    keys, starts = np.unique(pairs[:, 0], return_index=True)
+    np.save(tmp_dir / "ngram_keys.npy", keys)
+    np.save(tmp_dir / "ngram_offsets.npy", np.append(starts, len(pairs)).astype(np.int64))
+    np.save(tmp_dir / "ngram_rows.npy", pairs[:, 1].copy())
+
+    with open(tmp_dir / "meta.json", "w") as f:
+        json.dump({
+            "version": INDEX_VERSION,
+            "source": _source_stamp(csv_file),
+            "header": header.decode("utf-8").rstrip("\r\n"),
+        }, f)
+
+    if index_dir.exists():
+        shutil.rmtree(index_dir)
+    os.replace(tmp_dir, index_dir)
+    logging.info(f"Built geotargets index for {len(lines)} rows in {index_dir}")
+    return index_dir
+
+
+class GeotargetIndex:
+    """Memory-mapped lookups by Criteria ID and Parent ID."""
+
+    def __init__(self, csv_file: Path):
+        csv_file = Path(csv_file)
+        index_dir = _index_dir(csv_file)
+        meta_path = index_dir / "meta.json"
+        meta = None
+        if meta_path.exists():
+            with open(meta_path) as f:
+                meta = json.load(f)
+        if meta is None or meta.get("version") != INDEX_VERSION or meta["source"] != _source_stamp(csv_file):
+            build_index(csv_file)
+            with open(meta_path) as f:
+                meta = json.load(f)
+
+        def load(name):
+            return np.load(index_dir / f"{name}.npy", mmap_mode="r")
+
+        self.header = meta["header"]
+        self.criteria_ids = load("criteria_ids")
+        self.criteria_rows = load("criteria_rows")
+        self.parent_ids = load("parent_ids")
+        self.parent_rows = load("parent_rows")
+        self.ngram_keys = load("ngram_keys")
+        self.ngram_offsets = load("ngram_offsets")
+        self.ngram_rows = load("ngram_rows")
+        self.row_offsets = load("row_offsets")
+        self.rows = np.memmap(index_dir / "rows.bin", dtype=np.uint8, mode="r") \
+            if self.row_offsets[-1] > 0 else np.empty(0, dtype=np.uint8)
+        self.index_dir = index_dir
+        self._table = None
+        self._id_texts = None
+
+    def table(self) -> pd.DataFrame:
+        """The enrichment columns of every row, in file order (loaded once)."""
+        if self._table is None:
+            self._table = pd.read_pickle(self.index_dir / "table.pkl")
+        return self._table
+
+    def id_texts(self):
+        """Criteria ID and Parent ID of every row as strings, in file order (built once)."""
+        if self._id_texts is None:
+            texts = []
+            for ids, rows in ((self.criteria_ids, self.criteria_rows), (self.parent_ids, self.parent_rows)):
+                by_row = np.empty(len(self), dtype=np.int64)
+                by_row[rows] = ids
+                texts.append(np.array(_id_strings(by_row), dtype=str))
+            self._id_texts = tuple(texts)
+        return self._id_texts
+
+    def __len__(self) -> int:
+        return len(self.row_offsets) - 1
+
+    def fetch(self, rows: Iterable[int]) -> pd.DataFrame:
+        """Parse the given row numbers into a DataFrame, in the given order."""
+        rows = np.asarray(list(rows), dtype=np.int64)
+        lines = [bytes(self.rows[self.row_offsets[r]:self.row_offsets[r + 1]]) for r in rows]
+        df = pd.read_csv(io.BytesIO(self.header.encode("utf-8") + b"\n" + b"".join(lines)))
+        df.index = rows
+        return df
+
+    @staticmethod
+    def _range(ids: np.ndarray, rows: np.ndarray, low: int, high: int) -> np.ndarray:
+        """Row numbers whose ID lies in [low, high)."""
+        return np.asarray(rows[np.searchsorted(ids, low, "left"):np.searchsorted(ids, high, "left")])
+
+    def _both(self, low: int, high: int) -> np.ndarray:
+        return np.union1d(
+            self._range(self.criteria_ids, self.criteria_rows, low, high),
+            self._range(self.parent_ids, self.parent_rows, low, high),
+        )
+
+    def exact_rows(self, query: str) -> np.ndarray:
+        """Rows whose Criteria ID or Parent ID equals query."""
+        if not query.isdigit():
+            return np.empty(0, dtype=np.int64)
+        value = int(query)
+        return self._both(value, value + 1)
+
+    def prefix_rows(self, query: str) -> np.ndarray:
+        """Rows whose Criteria ID or Parent ID starts with query."""
+        if not query.isdigit() or query.startswith("0"):
+            return np.empty(0, dtype=np.int64)
+        value = int(query)
+        max_id = max(int(self.criteria_ids[-1]) if len(self.criteria_ids) else 0,
+                     int(self.parent_ids[-1]) if len(self.parent_ids) else 0)
+        found = []
+        scale = 1
+        # IDs starting with "123" are 123, 1230-1239, 12300-12399, ...
+        while value * scale <= max_id:
+            found.append(self._both(value * scale, (value + 1) * scale))
+            scale *= 10
+        return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
+
+    def substring_rows(self, query: str) -> np.ndarray:
+        """Rows whose Criteria ID or Parent ID contains query."""
+        if not query.isdigit():
+            return np.empty(0, dtype=np.int64)
+        texts_c, texts_p = self.id_texts()
+        if len(query) < NGRAM:
+            # Too short for the trigram postings: scan every row's IDs
+            found = (np.char.find(texts_c, query) >= 0) | (np.char.find(texts_p, query) >= 0)
+            return np.flatnonzero(found)
+
+        candidates = None
+        for i in range(len(query) - NGRAM + 1):
+            key = int(query[i:i + NGRAM])
+            pos = np.searchsorted(self.ngram_keys, key)
+            if pos == len(self.ngram_keys) or self.ngram_keys[pos] != key:
+                return np.empty(0, dtype=np.int64)
+            posting = np.asarray(self.ngram_rows[self.ngram_offsets[pos]:self.ngram_offsets[pos + 1]])
+            candidates = posting if candidates is None else np.intersect1d(candidates, posting)
+            if len(candidates) == 0:
+                return candidates
+
+        # Trigrams can match out of order, so verify against the real IDs
+        keep = (np.char.find(texts_c[candidates], query) >= 0) | (np.char.find(texts_p[candidates], query) >= 0)
+        return candidates[keep]
+
+    def lookup(self, query: str, mode: str = "substring") -> pd.DataFrame:
+        """Look up rows by Criteria ID or Parent ID.
+
+        Args:
+            query (str): Digits to search for
+            mode (str): "exact", "prefix" or "substring"
+
+        Returns:
+            pd.DataFrame: Matching rows in file order, indexed by row number
+        """
+        finders = {"exact": self.exact_rows, "prefix": self.prefix_rows, "substring": self.substring_rows}
+        if mode not in finders:
+            raise ValueError(f"Unknown lookup mode: {mode}")
+        return self.fetch(np.sort(finders[mode](query.strip())))
+
+    def lookup_many(self, criteria_ids: Iterable) -> pd.DataFrame:
+        """Resolve many Criteria IDs in one vectorized pass.
+
+        Args:
+            criteria_ids (Iterable): IDs as ints or strings; unknown ones are skipped
+
+        Returns:
+            pd.DataFrame: One row per resolved ID, in input order
+        """
+        ids = pd.to_numeric(pd.Series(list(criteria_ids), dtype=object), errors="coerce")
+        ids = ids.dropna().astype(np.int64).to_numpy()
+        pos = np.searchsorted(self.criteria_ids, ids)
+        pos[pos == len(self.criteria_ids)] = 0
+        found = (np.asarray(self.criteria_ids)[pos] == ids) if len(self.criteria_ids) else np.zeros(len(ids), bool)
+        return self.fetch(np.asarray(self.criteria_rows)[pos[found]])
+
+
+def normalize_city_ids(values: pd.Series) -> pd.Series:
+    """Turn cityId values into nullable integers.
+
+    Handles the forms found in the data: "1009540", "1009540.0" (CSV round
+    trips through float), floats, "", NaN and "(not set)".
+    """
+    return pd.to_numeric(values.astype(str).str.strip(), errors="coerce").astype("Int64")
+
+
+def _join(index: GeotargetIndex, ids: pd.Series) -> np.ndarray:
+    """Row numbers in the geotargets table for each ID, -1 where unknown."""
+    criteria_ids = np.asarray(index.criteria_ids)
+    values = ids.fillna(-1).to_numpy(dtype=np.int64)
+    if len(criteria_ids) == 0:
+        return np.full(len(values), -1, dtype=np.int64)
+    pos = np.searchsorted(criteria_ids, values)
+    pos[pos == len(criteria_ids)] = 0
+    found = (criteria_ids[pos] == values) & (values >= 0)
+    return np.where(found, np.asarray(index.criteria_rows)[pos], -1)
+
+
+def _take(column: pd.Series, rows: np.ndarray) -> np.ndarray:
+    out = column.to_numpy(dtype=object)[np.maximum(rows, 0)]
+    out[rows < 0] = ""
+    return out
+
+
+def enrich_city_ids(df: pd.DataFrame, index: GeotargetIndex, column: str = "cityId") -> pd.DataFrame:
+    """Add geotarget columns for every cityId in one vectorized join.
+
+    Args:
+        df (pd.DataFrame): Report rows with a cityId column
+        index (GeotargetIndex): Geotargets index
+        column (str): Name of the cityId column
+
+    Returns:
+        pd.DataFrame: Copy of df with geoName, geoParentId, geoParentName,
+            geoCountryCode and geoTargetType ("" where the ID is unknown)
+    """
+    table = index.table()
+    rows = _join(index, normalize_city_ids(df[column]))
+    parent_ids = table["Parent ID"].to_numpy(dtype=object)[np.maximum(rows, 0)]
+    parent_ids[rows < 0] = pd.NA
+    parent_rows = _join(index, pd.Series(parent_ids, dtype="Int64"))
+
+    out = df.copy()
+    out["geoName"] = _take(table["Canonical Name"], rows)
+    out["geoParentId"] = pd.Series(parent_ids, index=df.index, dtype="Int64").astype(str).replace("<NA>", "")
+    out["geoParentName"] = _take(table["Canonical Name"], parent_rows)
+    out["geoCountryCode"] = _take(table["Country Code"], rows) if "Country Code" in table else ""
+    out["geoTargetType"] = _take(table["Target Type"], rows) if "Target Type" in table else ""
+    return out
+
+
+def update_city_table(new_df: pd.DataFrame, cities_path: Path, geotargets_path: Path) -> int:
+    """Add the cityIds first seen in new_df to the cityId dimension file.
+
+    Args:
+        new_df (pd.DataFrame): New report rows with a cityId column
+        cities_path (Path): CSV with one row per known cityId
+        geotargets_path (Path): Geotargets CSV to resolve IDs against
+
+    Returns:
+        int: Number of cityIds added
+    """
+    if not geotargets_path.exists():
+        logging.info(f"Geotargets file {geotargets_path} not found, skipping city enrichment")
+        return 0
+
+    try:
+        ids = normalize_city_ids(new_df["cityId"]).dropna().unique()
+        known = pd.Series(dtype="Int64")
+        if cities_path.exists():
+            known = pd.read_csv(cities_path, usecols=["cityId"], dtype={"cityId": "Int64"})["cityId"]
+        unseen = pd.DataFrame({"cityId": pd.Series(ids, dtype="Int64")})
+        unseen = unseen[~unseen["cityId"].isin(known)].sort_values("cityId")
+        if unseen.empty:
+            return 0
+
+        enriched = enrich_city_ids(unseen, GeotargetIndex(geotargets_path))[CITY_COLUMNS]
+        cities_path.parent.mkdir(parents=True, exist_ok=True)
+        enriched.to_csv(cities_path, mode="a", header=not cities_path.exists(), index=False)
+        logging.info(f"Added {len(enriched)} cities to {cities_path}")
+        return len(enriched)
+
+    except Exception as e:
+        logging.error(f"Failed to enrich cities: {e}")
+        # Don't raise the exception to allow the main process to continue
+        return 0
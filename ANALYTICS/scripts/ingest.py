@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Refresh the daily and detail datasets in one go.
+
+Instead of running daily-user.py and details.py as separate processes, each
+with its own client and round trips, this builds one GA client and sends
+both reports through batch_run_reports. Every page is handed to the
+process_response of its script, and the results are stored by that script's
+own save_new_data, so the data files are exactly what the separate scripts
+would produce. With GA_DRY_RUN=1 each script's preview_new_data reports
+what would change instead.
+
+The daily report cannot be derived from the detail report (activeUsers is
+a distinct count), so both reports are still requested, just together.
+
+Usage:
+    python ingest.py [--levels daily detail]
+"""
+import argparse
+import importlib.util
+import logging
+import os
+import sys
+from pathlib import Path
+from typing import Dict
+
+# Report name -> entry script providing its request, processing and storage
+LEVELS = {'daily': 'daily-user', 'detail': 'details'}
+
+
+def load_script(dirname: Path, script: str):
+    """Import a hyphenated entry script (e.g. daily-user.py) as a module."""
+    spec = importlib.util.spec_from_file_location(script.replace('-', '_'), dirname / f"{script}.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_levels(dirname: Path, levels: list) -> Dict[str, object]:
+    """Import the entry script of every level, keyed by level name."""
+    return {level: load_script(dirname, LEVELS[level]) for level in levels}
+
+
+def setup_client(dirname: Path, modules: Dict[str, object]):
+    """Create the GA client shared by all levels."""
+    from fake_ga import FAKE_GA
+
+    first = next(iter(modules.values()))
+    credentials_path = dirname / first.CREDENTIALS_PATH
+    if not FAKE_GA and not credentials_path.exists():
+        raise FileNotFoundError(f"Credentials file not found: {credentials_path}")
+    return first.setup_ga_client(str(credentials_path))
+
+
+def ingest(dirname: Path, modules: Dict[str, object], client=None) -> Dict[str, int]:
+    """Fetch the given levels in shared batch calls and store each one.
+
+    Args:
+        dirname (Path): Directory where the scripts are located
+        modules (Dict[str, module]): Entry script of each level, from load_levels
+        client: GA client to reuse; a new one is created if None
+
+    Returns:
+        Dict[str, int]: Number of rows fetched for each level
+
+    Raises:
+        Exception: If fetching or storing fails
+    """
+    import pandas as pd
+
+    from checkpoint import CHECKPOINT_DIR, FetchCheckpoint
+    from ga_fetch import QuotaTracker, fetch_batch_frames
+    from response_cache import open_cache
+    from storage import DRY_RUN
+    from instrument import PROFILE_DIR, RUN_LOG_FILE, RunRecorder
+
+    recorder = RunRecorder('ingest', dirname / RUN_LOG_FILE, dirname / PROFILE_DIR)
+    try:
+        requests = {level: module.create_incremental_request(dirname) for level, module in modules.items()}
+
+        # One authenticated client for every report
+        if client is None:
+            with recorder.stage('client_setup'):
+                client = setup_client(dirname, modules)
+
+        processors = {
+            level: recorder.counter(f'decode_{level}', module.process_response,
+                                    lambda response: len(response.rows))
+            for level, module in modules.items()
+        }
+        # Pages of an interrupted run are read back from each level's checkpoint
+        checkpoints = {level: FetchCheckpoint(dirname / CHECKPOINT_DIR / Path(module.OUTPUT_FILE).stem)
+                       for level, module in modules.items()}
+        quota = QuotaTracker()
+        # Open-range pages are fetched fresh unless this is only a preview
+        cache = open_cache(dirname, serve_open=DRY_RUN)
+        with recorder.stage('api_call') as stage:
+            try:
+                frames = fetch_batch_frames(client, requests, processors, checkpoints=checkpoints, quota=quota,
+                                            cache=cache)
+            finally:
+                stage['quota'] = quota.summary()
+                if cache is not None:
+                    stage['cache'] = {'hits': cache.hits, 'misses': cache.misses}
+            stage['rows_out'] = sum(len(frame) for level_frames in frames.values() for frame in level_frames)
+        recorder.finish()
+    except Exception as e:
+        logging.error(f"Error fetching reports: {e}")
+        recorder.finish('error', e)
+        raise
+
+    # Fan the results out to each script's own storage pipeline
+    fetched = {}
+    for level, module in modules.items():
+        level_recorder = RunRecorder(Path(module.OUTPUT_FILE).stem, dirname / RUN_LOG_FILE, dirname / PROFILE_DIR)
+        fetched[level] = sum(len(frame) for frame in frames[level])
+        if not frames[level]:
+            logging.warning(f"No {level} data returned from Google Analytics")
+            checkpoints[level].clear()
+            level_recorder.finish('no_data')
+            continue
+        try:
+            new_df = pd.concat(frames[level], ignore_index=True).sort_values(module.TIME_COLUMN)
+            logging.info(f"Processed {len(new_df)} rows of new {level} data")
+            if DRY_RUN:
+                module.preview_new_data(new_df, dirname, level_recorder)
+                level_recorder.finish('dry_run')
+                continue
+            module.save_new_data(new_df, dirname, level_recorder)
+            checkpoints[level].clear()
+            level_recorder.finish()
+        except Exception as e:
+            logging.error(f"Error storing {level} data: {e}")
+            level_recorder.finish('error', e)
+            raise
+    return fetched
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Fetch the daily and detail reports in one batch")
+    parser.add_argument("--levels", nargs="+", choices=list(LEVELS), default=list(LEVELS),
+                        help="Reports to refresh (default: all)")
+    args = parser.parse_args()
+
+    dirname = Path(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        ingest(dirname, load_levels(dirname, args.levels))
+    except Exception:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Per-stage instrumentation and structured run records.
+
+main() in daily-user.py and details.py wraps each stage in
+RunRecorder.stage(); at the end of the run one JSON line is appended to
+../data/runs.jsonl with the duration, rows in/out, peak RSS and bytes
+read/written of every stage, so runs can be compared over time.
+
+Profiling:
+    GA_PROFILE=merge,load (or "all") runs those stages under cProfile and
+    writes ../data/profiles/<script>-<run_id>-<stage>.prof, readable with
+    pstats or snakeviz. cProfile only sees the main thread; for the threaded
+    API stage, attach a sampling profiler (e.g. py-spy) to the pid stored in
+    the run record and line it up using each stage's "offset".
+
+Usage:
+    python instrument.py [runs.jsonl] [-n N]    # summarise the last N runs
+"""
+import argparse
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional
+
+from perf import current_rss, measure
+
+# Configuration
+RUN_LOG_FILE = '../data/runs.jsonl'
+PROFILE_DIR = '../data/profiles'
+PROFILE_STAGES = {s.strip() for s in os.environ.get("GA_PROFILE", "").split(",") if s.strip()}
+
+
+class RunRecorder:
+    """Collects stage measurements for one run and appends them as a JSON line."""
+
+    def __init__(self, script: str, log_path: Path, profile_dir: Optional[Path] = None):
+        self.log_path = log_path
+        self.profile_dir = profile_dir
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self.record = {
+            "script": script,
+            "run_id": datetime.now().strftime('%Y%m%dT%H%M%S') + f"-{os.getpid()}",
+            "started": datetime.now().isoformat(timespec='seconds'),
+            "pid": os.getpid(),
+            "config": {k: v for k, v in os.environ.items() if k.startswith("GA_")},
+            "stages": [],
+        }
+
+    def _profile_path(self, name: str) -> Optional[Path]:
+        if self.profile_dir is None or not (name in PROFILE_STAGES or "all" in PROFILE_STAGES):
+            return None
+        return self.profile_dir / f"{self.record['script']}-{self.record['run_id']}-{name}.prof"
+
+    @contextmanager
+    def stage(self, name: str, **fields) -> Iterator[Dict]:
+        """Measure a stage.
+
+        Yields the stage's entry so the caller can add fields such as
+        rows_in/rows_out. The entry is recorded even if the stage raises.
+        """
+        entry = {"name": name, "offset": round(time.perf_counter() - self._start, 6), **fields}
+        profile_path = self._profile_path(name)
+        profiler = cProfile.Profile() if profile_path else None
+        try:
+            with measure() as stats:
+                if profiler:
+                    profiler.enable()
+                try:
+                    yield entry
+                finally:
+                    if profiler:
+                        profiler.disable()
+        finally:
+            entry.update(stats)
+            self.record["stages"].append(entry)
+            if profiler:
+                try:
+                    profile_path.parent.mkdir(parents=True, exist_ok=True)
+                    profiler.dump_stats(str(profile_path))
+                    entry["profile"] = str(profile_path)
+                except OSError as e:
+                    logging.error(f"Failed to write profile {profile_path}: {e}")
+
+    def counter(self, name: str, fn: Callable, count_in: Optional[Callable] = None) -> Callable:
+        """Wrap a function called many times (possibly from threads), e.g. per page.
+
+        Its calls, summed time and rows in/out are recorded as one stage.
+        Peak memory and I/O are not tracked per call; they belong to the
+        stage the calls run in.
+        """
+        entry = {"name": name, "calls": 0, "seconds": 0.0, "rows_in": 0, "rows_out": 0}
+        self._counters[name] = entry
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = fn(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                entry["calls"] += 1
+                entry["seconds"] += elapsed
+                if count_in is not None:
+                    entry["rows_in"] += count_in(*args)
+                if hasattr(result, "__len__"):
+                    entry["rows_out"] += len(result)
+            return result
+
+        return wrapper
+
+    def finish(self, status: str = "ok", error: Optional[BaseException] = None) -> None:
+        """Append the run record to the run log. Never raises."""
+        self.record["stages"].extend(self._counters.values())
+        self.record["status"] = status
+        if error is not None:
+            self.record["error"] = f"{type(error).__name__}: {error}"
+        self.record["seconds"] = round(time.perf_counter() - self._start, 6)
+        peaks = [s["peak_rss"] for s in self.record["stages"] if "peak_rss" in s]
+        self.record["peak_rss"] = max(peaks + [current_rss()])
+        try:
+            self.log_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(self.record) + "\n")
+        except OSError as e:
+            logging.error(f"Failed to write run record to {self.log_path}: {e}")
+
+
+def main():
+    dirname = Path(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description="Summarise recorded runs")
+    parser.add_argument("log", nargs="?", type=Path, default=dirname / RUN_LOG_FILE)
+    parser.add_argument("-n", type=int, default=10, help="Number of runs to show (default: 10)")
+    args = parser.parse_args()
+
+    if not args.log.exists():
+        print(f"Error: {args.log} not found")
+        sys.exit(1)
+    with open(args.log) as f:
+        runs = [json.loads(line) for line in f if line.strip()][-args.n:]
+
+    for run in runs:
+        print(f"\n{run['started']}  {run['script']}  {run['status']}  "
+              f"{run['seconds']:.2f}s  peak {run['peak_rss'] / 2**20:.0f} MiB")
+        for stage in run["stages"]:
+            rows = ""
+            if stage.get("rows_in") is not None or stage.get("rows_out") is not None:
+                rows = f"{stage.get('rows_in', '?')} -> {stage.get('rows_out', '?')} rows"
+            written = stage.get("bytes_written")
+            written = f"{written / 2**20:.1f} MiB written" if written else ""
+            print(f"  {stage['name']:<14}{stage['seconds']:>9.3f}s  {rows:<24}{written}")
+
+
+if __name__ == "__main__":
+    main()
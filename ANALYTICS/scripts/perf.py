@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Wall time, memory and I/O measurement for pipeline stages.
+
+measure() wraps a block of code and reports its duration, the peak resident
+set size reached while it ran, and the bytes the process read and wrote.
+Peak RSS is sampled from a background thread; I/O comes from /proc/self/io
+and is None on platforms without it.
+"""
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+# Configuration
+SAMPLE_INTERVAL = 0.01
+
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # ru_maxrss is the best we have here: bytes on macOS, KiB elsewhere
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def io_counters() -> Optional[Dict[str, int]]:
+    """Bytes read and written by this process so far, or None if unavailable.
+
+    Uses rchar/wchar, which count every read()/write() call including page
+    cache hits, so they match what the code asked for rather than what hit
+    the disk.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return {"read": int(fields["rchar"]), "written": int(fields["wchar"])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class RssSampler:
+    """Track the peak RSS of this process from a background thread."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self) -> "RssSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+@contextmanager
+def measure() -> Iterator[Dict]:
+    """Measure the enclosed block.
+
+    Yields a dict that is filled in when the block exits, with:
+        seconds: wall time
+        rss_start, peak_rss, rss_end: resident set size in bytes
+        bytes_read, bytes_written: process I/O during the block (None if unknown)
+
+    The dict is filled in even if the block raises.
+    """
+    stats = {}
+    io_start = io_counters()
+    rss_start = current_rss()
+    start = time.perf_counter()
+    sampler = RssSampler()
+    try:
+        with sampler:
+            yield stats
+    finally:
+        stats["seconds"] = time.perf_counter() - start
+        io_end = io_counters()
+        stats["rss_start"] = rss_start
+        stats["peak_rss"] = sampler.peak
+        stats["rss_end"] = current_rss()
+        if io_start and io_end:
+            stats["bytes_read"] = io_end["read"] - io_start["read"]
+            stats["bytes_written"] = io_end["written"] - io_start["written"]
+        else:
+            stats["bytes_read"] = stats["bytes_written"] = None
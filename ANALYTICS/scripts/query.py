@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""Show the latest stored rows without fetching anything.
+
+The data files are sorted by date/time, so the newest rows are read by
+seeking backwards from the end of the CSV and stopping as soon as enough
+matching rows were found (or the --from date was passed). Only the standard
+library is imported on this path; with GA_STORAGE=parquet and no exported
+CSV, the newest month partitions are read instead, which needs pandas and
+pyarrow and imports them only then. Rows still in the write-ahead log
+(GA_MERGE_MODE=wal) are merged in as compaction will, so they show at once.
+
+Usage:
+    python query.py [-l 1|2] [-n N | --all] [--from DATE] [--to DATE]
+                    [--country NAME] [--city NAME] [--page TEXT]
+
+Examples:
+    python query.py -l 2 -n 30 --country Japan
+    python query.py -l 1 --from 2025-01-01 --to 2025-01-31 --all
+"""
+import argparse
+import csv
+import heapq
+import io
+import os
+import sys
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from wal import WAL_DIR, WriteAheadLog
+
+# Configuration
+LEVEL_FILES = {'1': '../data/raw_data.csv', '2': '../data/raw_data_detail.csv'}
+LEVEL_DATASETS = {'1': '../data/raw_data', '2': '../data/raw_data_detail'}
+DEFAULT_LINES = {'1': 10, '2': 30}
+# Leading columns that identify a row (date, country, city, cityId); None for whole rows
+LEVEL_KEY_FIELDS = {'1': 4, '2': None}
+BLOCK_SIZE = 1 << 16
+
+
+def iter_lines_backward(csv_path: Path, block_size: int = BLOCK_SIZE) -> Iterator[str]:
+    """Yield the data lines of a CSV from last to first, reading blocks from the end.
+
+    The header is not yielded. Lines with quoted newlines are not supported;
+    the data files never contain any.
+    """
+    with open(csv_path, "rb") as f:
+        f.readline()
+        body_start = f.tell()
+        position = f.seek(0, os.SEEK_END)
+        carry = b""
+        while position > body_start:
+            size = min(block_size, position - body_start)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + carry).split(b"\n")
+            # The first piece may be a partial line; keep it for the next block
+            carry = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip():
+                    yield line.rstrip(b"\r").decode("utf-8")
+        if carry.strip():
+            yield carry.rstrip(b"\r").decode("utf-8")
+
+
+def read_header(csv_path: Path) -> str:
+    with open(csv_path, "rb") as f:
+        return f.readline().decode("utf-8").rstrip("\r\n")
+
+
+def merge_log_rows(rows: Iterable[List[str]], log_rows: List[List[str]],
+                   key_fields: Optional[int]) -> Iterator[List[str]]:
+    """Merge logged rows into newest-first stored rows, as compaction would.
+
+    The last logged row of a key wins, and stored rows with a logged key
+    are left out.
+    """
+    def key(row):
+        return tuple(row[:key_fields]) if key_fields else tuple(row)
+
+    latest = {key(row): row for row in log_rows}
+    logged = sorted(latest.values(), key=lambda row: row[0], reverse=True)
+    stored = (row for row in rows if key(row) not in latest)
+    return heapq.merge(logged, stored, key=lambda row: row[0], reverse=True)
+
+
+def read_log_rows(csv_path: Path) -> List[List[str]]:
+    """Rows of the write-ahead log next to a data file, in write order."""
+    _, lines = WriteAheadLog(csv_path.parent / Path(WAL_DIR).name / csv_path.stem).lines()
+    return list(csv.reader(lines))
+
+
+def read_tail(csv_path: Path, n: int, key_fields: Optional[int] = None) -> Tuple[str, List[str]]:
+    """Return the header and the last n lines of a CSV, oldest first.
+
+    Rows still in the write-ahead log are merged in, matched on the first
+    key_fields columns (whole rows when None).
+    """
+    log_rows = read_log_rows(csv_path)
+    if log_rows:
+        rows = (next(csv.reader([line])) for line in iter_lines_backward(csv_path))
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        for i, row in enumerate(merge_log_rows(rows, log_rows, key_fields)):
+            if i >= n:
+                break
+            writer.writerow(row)
+        lines = out.getvalue().split("\n")[:-1]
+        return read_header(csv_path), lines[::-1]
+    lines = []
+    for line in iter_lines_backward(csv_path):
+        if len(lines) >= n:
+            break
+        lines.append(line)
+    return read_header(csv_path), lines[::-1]
+
+
+def make_filter(columns: List[str], args) -> Callable[[List[str]], bool]:
+    """Build a predicate over parsed rows from the command-line filters.
+
+    Raises:
+        ValueError: If a filter refers to a column the file does not have
+    """
+    checks = []
+
+    def column(name):
+        if name not in columns:
+            raise ValueError(f"This data has no {name} column")
+        return columns.index(name)
+
+    if args.to:
+        checks.append(lambda row, i=0: row[i][:len(args.to)] <= args.to)
+    if args.country:
+        i, value = column('country'), args.country.lower()
+        checks.append(lambda row: row[i].lower() == value)
+    if args.city:
+        i, value = column('city'), args.city.lower()
+        checks.append(lambda row: row[i].lower() == value)
+    if args.page:
+        i = column('page')
+        checks.append(lambda row: args.page in row[i])
+    return lambda row: all(check(row) for check in checks)
+
+
+def iter_partition_rows(dataset_dir: Path) -> Iterator[List[str]]:
+    """Yield rows of a Parquet dataset from newest to oldest, as strings."""
+    from storage import list_partitions, read_partition
+
+    for key in reversed(list_partitions(dataset_dir)):
+        df = read_partition(dataset_dir, key).fillna("").astype(str)
+        yield from reversed(df.values.tolist())
+
+
+def query(source: Path, limit: Optional[int], args,
+          key_fields: Optional[int] = None) -> Tuple[List[str], List[List[str]]]:
+    """Collect the newest rows matching the filters, oldest first.
+
+    Args:
+        source (Path): CSV file, or Parquet dataset directory
+        limit (Optional[int]): Maximum number of rows, None for all
+        args: Parsed filters (from/to dates, country, city, page)
+        key_fields (Optional[int]): Leading columns matching logged rows to
+            stored ones; None for whole rows
+
+    Returns:
+        Tuple[List[str], List[List[str]]]: Column names and matching rows
+    """
+    if source.is_dir():
+        from storage import list_partitions, read_partition
+
+        keys = list_partitions(source)
+        columns = list(read_partition(source, keys[-1]).columns) if keys else []
+        rows = iter_partition_rows(source)
+    else:
+        columns = read_header(source).split(",")
+        rows = (next(csv.reader([line])) for line in iter_lines_backward(source))
+        log_rows = read_log_rows(source)
+        if log_rows:
+            rows = merge_log_rows(rows, log_rows, key_fields)
+
+    keep = make_filter(columns, args)
+    matches = []
+    for row in rows:
+        # Rows are newest first, so everything after this is older still
+        if args.since and row[0] < args.since:
+            break
+        if keep(row):
+            matches.append(row)
+            if limit is not None and len(matches) >= limit:
+                break
+    return columns, matches[::-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the latest stored GA rows without fetching")
+    parser.add_argument("-l", "--level", choices=list(LEVEL_FILES), default='1',
+                        help="1 for daily user data, 2 for detailed data (default: 1)")
+    parser.add_argument("-n", type=int, help="Number of rows to show (default: 10 for level 1, 30 for level 2)")
+    parser.add_argument("-a", "--all", action="store_true", help="Show every matching row")
+    parser.add_argument("--from", dest="since", metavar="DATE", help="First date/time to include")
+    parser.add_argument("--to", metavar="DATE", help="Last date/time to include (a date includes the whole day)")
+    parser.add_argument("--country", help="Country name (case-insensitive)")
+    parser.add_argument("--city", help="City name (case-insensitive)")
+    parser.add_argument("--page", help="Text contained in the page path (level 2)")
+    parser.add_argument("--file", type=Path, help="Query this CSV instead of the level's data file")
+    args = parser.parse_args()
+
+    dirname = Path(os.path.dirname(os.path.abspath(__file__)))
+    source = args.file or dirname / LEVEL_FILES[args.level]
+    dataset_dir = dirname / LEVEL_DATASETS[args.level]
+    if args.file is None and os.environ.get("GA_STORAGE") == "parquet" and dataset_dir.exists() \
+            and (not source.exists() or os.environ.get("GA_EXPORT_CSV", "1") != "1"):
+        source = dataset_dir
+    if not source.exists():
+        print(f"Error: {source} not found", file=sys.stderr)
+        sys.exit(1)
+
+    limit = None if args.all else (args.n if args.n is not None else DEFAULT_LINES[args.level])
+    try:
+        key_fields = None if args.file else LEVEL_KEY_FIELDS[args.level]
+        columns, rows = query(source, limit, args, key_fields)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(columns)
+    writer.writerows(rows)
+    try:
+        sys.stdout.write(out.getvalue())
+    except BrokenPipeError:
+        pass
+
+
+if __name__ == "__main__":
+    main()
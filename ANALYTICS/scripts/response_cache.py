@@ -0,0 +1,179 @@
+"""On-disk cache of decoded report pages.
+
+ga_fetch looks every page request up here before calling the API, so dry
+runs (test.py) and reruns that ask for the same pages again cost no API
+calls and no protobuf decoding. A page is stored as the DataFrame
+response_to_frame decoded from it, together with the report's row_count,
+under ../data/cache/<key>.pkl. The key is a hash of the page request:
+property, dimensions, metrics, filters, date range, limit and offset.
+
+Pages of closed date ranges, which end before GA stops revising the data
+(GA_LOOKBACK_DAYS before today), never expire. Pages of the open range
+expire after GA_CACHE_TTL_MINUTES (default 60), and are only ever served to
+previews (test.py and GA_DRY_RUN=1): a real refresh always asks the API for
+them, so it sees rows GA added since, and reuses only closed pages, e.g. when
+it is rerun after a failure. The cache is bounded to GA_CACHE_MAX_MB
+(default 512); the least recently used pages are evicted first. Set
+GA_CACHE=0 to bypass it.
+
+Usage:
+    python response_cache.py stats    # number and size of cached pages
+    python response_cache.py clear    # drop every cached page
+"""
+import argparse
+import hashlib
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Dict, Optional
+
+import pandas as pd
+
+from ga_fetch import LOOKBACK_DAYS, DecodedPage
+
+# Configuration
+CACHE_DIR = '../data/cache'
+CACHE_ENABLED = os.environ.get("GA_CACHE", "1") != "0"
+CACHE_TTL_MINUTES = float(os.environ.get("GA_CACHE_TTL_MINUTES", "60"))
+CACHE_MAX_MB = float(os.environ.get("GA_CACHE_MAX_MB", "512"))
+PAGE_SUFFIX = ".pkl"
+
+
+def page_key(request) -> str:
+    """Stable name of a page request; only the quota flag is left out."""
+    base = type(request)(request)
+    base.return_property_quota = False
+    return hashlib.sha256(type(request).serialize(base)).hexdigest()[:32]
+
+
+def is_closed(request, today: Optional[date] = None) -> bool:
+    """Whether every date range of the request ends before GA's revision window."""
+    today = today or date.today()
+    for date_range in request.date_ranges:
+        try:
+            end = datetime.strptime(date_range.end_date, '%Y-%m-%d').date()
+        except ValueError:
+            # "today", "NdaysAgo" and the like move with the calendar
+            return False
+        if end >= today - timedelta(days=LOOKBACK_DAYS):
+            return False
+    return True
+
+
+class ResponseCache:
+    """Decoded pages on disk, with a TTL for open ranges and LRU eviction by size.
+
+    With serve_open=False, pages of open ranges are still stored but never
+    returned, so the caller always fetches them fresh.
+    """
+
+    def __init__(self, directory: Path, ttl_minutes: float = CACHE_TTL_MINUTES,
+                 max_mb: float = CACHE_MAX_MB, serve_open: bool = True):
+        self.directory = directory
+        self.ttl_seconds = ttl_minutes * 60
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.serve_open = serve_open
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, request) -> Path:
+        return self.directory / (page_key(request) + PAGE_SUFFIX)
+
+    def get(self, request) -> Optional[DecodedPage]:
+        """The cached page for a request, or None if it is missing, expired or not served."""
+        path = self._path(request)
+        if not self.serve_open and not is_closed(request):
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            entry = pd.read_pickle(path)
+            if entry["expires"] is not None and time.time() > entry["expires"]:
+                path.unlink(missing_ok=True)
+                entry = None
+            else:
+                # The modification time orders pages for eviction
+                os.utime(path)
+        except FileNotFoundError:
+            entry = None
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable cache entry {path.name}: {e}")
+            path.unlink(missing_ok=True)
+            entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return DecodedPage(entry["frame"], entry["row_count"])
+
+    def put(self, request, page: DecodedPage) -> None:
+        """Store a decoded page, then evict old pages if the cache is too big."""
+        expires = None if is_closed(request) else time.time() + self.ttl_seconds
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(request)
+        tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        try:
+            pd.to_pickle({"frame": page.frame, "row_count": page.row_count, "expires": expires}, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not cache page {path.name}: {e}")
+            tmp_path.unlink(missing_ok=True)
+            return
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used pages until the cache fits in max_bytes."""
+        with self._lock:
+            entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                       for entry in os.scandir(self.directory) if entry.name.endswith(PAGE_SUFFIX)]
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                Path(path).unlink(missing_ok=True)
+                total -= size
+
+    def stats(self) -> Dict:
+        entries = [entry.stat().st_size for entry in os.scandir(self.directory)
+                   if entry.name.endswith(PAGE_SUFFIX)] if self.directory.exists() else []
+        return {"pages": len(entries), "bytes": sum(entries), "hits": self.hits, "misses": self.misses}
+
+    def clear(self) -> None:
+        if not self.directory.exists():
+            return
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(PAGE_SUFFIX):
+                Path(entry.path).unlink(missing_ok=True)
+
+
+def open_cache(dirname: Path, serve_open: bool = False) -> Optional[ResponseCache]:
+    """The response cache next to the data, or None when GA_CACHE=0.
+
+    Only previews pass serve_open=True; refreshes reuse closed pages only.
+    """
+    return ResponseCache(dirname / CACHE_DIR, serve_open=serve_open) if CACHE_ENABLED else None
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Inspect or clear the cache of decoded report pages")
+    parser.add_argument("command", choices=["stats", "clear"])
+    args = parser.parse_args()
+
+    dirname = Path(os.path.dirname(os.path.abspath(__file__)))
+    cache = ResponseCache(dirname / CACHE_DIR)
+    if args.command == "stats":
+        stats = cache.stats()
+        print(f"{stats['pages']} page(s), {stats['bytes'] / 1024 / 1024:.1f} MiB in {cache.directory}")
+    else:
+        cache.clear()
+        logging.info(f"Cleared {cache.directory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""Pre-aggregated rollups of the detail data.
+
+Questions like "top pages last week" or "downloads of a file by country per
+month" used to mean scanning all of raw_data_detail.csv. The rollups count
+rows (events) and new-user rows per time bucket for a few dimension
+combinations (the "cubes" below), at hour, day and month grain, so those
+questions are answered from a few small tables.
+
+The rollups are kept up to date like summary.py keeps its totals: counts of
+"closed" rows (older than the look-back window) are stored once, and only
+the open tail of the CSV is re-aggregated after each merge. If the file was
+rewritten before the closed part, everything is rebuilt in chunks.
+
+Everything is stored under ../data/rollup/: one segment directory per
+month of closed rows, which is written when the month closes and then left
+alone, plus one for the open rows, which is replaced on every update.
+state.json names the current segments. Each segment holds one compressed
+file per cube and grain, every column dictionary-encoded (int32 codes plus
+the distinct values), so a query reads only the files it needs.
+
+Usage:
+    python rollup.py top DIMENSION [...] [--grain G] [--from T] [--to T]
+                     [--where DIM=VALUE ...] [-n N]
+    python rollup.py series [--grain G] [--from T] [--to T] [--where DIM=VALUE ...]
+    python rollup.py update | rebuild
+
+Examples:
+    python rollup.py top page --grain day --from 2025-07-01 --to 2025-07-07
+    python rollup.py top country --grain month --where fileName=JMP_matsuno.pdf
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ga_fetch import LOOKBACK_DAYS, read_last_value
+from storage import file_stamp, find_tail_offset, prefix_digest, prefix_unchanged, read_tail_chunks
+
+# Configuration
+DATA_FILE = '../data/raw_data_detail.csv'
+ROLLUP_DIR = '../data/rollup'
+STATE_FILE = 'state.json'
+CHUNK_ROWS = int(os.environ.get("GA_CHUNK_ROWS", "1000000"))
+ROLLUP_VERSION = 4
+
+# Time bucket -> length of the time prefix that identifies it
+GRAINS = {'hour': 13, 'day': 10, 'month': 7}
+# Dimension combinations that are pre-aggregated
+CUBES = {
+    'country': ('country',),
+    'page': ('page',),
+    'fileName': ('fileName',),
+    'device': ('device',),
+    'fileName_country': ('fileName', 'country'),
+}
+MEASURES = ['rows', 'new']
+
+
+def aggregate(df: pd.DataFrame, dims: Tuple[str, ...], grain: str) -> pd.DataFrame:
+    """Count rows and new-user rows per (bucket, *dims) of raw detail rows."""
+    keys = pd.DataFrame({'bucket': df['time'].str.slice(0, GRAINS[grain])})
+    for dim in dims:
+        keys[dim] = df[dim].to_numpy()
+    keys['rows'] = 1
+    keys['new'] = (df['newUsers'] == "New").to_numpy().astype(np.int64)
+    return keys.groupby(['bucket', *dims], as_index=False, sort=False)[MEASURES].sum()
+
+
+def combine(tables: List[pd.DataFrame], dims: Tuple[str, ...]) -> pd.DataFrame:
+    """Sum partial tables of the same cube, sorted by bucket."""
+    tables = [t for t in tables if not t.empty]
+    if not tables:
+        return pd.DataFrame({col: pd.Series(dtype=object) for col in ['bucket', *dims]}
+                            | {m: pd.Series(dtype=np.int64) for m in MEASURES})
+    df = pd.concat(tables, ignore_index=True)
+    df = df.groupby(['bucket', *dims], as_index=False, sort=False)[MEASURES].sum()
+    return df.sort_values('bucket', kind='stable').reset_index(drop=True)
+
+
+def table_names() -> List[Tuple[str, str]]:
+    return [(cube, grain) for cube in CUBES for grain in GRAINS]
+
+
+def save_table(path: Path, df: pd.DataFrame, dims: Tuple[str, ...]) -> None:
+    """Write one table, dictionary-encoding the bucket and dimension columns."""
+    arrays = {}
+    for col in ['bucket', *dims]:
+        codes, uniques = pd.factorize(df[col])
+        arrays[f"{col}.codes"] = codes.astype(np.int32)
+        arrays[f"{col}.values"] = np.asarray(uniques, dtype=str)
+    for measure in MEASURES:
+        arrays[measure] = df[measure].to_numpy(dtype=np.int64)
+    np.savez_compressed(path, **arrays)
+
+
+def load_table(path: Path, dims: Tuple[str, ...]) -> pd.DataFrame:
+    with np.load(path) as data:
+        columns = {col: data[f"{col}.values"][data[f"{col}.codes"]] for col in ['bucket', *dims]}
+        columns.update({m: data[m] for m in MEASURES})
+    return pd.DataFrame(columns)
+
+
+def write_segment(segment_dir: Path, tables: Dict[Tuple[str, str], pd.DataFrame]) -> None:
+    """Write the tables of one segment (a closed month, or the open rows) to a new directory."""
+    segment_dir.mkdir(parents=True, exist_ok=True)
+    for (cube, grain), df in tables.items():
+        save_table(segment_dir / f"{cube}.{grain}.npz", df, CUBES[cube])
+
+
+def load_segment(segment_dir: Path) -> Dict[Tuple[str, str], pd.DataFrame]:
+    return {(cube, grain): load_table(segment_dir / f"{cube}.{grain}.npz", CUBES[cube])
+            for cube, grain in table_names()}
+
+
+def load_state(rollup_dir: Path) -> Optional[Dict]:
+    """Read the rollup state; None if missing or from another version."""
+    state_path = rollup_dir / STATE_FILE
+    if not state_path.exists():
+        return None
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read rollup state {state_path}: {e}")
+        return None
+    if state.get("version") != ROLLUP_VERSION or state.get("cubes") != {k: list(v) for k, v in CUBES.items()}:
+        return None
+    return state
+
+
+def save_state(rollup_dir: Path, state: Dict) -> None:
+    tmp_path = rollup_dir / f"{STATE_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_path, rollup_dir / STATE_FILE)
+
+
+def next_generation(rollup_dir: Path) -> int:
+    """One more than the highest generation of any segment directory on disk."""
+    generations = [int(match.group(1)) for path in rollup_dir.iterdir()
+                   if (match := re.search(r"\.g(\d+)$", path.name))]
+    return max(generations, default=0) + 1
+
+
+def remove_unreferenced(rollup_dir: Path, state: Dict) -> None:
+    """Delete segment directories the state no longer points to."""
+    keep = {state["open"], *state["segments"].values()}
+    for path in rollup_dir.iterdir():
+        if path.is_dir() and path.name not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def update_rollup(csv_path: Path, rollup_dir: Path, rebuild: bool = False) -> None:
+    """Fold the rows added since the last update into the stored rollups.
+
+    Rows closed by this update are added to the segment of their month;
+    months that were already closed are not read or rewritten. The open
+    rows are aggregated again into a fresh open segment. Changed segments
+    go to new directories and state.json is switched over last, so an
+    interrupted update leaves the previous rollups intact.
+
+    Args:
+        csv_path (Path): raw_data_detail.csv, sorted by time
+        rollup_dir (Path): Directory of the stored rollups
+        rebuild (bool): Ignore the stored rollups and start over
+
+    Note:
+        Errors are logged and not raised, so a failed rollup never fails
+        the fetch that fed it.
+    """
+    try:
+        if not csv_path.exists():
+            logging.info(f"{csv_path} not found, skipping rollups")
+            return
+
+        rollup_dir.mkdir(parents=True, exist_ok=True)
+        stamp = file_stamp(csv_path)
+        state = None if rebuild else load_state(rollup_dir)
+        if state is not None and not prefix_unchanged(csv_path, state["closed_offset"], state["closed_digest"],
+                                                      state["open_from"], state["csv_stamp"]):
+            logging.info("Data file changed before the rolled-up part, rebuilding rollups")
+            state = None
+
+        latest_time = read_last_value(csv_path, 'time')
+        if latest_time is None:
+            logging.info("No data to roll up")
+            return
+
+        # Rows that can no longer be revised are added to their month's
+        # segment; the rest is re-aggregated from the CSV on every update
+        latest = datetime.strptime(latest_time[:10], '%Y-%m-%d').date()
+        open_from = max(str(latest - timedelta(days=LOOKBACK_DAYS)), state["open_from"] if state else "")
+        segments = dict(state["segments"]) if state else {}
+        generation = next_generation(rollup_dir)
+        closed_parts: Dict[str, Dict[Tuple[str, str], List[pd.DataFrame]]] = {}
+        open_parts = {name: [] for name in table_names()}
+
+        def close_month(month: str) -> None:
+            """Write the segment of a month that received its last closed rows of this update."""
+            parts = closed_parts.pop(month)
+            if month in segments:
+                for name, df in load_segment(rollup_dir / segments[month]).items():
+                    parts[name].insert(0, df)
+            segments[month] = f"{month}.g{generation}"
+            write_segment(rollup_dir / segments[month],
+                          {name: combine(partial, CUBES[name[0]]) for name, partial in parts.items()})
+
+        offset = state["closed_offset"] if state else 0
+        n_rows = 0
+        usecols = ['time', 'newUsers', *sorted({d for dims in CUBES.values() for d in dims})]
+        for chunk in read_tail_chunks(csv_path, offset, usecols, CHUNK_ROWS):
+            n_rows += len(chunk)
+            is_open = (chunk['time'] >= open_from).to_numpy()
+            closed = chunk[~is_open]
+            months = closed['time'].str.slice(0, 7)
+            for month in months.unique():
+                parts = closed_parts.setdefault(month, {name: [] for name in table_names()})
+                rows = closed[(months == month).to_numpy()]
+                for cube, grain in table_names():
+                    parts[(cube, grain)].append(aggregate(rows, CUBES[cube], grain))
+            for cube, grain in table_names():
+                open_parts[(cube, grain)].append(aggregate(chunk[is_open], CUBES[cube], grain))
+            # The file is sorted by time, so earlier months get no more rows
+            last_month = chunk['time'].iloc[-1][:7] if len(chunk) else ""
+            for month in sorted(m for m in closed_parts if m < last_month):
+                close_month(month)
+        for month in sorted(closed_parts):
+            close_month(month)
+        open_segment = f"open.g{generation}"
+        write_segment(rollup_dir / open_segment,
+                      {name: combine(partial, CUBES[name[0]]) for name, partial in open_parts.items()})
+
+        closed_offset = find_tail_offset(csv_path, open_from)
+        logging.info(f"Rolled up {n_rows} tail rows up to {latest_time}")
+        previous = (state["closed_offset"], state["closed_digest"]) if state else None
+        state = {
+            "version": ROLLUP_VERSION,
+            "cubes": {k: list(v) for k, v in CUBES.items()},
+            "latest_time": latest_time,
+            "open_from": open_from,
+            "closed_offset": closed_offset,
+            "closed_digest": prefix_digest(csv_path, closed_offset, previous),
+            "csv_stamp": stamp,
+            "segments": dict(sorted(segments.items())),
+            "open": open_segment,
+        }
+        save_state(rollup_dir, state)
+        remove_unreferenced(rollup_dir, state)
+
+    except Exception as e:
+        logging.error(f"Failed to update rollups: {e}")
+
+
+class Rollup:
+    """Queries over the stored rollups.
+
+    Each query picks the smallest cube holding the requested dimensions, so
+    it only touches a table with one row per (bucket, value) seen. Only that
+    cube's tables at the requested grain are read, and only for the months
+    the time range covers.
+    """
+
+    def __init__(self, rollup_dir: Path):
+        self.rollup_dir = rollup_dir
+        self.state = load_state(rollup_dir)
+        if self.state is None:
+            raise FileNotFoundError(f"No rollups in {rollup_dir}, run: python rollup.py rebuild")
+        self._tables = {}
+
+    def _load(self, segment: str, cube: str, grain: str) -> pd.DataFrame:
+        key = (segment, cube, grain)
+        if key not in self._tables:
+            self._tables[key] = load_table(self.rollup_dir / segment / f"{cube}.{grain}.npz", CUBES[cube])
+        return self._tables[key]
+
+    def table(self, dims: List[str], grain: str, start: Optional[str] = None,
+              end: Optional[str] = None) -> Tuple[pd.DataFrame, np.ndarray]:
+        """Counts of the smallest cube covering dims in the months of a time range, with its bucket array."""
+        cubes = [cube for cube, cube_dims in CUBES.items() if set(dims) <= set(cube_dims)]
+        if not cubes:
+            raise ValueError(f"No rollup covers {', '.join(dims)}; available: {', '.join(CUBES)}")
+        if grain not in GRAINS:
+            raise ValueError(f"Unknown grain {grain}; available: {', '.join(GRAINS)}")
+        cube = min(cubes, key=lambda c: len(CUBES[c]))
+        segments = [segment for month, segment in self.state["segments"].items()
+                    if (not start or month >= start[:7]) and (not end or month <= end[:7])]
+        if not end or end[:GRAINS[grain]] >= self.state["open_from"][:GRAINS[grain]]:
+            segments.append(self.state["open"])
+        df = combine([self._load(segment, cube, grain) for segment in segments], CUBES[cube])
+        return df, df['bucket'].to_numpy(dtype=str)
+
+    def query(self, by: List[str], grain: str = 'day', start: Optional[str] = None, end: Optional[str] = None,
+              where: Optional[Dict[str, str]] = None, top: Optional[int] = None) -> pd.DataFrame:
+        """Sum rows and new-user rows over a time range.
+
+        Args:
+            by (List[str]): Dimensions to group by; "bucket" groups by time bucket
+            grain (str): hour, day or month
+            start (Optional[str]): First date/time; buckets containing it are included
+            end (Optional[str]): Last date/time; buckets containing it are included
+            where (Optional[Dict[str, str]]): Exact dimension values to keep
+            top (Optional[int]): Only the top N groups by rows
+
+        Returns:
+            pd.DataFrame: One row per group with rows and new columns, sorted
+            by rows (or by bucket when grouping by bucket only)
+
+        Raises:
+            ValueError: If no rollup covers the requested dimensions
+        """
+        where = where or {}
+        dims = [d for d in by if d != 'bucket']
+        df, buckets = self.table(dims + list(where), grain, start, end)
+        # Buckets are sorted, so the time range is a slice
+        width = GRAINS[grain]
+        lo = np.searchsorted(buckets, start[:width], 'left') if start else 0
+        hi = np.searchsorted(buckets, end[:width], 'right') if end else len(buckets)
+        df = df.iloc[lo:hi]
+        for dim, value in where.items():
+            df = df[df[dim] == value]
+        result = df.groupby(list(by), as_index=False, sort=False)[MEASURES].sum() if by else \
+            pd.DataFrame({m: [int(df[m].sum())] for m in MEASURES})
+        if list(by) == ['bucket']:
+            result = result.sort_values('bucket')
+        else:
+            result = result.sort_values('rows', ascending=False, kind='stable')
+        return result.head(top).reset_index(drop=True) if top else result.reset_index(drop=True)
+
+
+def parse_where(items: List[str]) -> Dict[str, str]:
+    where = {}
+    for item in items:
+        dim, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError(f"Expected DIM=VALUE, got {item}")
+        where[dim] = value
+    return where
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Query or rebuild the detail data rollups")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    top_parser = subparsers.add_parser("top", help="Top values of one or more dimensions")
+    dimensions = sorted({dim for dims in CUBES.values() for dim in dims})
+    top_parser.add_argument("dimensions", nargs="+", help=f"Any of {', '.join(dimensions)}")
+    top_parser.add_argument("-n", type=int, default=10, help="Number of rows to show (default: 10)")
+    series_parser = subparsers.add_parser("series", help="Counts per time bucket")
+    for sub in (top_parser, series_parser):
+        sub.add_argument("--grain", choices=list(GRAINS), default='day')
+        sub.add_argument("--from", dest="since", metavar="TIME", help="First date/time to include")
+        sub.add_argument("--to", metavar="TIME", help="Last date/time to include")
+        sub.add_argument("--where", nargs="+", default=[], metavar="DIM=VALUE", help="Exact dimension values")
+    subparsers.add_parser("update", help="Fold new rows of the data file into the rollups")
+    subparsers.add_parser("rebuild", help="Recompute the rollups from the whole data file")
+    args = parser.parse_args()
+
+    dirname = Path(os.path.dirname(os.path.abspath(__file__)))
+    if args.command in ("update", "rebuild"):
+        update_rollup(dirname / DATA_FILE, dirname / ROLLUP_DIR, args.command == "rebuild")
+        return
+
+    try:
+        rollup = Rollup(dirname / ROLLUP_DIR)
+        by = args.dimensions if args.command == "top" else ['bucket']
+        result = rollup.query(by, args.grain, args.since, args.to, parse_where(args.where),
+                              args.n if args.command == "top" else None)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(result.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""Group detail events into visits.
+
+A session is a run of rows with the same (city, cityId, device) fingerprint
+in which no two consecutive rows are more than SESSION_GAP minutes apart.
+For every session ../data/sessions.csv holds its start and end, event and
+download counts, entry and exit pages, the page path, the downloaded files
+and how many steps of FUNNEL it completed in order (by default: a page
+under /research/, then a file under /static/papers/).
+
+Sessions are found with one sort by (fingerprint, time) and a sweep over
+consecutive rows, so the cost is linear in the rows read apart from the
+sort. Updates are incremental: sessions that ended more than SESSION_GAP
+before the look-back window are final and never recomputed; only the rows
+of the sessions still open are re-read from the tail of the CSV. Final
+sessions are appended as they become final (sorted by start within each
+update); open sessions follow them with open=1 and are rewritten on every
+update.
+
+Usage:
+    python sessions.py summary [--from DATE] [--to DATE] [-n N]
+    python sessions.py update | rebuild
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ga_fetch import LOOKBACK_DAYS, read_last_value
+from storage import file_stamp, find_tail_offset, prefix_digest, prefix_unchanged, read_tail_chunks
+
+# Configuration
+DATA_FILE = '../data/raw_data_detail.csv'
+SESSIONS_FILE = '../data/sessions.csv'
+SESSIONS_STATE = '../data/sessions_state.json'
+SESSION_GAP = int(os.environ.get("GA_SESSION_GAP", "30"))  # minutes
+FUNNEL = [step.split("=", 1) for step in
+          os.environ.get("GA_FUNNEL", "page=/research/,fileName=/static/papers/").split(",") if "=" in step]
+MAX_PATH_STEPS = 50
+CHUNK_ROWS = int(os.environ.get("GA_CHUNK_ROWS", "1000000"))
+STATE_VERSION = 3
+
+FINGERPRINT = ['city', 'cityId', 'device']
+SESSION_COLUMNS = ['start', 'end', *FINGERPRINT, 'newUsers', 'events', 'downloads',
+                   'entry_page', 'exit_page', 'path', 'files', 'funnel', 'open']
+
+
+def to_minutes(times: pd.Series) -> np.ndarray:
+    """Minutes since the epoch of "YYYY-MM-DD HH:MM:SS" strings, parsing each distinct value once."""
+    codes, uniques = pd.factorize(times.to_numpy(dtype=object))
+    parsed = pd.to_datetime(pd.Index(uniques), format='%Y-%m-%d %H:%M:%S')
+    return (parsed.to_numpy(dtype='datetime64[m]').astype(np.int64))[codes]
+
+
+def join_groups(values: np.ndarray, groups: np.ndarray, n_groups: int, sep: str,
+                limit: Optional[int] = None) -> np.ndarray:
+    """Join the values of each group (values sorted by group) into one string per group."""
+    out = np.full(n_groups, "", dtype=object)
+    if len(values) == 0:
+        return out
+    bounds = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1], True])
+    # Most groups hold a single value, which needs no joining
+    single = np.diff(bounds) == 1
+    out[groups[bounds[:-1][single]]] = values[bounds[:-1][single]]
+    for lo, hi in zip(bounds[:-1][~single], bounds[1:][~single]):
+        items = values[lo:hi].tolist()
+        if limit is not None and len(items) > limit:
+            items = items[:limit] + ["..."]
+        out[groups[lo]] = sep.join(items)
+    return out
+
+
+def sessionize(df: pd.DataFrame, gap: int = SESSION_GAP) -> Tuple[pd.DataFrame, np.ndarray]:
+    """Split detail rows into sessions.
+
+    Args:
+        df (pd.DataFrame): Detail rows as strings ("" for not set)
+        gap (int): Longest inactivity within a session, in minutes
+
+    Returns:
+        Tuple[pd.DataFrame, np.ndarray]: One row per session (SESSION_COLUMNS
+            except open, sorted by start), and the session number of every
+            input row
+    """
+    if df.empty:
+        return pd.DataFrame(columns=SESSION_COLUMNS[:-1]), np.empty(0, dtype=np.int64)
+    minutes = to_minutes(df['time'])
+    fingerprint = df.groupby(FINGERPRINT, sort=False).ngroup().to_numpy()
+    # Rows of one fingerprint become contiguous and stay in time order
+    order = np.lexsort((minutes, fingerprint))
+    e = df.iloc[order].reset_index(drop=True)
+    fp, t = fingerprint[order], minutes[order]
+
+    new = np.ones(len(e), dtype=bool)
+    new[1:] = (fp[1:] != fp[:-1]) | (t[1:] - t[:-1] > gap)
+    sid = np.cumsum(new) - 1
+    first = np.flatnonzero(new)
+    last = np.r_[first[1:] - 1, len(e) - 1]
+    n = len(first)
+
+    page = e['page'].to_numpy(dtype=object)
+    file_name = e['fileName'].to_numpy(dtype=object)
+    # Path: pages in order, repeated consecutive pages collapsed
+    step = (page != "") & (new | np.r_[True, page[1:] != page[:-1]])
+    downloads = file_name != ""
+
+    # Funnel: each step must happen at or after the previous one
+    reached = np.zeros(n, dtype=np.int64)
+    since = np.full(n, np.iinfo(np.int64).min)
+    for k, (column, prefix) in enumerate(FUNNEL):
+        match = e[column].str.startswith(prefix).to_numpy(dtype=bool)
+        # Only sessions that completed the previous steps, at or after the last of them
+        candidates = match & (reached[sid] == k) & (t >= since[sid])
+        hit = pd.Series(t[candidates]).groupby(sid[candidates]).min()
+        hit_sessions = hit.index.to_numpy()
+        reached[hit_sessions] += 1
+        since[hit_sessions] = hit.to_numpy()
+
+    sessions = pd.DataFrame({
+        'start': e['time'].to_numpy()[first],
+        'end': e['time'].to_numpy()[last],
+        **{column: e[column].to_numpy()[first] for column in FINGERPRINT},
+        'newUsers': e['newUsers'].to_numpy()[first],
+        'events': last - first + 1,
+        'downloads': np.bincount(sid, weights=downloads, minlength=n).astype(np.int64),
+        'entry_page': page[first],
+        'exit_page': page[last],
+        'path': join_groups(page[step], sid[step], n, " > ", MAX_PATH_STEPS),
+        'files': join_groups(file_name[downloads], sid[downloads], n, " | "),
+        'funnel': reached,
+    })
+    session_of_row = np.empty(len(df), dtype=np.int64)
+    session_of_row[order] = sid
+    by_start = np.argsort(sessions['start'].to_numpy(dtype=str), kind='stable')
+    rank = np.empty(n, dtype=np.int64)
+    rank[by_start] = np.arange(n)
+    return sessions.iloc[by_start].reset_index(drop=True), rank[session_of_row]
+
+
+def read_chunks(csv_path: Path, offset: int, chunk_rows: int = CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """Iterate over the CSV rows from a byte offset in chunks (offset 0 reads everything)."""
+    for chunk in read_tail_chunks(csv_path, offset, chunk_rows=chunk_rows):
+        if 'cityId' not in chunk.columns:
+            chunk['cityId'] = ''
+        yield chunk
+
+
+def drop_finished(rows: pd.DataFrame, finished: Dict[Tuple[str, str, str], str]) -> pd.DataFrame:
+    """Drop re-read rows that belong to sessions already written as final."""
+    if not finished or rows.empty:
+        return rows
+    keys = pd.MultiIndex.from_frame(rows[FINGERPRINT])
+    ends = pd.Series(finished, dtype=object)
+    ends.index = pd.MultiIndex.from_tuples(ends.index, names=FINGERPRINT)
+    end_of_row = ends.reindex(keys).to_numpy(dtype=object)
+    has_end = pd.notna(end_of_row)
+    done = np.zeros(len(rows), dtype=bool)
+    done[has_end] = rows['time'].to_numpy(dtype=object)[has_end] <= end_of_row[has_end]
+    return rows[~done]
+
+
+def load_state(state_path: Path) -> Optional[Dict]:
+    if not state_path.exists():
+        return None
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+        return state if state.get("version") == STATE_VERSION else None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read sessions state {state_path}: {e}")
+        return None
+
+
+def save_state(state_path: Path, state: Dict) -> None:
+    tmp_path = state_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def update_sessions(csv_path: Path, sessions_path: Path, state_path: Path, rebuild: bool = False) -> None:
+    """Sessionize the rows added since the last update.
+
+    Args:
+        csv_path (Path): raw_data_detail.csv, sorted by time
+        sessions_path (Path): sessions.csv, final sessions first, then open ones
+        state_path (Path): Where the re-read part of the CSV starts
+        rebuild (bool): Start over from the whole file
+
+    Note:
+        Errors are logged and not raised, so a failed update never fails
+        the fetch that fed it.
+    """
+    try:
+        if not csv_path.exists():
+            logging.info(f"{csv_path} not found, skipping sessions")
+            return
+        latest_time = read_last_value(csv_path, 'time')
+        if latest_time is None:
+            logging.info("No data to sessionize")
+            return
+
+        stamp = file_stamp(csv_path)
+        state = None if rebuild else load_state(state_path)
+        if state is not None and (not sessions_path.exists() or sessions_path.stat().st_size < state["final_size"]
+                                  or not prefix_unchanged(csv_path, state["resume_offset"], state["resume_digest"],
+                                                          state["resume_time"], state["csv_stamp"])):
+            logging.info("Data file changed before the sessionized part, rebuilding sessions")
+            state = None
+        finished = {tuple(key): end for *key, end in state["finished"]} if state else {}
+
+        # Sessions ending this long before the look-back window cannot change
+        latest = datetime.strptime(latest_time[:10], '%Y-%m-%d')
+        open_from = latest - timedelta(days=LOOKBACK_DAYS)
+        final_before = str(open_from - timedelta(minutes=SESSION_GAP))
+
+        final_parts = []
+        carry = pd.DataFrame()
+        chunks = read_chunks(csv_path, state["resume_offset"] if state else 0)
+        chunk = next(chunks, None)
+        n_rows = 0
+        while chunk is not None:
+            following = next(chunks, None)
+            n_rows += len(chunk)
+            rows = drop_finished(pd.concat([carry, chunk], ignore_index=True) if not carry.empty else chunk,
+                                 finished)
+            # Rows after this chunk are not older than its last row
+            cutoff = final_before if following is None else min(
+                final_before, str(datetime.strptime(chunk['time'].iloc[-1], '%Y-%m-%d %H:%M:%S')
+                                  - timedelta(minutes=SESSION_GAP)))
+            sessions, session_of_row = sessionize(rows)
+            is_final = (sessions['end'] < cutoff).to_numpy(dtype=bool)
+            final_parts.append(sessions[is_final])
+            carry = rows[~is_final[session_of_row]]
+            chunk = following
+        open_sessions = sessionize(carry)[0] if not carry.empty else pd.DataFrame(columns=SESSION_COLUMNS[:-1])
+        final = pd.concat(final_parts, ignore_index=True) if final_parts else open_sessions.iloc[:0]
+
+        # Rewrite the open part of the sessions file
+        final_size = state["final_size"] if state else 0
+        with open(sessions_path, "r+b" if state else "wb") as f:
+            f.seek(final_size)
+            f.truncate()
+            if not state:
+                f.write((",".join(SESSION_COLUMNS) + "\n").encode("utf-8"))
+            f.write(final.assign(open=0).to_csv(index=False, header=False, lineterminator="\n").encode("utf-8"))
+            final_size = f.tell()
+            f.write(open_sessions.assign(open=1).to_csv(index=False, header=False, lineterminator="\n")
+                    .encode("utf-8"))
+
+        # The next update re-reads from the start of the oldest open session
+        resume_time = min(open_sessions['start'].min(), str(open_from)) if not open_sessions.empty \
+            else str(open_from)
+        finished.update({tuple(key): end for *key, end in
+                         final.loc[final['end'] >= resume_time, [*FINGERPRINT, 'end']].itertuples(index=False)})
+        resume_offset = find_tail_offset(csv_path, resume_time)
+        save_state(state_path, {
+            "version": STATE_VERSION,
+            "gap": SESSION_GAP,
+            "resume_time": resume_time,
+            "resume_offset": resume_offset,
+            "resume_digest": prefix_digest(csv_path, resume_offset,
+                                           (state["resume_offset"], state["resume_digest"]) if state else None),
+            "csv_stamp": stamp,
+            "final_size": final_size,
+            "finished": [[*key, end] for key, end in finished.items() if end >= resume_time],
+        })
+        logging.info(f"Sessionized {n_rows} rows: {len(final)} final and {len(open_sessions)} open sessions")
+
+    except Exception as e:
+        logging.error(f"Failed to update sessions: {e}")
+
+
+def summarize(sessions: pd.DataFrame, top: int) -> str:
+    """Visit counts, top entry/exit pages and paths, and the funnel conversion."""
+    lines = [f"{len(sessions)} sessions, {sessions['events'].sum()} events, "
+             f"{(sessions['events'] == 1).mean():.1%} single-event, "
+             f"{(sessions['downloads'] > 0).mean():.1%} with downloads"]
+    for column, title in [('entry_page', 'Entry pages'), ('exit_page', 'Exit pages'), ('path', 'Paths')]:
+        counts = sessions.loc[sessions[column] != "", column].value_counts().head(top)
+        lines += ["", title] + [f"{count:>8}  {value}" for value, count in counts.items()]
+    lines += ["", "Funnel"]
+    for k, (column, prefix) in enumerate(FUNNEL, start=1):
+        reached = int((sessions['funnel'] >= k).sum())
+        share = reached / len(sessions) if len(sessions) else 0.0
+        lines.append(f"{reached:>8}  {k}. {column} starts with {prefix} ({share:.1%} of sessions)")
+    return "\n".join(lines)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Sessionize detail events and summarise visits")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary", help="Summarise the stored sessions")
+    summary_parser.add_argument("--from", dest="since", metavar="DATE", help="First session start to include")
+    summary_parser.add_argument("--to", metavar="DATE", help="Last session start to include (a date includes the day)")
+    summary_parser.add_argument("-n", type=int, default=10, help="Rows per table (default: 10)")
+    subparsers.add_parser("update", help="Sessionize the rows added since the last update")
+    subparsers.add_parser("rebuild", help="Sessionize the whole data file again")
+    args = parser.parse_args()
+
+    dirname = Path(os.path.dirname(os.path.abspath(__file__)))
+    sessions_path = dirname / SESSIONS_FILE
+    if args.command in ("update", "rebuild"):
+        update_sessions(dirname / DATA_FILE, sessions_path, dirname / SESSIONS_STATE, args.command == "rebuild")
+        return
+    if not sessions_path.exists():
+        print(f"Error: {sessions_path} not found, run: python sessions.py rebuild", file=sys.stderr)
+        sys.exit(1)
+
+    sessions = pd.read_csv(sessions_path, dtype=str, keep_default_na=False)
+    sessions[['events', 'downloads', 'funnel']] = sessions[['events', 'downloads', 'funnel']].astype(int)
+    if args.since:
+        sessions = sessions[sessions['start'] >= args.since]
+    if args.to:
+        sessions = sessions[sessions['start'].str.slice(0, len(args.to)) <= args.to]
+    print(summarize(sessions, args.n))
+
+
+if __name__ == "__main__":
+    main()
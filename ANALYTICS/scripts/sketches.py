@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""Bounded-memory sketches of the high-cardinality detail dimensions.
+
+page (pagePathPlusQueryString) and linkUrl carry query strings and outbound
+links, so exact counts over them grow with the history. Two sketches are
+kept instead, in ../data/sketches.npz:
+
+* Space-Saving heavy hitters for page, fileName and linkUrl. With K
+  counters and N counted rows, every reported count overestimates the true
+  count by at most its "error" column, which is never more than N / K, and
+  every value occurring more than N / K times is reported.
+
+* HyperLogLog distinct counts of cities (cityId + city) and devices per
+  day. With 2^HLL_PRECISION registers the relative standard error is
+  1.04 / sqrt(2^HLL_PRECISION), 1.6% at the default precision of 12; small
+  counts use linear counting and are close to exact. Daily sketches merge
+  without extra error, so a range has the same error bound as a single day.
+
+details.py feeds the sketches with the rows each merge adds, i.e. the
+processed report rows that are not stored yet; rows refetched within the
+look-back window are therefore counted once.
+
+Usage:
+    python sketches.py top page|fileName|linkUrl [-n N]
+    python sketches.py distinct city|device [--from DATE] [--to DATE] [--daily]
+    python sketches.py rebuild
+"""
+import argparse
+import heapq
+import json
+import logging
+import os
+import sys
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+# Configuration
+DATA_FILE = '../data/raw_data_detail.csv'
+SKETCH_FILE = '../data/sketches.npz'
+TOPK_COUNTERS = int(os.environ.get("GA_SKETCH_COUNTERS", "1000"))
+HLL_PRECISION = int(os.environ.get("GA_HLL_PRECISION", "12"))
+CHUNK_ROWS = int(os.environ.get("GA_CHUNK_ROWS", "1000000"))
+SKETCH_VERSION = 1
+
+TOPK_COLUMNS = ['page', 'fileName', 'linkUrl']
+# Distinct-count name -> columns that identify a value
+DISTINCT_KEYS = {'city': ['cityId', 'city'], 'device': ['device']}
+
+
+class SpaceSaving:
+    """Weighted Space-Saving top-K counter (Metwally et al., 2005).
+
+    When a new value arrives and all counters are taken, the smallest counter
+    is handed over to it and its count becomes an error bound for the new
+    value.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.total = 0
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+
+    def update(self, values: pd.Series) -> None:
+        """Count a batch of values, most frequent first."""
+        batch = values.value_counts(sort=True)
+        self.total += int(batch.sum())
+        # Lazy min-heap of (count, value); stale entries are skipped on pop
+        heap = [(count, value) for value, count in self.counts.items()]
+        heapq.heapify(heap)
+        for value, weight in batch.items():
+            weight = int(weight)
+            if value in self.counts:
+                self.counts[value] += weight
+                heapq.heappush(heap, (self.counts[value], value))
+                continue
+            if len(self.counts) < self.capacity:
+                self.counts[value], self.errors[value] = weight, 0
+                heapq.heappush(heap, (weight, value))
+                continue
+            while True:
+                count, evicted = heapq.heappop(heap)
+                if self.counts.get(evicted) == count:
+                    break
+            del self.counts[evicted], self.errors[evicted]
+            self.counts[value], self.errors[value] = count + weight, count
+            heapq.heappush(heap, (count + weight, value))
+
+    def top(self, n: Optional[int] = None) -> pd.DataFrame:
+        """Top values with their (over-)estimated count and maximum overestimate."""
+        df = pd.DataFrame({'value': list(self.counts), 'count': list(self.counts.values()),
+                           'error': [self.errors[v] for v in self.counts]}, columns=['value', 'count', 'error'])
+        df = df.sort_values(['count', 'value'], ascending=[False, True]).reset_index(drop=True)
+        return df.head(n) if n else df
+
+    def error_bound(self) -> float:
+        return self.total / self.capacity
+
+
+class HyperLogLog:
+    """HyperLogLog distinct counter (Flajolet et al., 2007) over 64-bit hashes."""
+
+    def __init__(self, precision: int, registers: Optional[np.ndarray] = None):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8) if registers is None else registers
+
+    def add_hashes(self, hashes: np.ndarray) -> None:
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        rest = hashes & np.uint64((1 << (64 - self.precision)) - 1)
+        # Rank = position of the leftmost 1 bit in the remaining 64 - p bits
+        bit_length = np.zeros(len(rest), dtype=np.int64)
+        x = rest.copy()
+        for shift in (32, 16, 8, 4, 2, 1):
+            big = x >= np.uint64(1 << shift)
+            bit_length[big] += shift
+            x[big] >>= np.uint64(shift)
+        bit_length += (x > 0)
+        rank = (64 - self.precision) - bit_length + 1
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        return HyperLogLog(self.precision, np.maximum(self.registers, other.registers))
+
+    def estimate(self) -> float:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            return m * np.log(m / zeros)
+        return float(raw)
+
+    def relative_error(self) -> float:
+        return 1.04 / np.sqrt(len(self.registers))
+
+
+class Sketches:
+    """All sketches of the detail data, loaded from and saved to one file."""
+
+    def __init__(self, capacity: int = TOPK_COUNTERS, precision: int = HLL_PRECISION):
+        self.topk = {column: SpaceSaving(capacity) for column in TOPK_COLUMNS}
+        self.distinct: Dict[str, Dict[str, HyperLogLog]] = {name: {} for name in DISTINCT_KEYS}
+        self.precision = precision
+
+    def update(self, df: pd.DataFrame) -> None:
+        """Add detail rows (as stored, "" for not set); not-set values are skipped."""
+        if df.empty:
+            return
+        for column, sketch in self.topk.items():
+            values = df[column]
+            sketch.update(values[values != ""])
+        days = df['time'].str.slice(0, 10).to_numpy()
+        for name, columns in DISTINCT_KEYS.items():
+            keys = df[columns]
+            keep = (keys != "").any(axis=1).to_numpy()
+            hashes = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+            for day, positions in pd.Series(hashes[keep]).groupby(days[keep]).indices.items():
+                sketch = self.distinct[name].setdefault(day, HyperLogLog(self.precision))
+                sketch.add_hashes(hashes[keep][positions])
+
+    def distinct_count(self, name: str, start: Optional[str] = None, end: Optional[str] = None) -> float:
+        """Estimated number of distinct values over the days in [start, end]."""
+        union = HyperLogLog(self.precision)
+        for day, sketch in self.distinct[name].items():
+            if (not start or day >= start[:10]) and (not end or day <= end[:10]):
+                union = union.merge(sketch)
+        return union.estimate()
+
+    def save(self, path: Path) -> None:
+        meta = {"version": SKETCH_VERSION, "precision": self.precision, "topk": {}}
+        arrays = {}
+        for column, sketch in self.topk.items():
+            meta["topk"][column] = {"capacity": sketch.capacity, "total": sketch.total}
+            arrays[f"topk.{column}.values"] = np.asarray(list(sketch.counts), dtype=str)
+            arrays[f"topk.{column}.counts"] = np.fromiter(sketch.counts.values(), dtype=np.int64,
+                                                          count=len(sketch.counts))
+            arrays[f"topk.{column}.errors"] = np.fromiter((sketch.errors[v] for v in sketch.counts),
+                                                          dtype=np.int64, count=len(sketch.counts))
+        for name, days in self.distinct.items():
+            keys = sorted(days)
+            arrays[f"hll.{name}.days"] = np.asarray(keys, dtype=str)
+            arrays[f"hll.{name}.registers"] = np.stack([days[d].registers for d in keys]) if keys else \
+                np.zeros((0, 1 << self.precision), dtype=np.uint8)
+        arrays["meta"] = np.array(json.dumps(meta))
+        tmp_path = path.with_suffix(".tmp.npz")
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "Sketches":
+        """Load stored sketches, or empty ones if there are none (or they are unreadable)."""
+        if not path.exists():
+            return cls()
+        try:
+            with np.load(path) as data:
+                meta = json.loads(str(data["meta"]))
+                if meta.get("version") != SKETCH_VERSION:
+                    return cls()
+                sketches = cls(precision=meta["precision"])
+                for column, info in meta["topk"].items():
+                    sketch = SpaceSaving(info["capacity"])
+                    sketch.total = info["total"]
+                    values = data[f"topk.{column}.values"].tolist()
+                    sketch.counts = dict(zip(values, data[f"topk.{column}.counts"].tolist()))
+                    sketch.errors = dict(zip(values, data[f"topk.{column}.errors"].tolist()))
+                    sketches.topk[column] = sketch
+                for name in DISTINCT_KEYS:
+                    registers = data[f"hll.{name}.registers"]
+                    sketches.distinct[name] = {
+                        day: HyperLogLog(sketches.precision, registers[i].copy())
+                        for i, day in enumerate(data[f"hll.{name}.days"].tolist())
+                    }
+            return sketches
+        except (OSError, KeyError, ValueError) as e:
+            logging.warning(f"Could not read sketches {path}: {e}")
+            return cls()
+
+
+def update_sketches(rows: pd.DataFrame, sketch_path: Path) -> None:
+    """Add newly stored detail rows to the persisted sketches.
+
+    Args:
+        rows (pd.DataFrame): Rows that were not stored before this run
+        sketch_path (Path): Stored sketches
+
+    Note:
+        Errors are logged and not raised, so a failed update never fails
+        the fetch that fed it.
+    """
+    try:
+        if rows.empty:
+            return
+        sketches = Sketches.load(sketch_path)
+        sketches.update(rows)
+        sketches.save(sketch_path)
+        logging.info(f"Added {len(rows)} rows to the sketches")
+    except Exception as e:
+        logging.error(f"Failed to update sketches: {e}")
+
+
+def rebuild_sketches(csv_path: Path, sketch_path: Path, chunk_rows: int = CHUNK_ROWS) -> None:
+    """Recompute the sketches from the whole data file, in chunks."""
+    sketches = Sketches()
+    columns = sorted(set(TOPK_COLUMNS) | {c for cols in DISTINCT_KEYS.values() for c in cols} | {'time'})
+    for chunk in pd.read_csv(csv_path, dtype=str, keep_default_na=False, usecols=columns, chunksize=chunk_rows):
+        sketches.update(chunk)
+    sketches.save(sketch_path)
+    logging.info(f"Rebuilt sketches from {csv_path}")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Approximate top values and distinct counts of the detail data")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    top_parser = subparsers.add_parser("top", help="Most frequent values (Space-Saving)")
+    top_parser.add_argument("column", choices=TOPK_COLUMNS)
+    top_parser.add_argument("-n", type=int, default=20, help="Number of values to show (default: 20)")
+    distinct_parser = subparsers.add_parser("distinct", help="Distinct values per day or range (HyperLogLog)")
+    distinct_parser.add_argument("name", choices=list(DISTINCT_KEYS))
+    distinct_parser.add_argument("--from", dest="since", metavar="DATE")
+    distinct_parser.add_argument("--to", metavar="DATE")
+    distinct_parser.add_argument("--daily", action="store_true", help="One estimate per day")
+    subparsers.add_parser("rebuild", help="Recompute the sketches from the whole data file")
+    args = parser.parse_args()
+
+    dirname = Path(os.path.dirname(os.path.abspath(__file__)))
+    sketch_path = dirname / SKETCH_FILE
+    if args.command == "rebuild":
+        rebuild_sketches(dirname / DATA_FILE, sketch_path)
+        return
+    if not sketch_path.exists():
+        print(f"Error: {sketch_path} not found, run: python sketches.py rebuild", file=sys.stderr)
+        sys.exit(1)
+
+    sketches = Sketches.load(sketch_path)
+    if args.command == "top":
+        sketch = sketches.topk[args.column]
+        print(sketch.top(args.n).to_string(index=False))
+        print(f"\n{sketch.total} rows counted; counts overestimate by at most the error column "
+              f"(<= {sketch.error_bound():.0f})")
+    else:
+        days = [d for d in sorted(sketches.distinct[args.name])
+                if (not args.since or d >= args.since[:10]) and (not args.to or d <= args.to[:10])]
+        if args.daily:
+            for day in days:
+                print(f"{day}  {sketches.distinct[args.name][day].estimate():.0f}")
+        else:
+            print(f"{sketches.distinct_count(args.name, args.since, args.to):.0f}")
+        error = HyperLogLog(sketches.precision).relative_error()
+        print(f"\n{args.name}: {len(days)} days, relative standard error {error:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,919 @@
+"""Storage backends shared by daily-user.py and details.py.
+
+The default backend is the single CSV file the scripts have always written.
+It is updated in place: a sorted array of row hashes kept next to the CSV
+tells which new rows are already stored, and only the tail of the file from
+the earliest changed row onwards is rewritten. GA_MERGE_MODE=stream instead
+streams the whole file through the merge in GA_CHUNK_ROWS-row chunks, so peak
+memory is bounded by the chunk size rather than by the history length.
+GA_MERGE_MODE=wal appends each run's rows to a write-ahead log instead (see
+wal.py); compaction folds the log in with upsert_csv, journaled so that an
+interrupted rewrite can be rolled back.
+
+Set GA_STORAGE=parquet to keep the data as month-partitioned Parquet files
+instead; only the partitions touched by a run are rewritten, and the CSV is
+still exported for get-data.sh and make-summary.R unless GA_EXPORT_CSV=0.
+
+With GA_DRY_RUN=1 the scripts only report what a merge would change
+(merge_diff) and leave every file as it is.
+"""
+import csv
+import io
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from codec import Codec, CodecError
+
+# Configuration
+STORAGE_BACKEND = os.environ.get("GA_STORAGE", "csv")
+EXPORT_CSV = os.environ.get("GA_EXPORT_CSV", "1") == "1"
+PARTITION_PREFIX = "month="
+PARTITION_FILE = "part-0.parquet"
+HASHES_FILE = "part-0.hashes.npy"
+EXPORT_MANIFEST = "export.json"
+INDEX_SUFFIX = ".index.npz"
+JOURNAL_SUFFIX = ".journal"
+READ_BLOCK_SIZE = 1 << 20
+# Tail rewrites remembered by a row-hash index (see bytes_kept_since)
+REWRITE_HISTORY = 32
+# CSV merge mode: "upsert" (rewrite the changed tail) or "stream" (chunked full pass)
+MERGE_MODE = os.environ.get("GA_MERGE_MODE", "upsert")
+CHUNK_ROWS = int(os.environ.get("GA_CHUNK_ROWS", "500000"))
+# Set GA_DRY_RUN=1 to preview a refresh with merge_diff instead of storing it
+DRY_RUN = os.environ.get("GA_DRY_RUN", "") == "1"
+
+# Row-hash indexes already loaded by this process: index path -> ((CSV size, mtime), hashes)
+_INDEX_CACHE: Dict[Path, Tuple[Tuple[int, int], np.ndarray]] = {}
+
+
+def _require_pyarrow():
+    """Import pyarrow, with a clear message if it is not installed."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError(
+            "Parquet storage requires pyarrow: conda install --name google-analytics pyarrow"
+        ) from e
+    return pa, pq
+
+
+def line_hashes(lines: List[bytes]) -> np.ndarray:
+    """Hash CSV lines (without line terminators) to uint64."""
+    if not lines:
+        return np.empty(0, dtype=np.uint64)
+    return pd.util.hash_array(np.array(lines, dtype=object))
+
+
+def row_hashes(df: pd.DataFrame) -> np.ndarray:
+    """Hash DataFrame rows exactly as they would be written by to_csv."""
+    if df.empty:
+        return np.empty(0, dtype=np.uint64)
+    text = df.to_csv(index=False, header=False, lineterminator="\n")
+    return line_hashes(text.encode("utf-8").split(b"\n")[:-1])
+
+
+def contains_sorted(index: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+    """Vectorized membership test of hashes in a sorted hash array."""
+    if len(index) == 0:
+        return np.zeros(len(hashes), dtype=bool)
+    pos = np.searchsorted(index, hashes)
+    pos[pos == len(index)] = 0
+    return index[pos] == hashes
+
+
+def update_sorted(index: np.ndarray, remove: np.ndarray, add: np.ndarray) -> np.ndarray:
+    """Remove one occurrence of each hash in remove, then insert add, keeping index sorted."""
+    if len(remove):
+        pos = np.searchsorted(index, np.sort(remove))
+        pos = pos[(pos < len(index)) & (index[np.minimum(pos, len(index) - 1)] == np.sort(remove))]
+        index = np.delete(index, pos)
+    if len(add):
+        add = np.sort(add)
+        index = np.insert(index, np.searchsorted(index, add), add)
+    return index
+
+
+def partition_keys(values: pd.Series) -> pd.Series:
+    """Map date ("YYYY-MM-DD") or time ("YYYY-MM-DD HH:MM:SS") strings to month keys."""
+    return values.astype(str).str[:7]
+
+
+def partition_path(dataset_dir: Path, key: str) -> Path:
+    """Path of the Parquet file holding one month partition."""
+    return dataset_dir / f"{PARTITION_PREFIX}{key}" / PARTITION_FILE
+
+
+def list_partitions(dataset_dir: Path) -> List[str]:
+    """List the month keys stored in a dataset, oldest first."""
+    if not dataset_dir.exists():
+        return []
+    return sorted(
+        p.name[len(PARTITION_PREFIX):]
+        for p in dataset_dir.iterdir()
+        if p.is_dir() and p.name.startswith(PARTITION_PREFIX) and (p / PARTITION_FILE).exists()
+    )
+
+
+def read_partition(dataset_dir: Path, key: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Read one month partition, or an empty DataFrame if it does not exist."""
+    _, pq = _require_pyarrow()
+    path = partition_path(dataset_dir, key)
+    if not path.exists():
+        return pd.DataFrame()
+    return pq.read_table(path, columns=columns).to_pandas()
+
+
+def read_partitions(dataset_dir: Path, keys: Optional[List[str]] = None,
+                    columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Read several partitions (all by default) into one time-ordered DataFrame."""
+    keys = list_partitions(dataset_dir) if keys is None else keys
+    frames = [read_partition(dataset_dir, key, columns) for key in keys]
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
+def write_partition(df: pd.DataFrame, dataset_dir: Path, key: str, dtypes: Dict[str, str],
+                    dictionary_columns: List[str]) -> int:
+    """Atomically write one month partition.
+
+    Args:
+        df (pd.DataFrame): Rows of the partition, already sorted
+        dataset_dir (Path): Root directory of the dataset
+        key (str): Month key ("YYYY-MM")
+        dtypes (Dict[str, str]): Column name to "string" or "int64"; fixes the
+            column order and types so nothing is re-inferred on read
+        dictionary_columns (List[str]): Columns stored dictionary-encoded
+
+    Returns:
+        int: Number of bytes written
+    """
+    pa, pq = _require_pyarrow()
+    arrow_types = {"string": pa.string(), "int64": pa.int64()}
+    schema = pa.schema([(name, arrow_types[dtype]) for name, dtype in dtypes.items()])
+
+    df = df[list(dtypes)].copy()
+    for name, dtype in dtypes.items():
+        if dtype == "string":
+            df[name] = df[name].fillna("").astype(str)
+        else:
+            df[name] = pd.to_numeric(df[name]).astype(dtype)
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+    path = partition_path(dataset_dir, key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    pq.write_table(table, tmp_path, use_dictionary=dictionary_columns, compression="zstd")
+    os.replace(tmp_path, path)
+
+    # Sorted row hashes let the next run skip partitions it would not change
+    hashes_path = path.parent / HASHES_FILE
+    with open(hashes_path.with_suffix(".tmp"), "wb") as f:
+        np.save(f, np.sort(row_hashes(df)))
+    os.replace(hashes_path.with_suffix(".tmp"), hashes_path)
+    return path.stat().st_size
+
+
+def save_partitioned(new_df: pd.DataFrame, dataset_dir: Path, time_column: str,
+                     merge_fn: Callable[[pd.DataFrame, pd.DataFrame], pd.DataFrame],
+                     dtypes: Dict[str, str], dictionary_columns: List[str]) -> int:
+    """Merge new rows into the partitions they fall in and rewrite only those.
+
+    Args:
+        new_df (pd.DataFrame): New data from GA
+        dataset_dir (Path): Root directory of the dataset
+        time_column (str): Date/time column used for partitioning
+        merge_fn (Callable): The script's merge_data(new_df, existing_df)
+        dtypes (Dict[str, str]): Column types, see write_partition
+        dictionary_columns (List[str]): Columns stored dictionary-encoded
+
+    Returns:
+        int: Number of rows added across the touched partitions
+    """
+    if new_df.empty:
+        return 0
+
+    keys = partition_keys(new_df[time_column])
+    added = 0
+    for key, part_new in new_df.groupby(keys, sort=True):
+        hashes_path = partition_path(dataset_dir, key).parent / HASHES_FILE
+        if hashes_path.exists():
+            stored = np.load(hashes_path)
+            if contains_sorted(stored, row_hashes(part_new[list(dtypes)])).all():
+                logging.info(f"Partition {key} already up to date")
+                continue
+
+        part_existing = read_partition(dataset_dir, key)
+        merged = merge_fn(part_new, part_existing)
+        write_partition(merged, dataset_dir, key, dtypes, dictionary_columns)
+        added += len(merged) - len(part_existing)
+        logging.info(f"Rewrote partition {key}: {len(merged)} rows")
+    return added
+
+
+def latest_value(dataset_dir: Path, column: str) -> Optional[str]:
+    """Largest value of column in the newest partition, or None if the dataset is empty."""
+    keys = list_partitions(dataset_dir)
+    if not keys:
+        return None
+    df = read_partition(dataset_dir, keys[-1], columns=[column])
+    if df.empty:
+        return None
+    return str(df[column].max())
+
+
+def load_export_manifest(dataset_dir: Path, csv_path: Path) -> Optional[Dict]:
+    """What the last export_csv wrote, or None if csv_path changed since then."""
+    manifest_path = dataset_dir / EXPORT_MANIFEST
+    if not manifest_path.exists() or not csv_path.exists():
+        return None
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read {manifest_path}: {e}")
+        return None
+    if manifest.get("csv") != csv_path.name or tuple(manifest.get("stamp", ())) != file_stamp(csv_path):
+        return None
+    return manifest
+
+
+def export_csv(dataset_dir: Path, csv_path: Path, since: Optional[str] = None) -> None:
+    """Write the dataset as one CSV, one partition at a time.
+
+    The output is the same file merge_and_save_data would write with the CSV
+    backend, so get-data.sh, make-summary.R and the archive keep working.
+
+    Every export records in the dataset's export manifest the stamp (size,
+    mtime) of each partition file it wrote, the byte offset where that
+    partition's rows end in the CSV, and the stamp of the CSV itself. With
+    since (a month key, the first partition a run may have changed), only
+    the CSV rows from that month on are rewritten, in place. That is done
+    only if the CSV and all earlier partitions are still as the manifest
+    says; otherwise, e.g. after runs with GA_EXPORT_CSV=0, the whole file
+    is written again.
+    """
+    csv_path = csv_path.resolve()
+    keys = list_partitions(dataset_dir)
+
+    def stamp(key: str) -> List[int]:
+        return list(file_stamp(partition_path(dataset_dir, key)))
+
+    partitions = {}
+    if since is not None:
+        manifest = load_export_manifest(dataset_dir, csv_path)
+        kept = [key for key in keys if key < since]
+        tail_keys = keys[len(kept):]
+        header, first = None, None
+        if manifest is not None and tail_keys:
+            with open(csv_path, "rb") as f:
+                header = f.readline().rstrip(b"\r\n").decode("utf-8")
+            first = read_partition(dataset_dir, tail_keys[0])
+        if (first is not None and header == ",".join(first.columns)
+                and list(manifest["partitions"])[:len(kept)] == kept
+                and all(manifest["partitions"][key]["stamp"] == stamp(key) for key in kept)):
+            partitions = {key: manifest["partitions"][key] for key in kept}
+            with open(csv_path, "r+b") as f:
+                f.seek(partitions[kept[-1]]["end"] if kept else manifest["header_end"])
+                f.truncate()
+                for key in tail_keys:
+                    df = first if key == tail_keys[0] else read_partition(dataset_dir, key)
+                    f.write(df.to_csv(header=False, index=False).encode("utf-8"))
+                    partitions[key] = {"stamp": stamp(key), "end": f.tell()}
+            save_export_manifest(dataset_dir, csv_path, manifest["header_end"], partitions)
+            logging.info(f"Exported partitions {tail_keys[0]} to {tail_keys[-1]} to {csv_path}")
+            return
+        logging.info(f"{csv_path} does not match the partitions before {since}, exporting all of it")
+
+    csv_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = csv_path.with_suffix(".csv.tmp")
+    header_end = 0
+    with open(tmp_path, "wb") as f:
+        for key in keys:
+            df = read_partition(dataset_dir, key)
+            if not header_end:
+                f.write(df.iloc[:0].to_csv(index=False).encode("utf-8"))
+                header_end = f.tell()
+            f.write(df.to_csv(header=False, index=False).encode("utf-8"))
+            partitions[key] = {"stamp": stamp(key), "end": f.tell()}
+    os.replace(tmp_path, csv_path)
+    save_export_manifest(dataset_dir, csv_path, header_end, partitions)
+    logging.info(f"Exported CSV to {csv_path}")
+
+
+def save_export_manifest(dataset_dir: Path, csv_path: Path, header_end: int, partitions: Dict[str, Dict]) -> None:
+    """Record an export; see export_csv."""
+    manifest_path = dataset_dir / EXPORT_MANIFEST
+    manifest = {"csv": csv_path.name, "stamp": list(file_stamp(csv_path)), "header_end": header_end,
+                "partitions": partitions}
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def import_csv(df: pd.DataFrame, dataset_dir: Path, time_column: str, dtypes: Dict[str, str],
+               dictionary_columns: List[str]) -> None:
+    """Write an already-cleaned, sorted CSV history as a fresh partitioned dataset."""
+    if dataset_dir.exists():
+        shutil.rmtree(dataset_dir)
+    for key, part in df.groupby(partition_keys(df[time_column]), sort=True):
+        write_partition(part, dataset_dir, key, dtypes, dictionary_columns)
+    logging.info(f"Imported {len(df)} rows into {dataset_dir}")
+
+
+def _index_path(csv_path: Path) -> Path:
+    return csv_path.with_name(csv_path.stem + INDEX_SUFFIX)
+
+
+def build_csv_index(csv_path: Path) -> np.ndarray:
+    """Hash every data line of a CSV, reading it in blocks."""
+    hashes = []
+    with open(csv_path, "rb") as f:
+        f.readline()
+        rest = b""
+        while True:
+            block = f.read(READ_BLOCK_SIZE)
+            if not block:
+                break
+            lines = (rest + block).split(b"\n")
+            rest = lines.pop()
+            hashes.append(line_hashes([line.rstrip(b"\r") for line in lines]))
+        if rest.strip():
+            hashes.append(line_hashes([rest.rstrip(b"\r")]))
+    index = np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)
+    return np.sort(index)
+
+
+def file_stamp(csv_path: Path) -> Tuple[int, int]:
+    """Size and modification time (ns) of a file; any rewrite changes one of them."""
+    st = csv_path.stat()
+    return st.st_size, st.st_mtime_ns
+
+
+def load_csv_index(csv_path: Path) -> np.ndarray:
+    """Load the persisted row-hash index of a CSV, rebuilding it if it is stale.
+
+    An index is stale unless the CSV still has the size and modification
+    time it was saved with, so a same-size edit of the file is noticed too.
+    Indexes are also kept in memory for the life of the process, so a
+    long-running process (see daemon.py) only reads each one once.
+    """
+    index_path = _index_path(csv_path)
+    stamp = file_stamp(csv_path)
+    cached = _INDEX_CACHE.get(index_path.resolve())
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    if index_path.exists():
+        try:
+            with np.load(index_path) as data:
+                if (int(data["size"]), int(data["mtime_ns"])) == stamp:
+                    index = data["hashes"]
+                    _INDEX_CACHE[index_path.resolve()] = (stamp, index)
+                    return index
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Could not read index {index_path}: {e}")
+
+    logging.info(f"Building row index for {csv_path}")
+    index = build_csv_index(csv_path)
+    save_csv_index(csv_path, index)
+    return index
+
+
+def save_csv_index(csv_path: Path, index: np.ndarray,
+                   rewrite: Optional[Tuple[Tuple[int, int], int]] = None) -> None:
+    """Persist the row-hash index together with the CSV size and mtime it describes.
+
+    rewrite=(stamp, offset) records that the CSV was made from the version
+    with that stamp by rewriting it from offset onwards. The index keeps the
+    last REWRITE_HISTORY such rewrites, as long as they follow each other.
+    """
+    index_path = _index_path(csv_path)
+    stamp = file_stamp(csv_path)
+    history = np.empty((0, 3), dtype=np.int64)
+    if rewrite is not None:
+        previous_stamp, offset = rewrite
+        if index_path.exists():
+            try:
+                with np.load(index_path) as data:
+                    if (int(data["size"]), int(data["mtime_ns"])) == tuple(previous_stamp) and "history" in data:
+                        history = data["history"]
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Could not read index {index_path}: {e}")
+        history = np.vstack([history, [[*previous_stamp, offset]]])[-REWRITE_HISTORY:]
+    tmp_path = index_path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(f, hashes=index, size=np.int64(stamp[0]), mtime_ns=np.int64(stamp[1]), history=history)
+    os.replace(tmp_path, index_path)
+    _INDEX_CACHE[index_path.resolve()] = (stamp, index)
+
+
+def bytes_kept_since(csv_path: Path, stamp: Tuple[int, int]) -> int:
+    """How many leading bytes of a CSV are unchanged since it had the given stamp.
+
+    Answered from the rewrites recorded in the row-hash index, without reading
+    the CSV. Returns 0 when the index cannot tell, e.g. because the file was
+    written by something else or replaced as a whole.
+    """
+    current = file_stamp(csv_path)
+    if tuple(stamp) == current:
+        return current[0]
+    index_path = _index_path(csv_path)
+    try:
+        with np.load(index_path) as data:
+            if (int(data["size"]), int(data["mtime_ns"])) != current or "history" not in data:
+                return 0
+            history = data["history"]
+    except (OSError, ValueError, KeyError):
+        return 0
+    kept = current[0]
+    for size, mtime_ns, offset in history[::-1]:
+        kept = min(kept, int(offset))
+        if (int(size), int(mtime_ns)) == tuple(stamp):
+            return kept
+    return 0
+
+
+def find_tail_offset(csv_path: Path, start: str) -> int:
+    """Byte offset of the first data line whose first field is >= start.
+
+    The file is sorted on its first column (date or time), so scan backwards
+    from the end and stop at the first line that sorts before start.
+    """
+    start_bytes = start.encode("utf-8")
+    with open(csv_path, "rb") as f:
+        f.readline()
+        header_end = f.tell()
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        pos = end
+        carry = b""
+        while pos > header_end:
+            step = min(READ_BLOCK_SIZE, pos - header_end)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + carry).split(b"\n")
+
+            # lines[0] may be cut off unless the block starts right after the header
+            first = 0 if pos == header_end else 1
+            starts = np.cumsum([0] + [len(line) + 1 for line in lines[:-1]])
+            for i in range(len(lines) - 1, first - 1, -1):
+                line = lines[i]
+                if line.strip() and line.split(b",", 1)[0].strip(b'"') < start_bytes:
+                    return min(pos + int(starts[i]) + len(line) + 1, end)
+            carry = lines[0] if first else b""
+    return header_end
+
+
+def prefix_digest(csv_path: Path, offset: int, since: Optional[Tuple[int, str]] = None) -> str:
+    """Hash of the data lines before offset: the sum of their line hashes.
+
+    A sum can be extended, so given since=(earlier offset, its digest) only
+    the lines between the two offsets are read.
+    """
+    total = 0
+    with open(csv_path, "rb") as f:
+        f.readline()
+        pos = f.tell()
+        if since is not None and pos <= since[0] <= offset:
+            pos, total = since[0], int(since[1], 16)
+        f.seek(pos)
+        remaining = offset - pos
+        rest = b""
+        while remaining > 0:
+            block = f.read(min(READ_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            lines = (rest + block).split(b"\n")
+            rest = lines.pop()
+            hashes = line_hashes([line.rstrip(b"\r") for line in lines if line.strip()])
+            total = (total + int(hashes.sum(dtype=np.uint64))) % (1 << 64)
+        if rest.strip():
+            total = (total + int(line_hashes([rest.rstrip(b"\r")])[0])) % (1 << 64)
+    return f"{total:016x}"
+
+
+def prefix_unchanged(csv_path: Path, offset: int, digest: str, start: str,
+                     stamp: Optional[Tuple[int, int]] = None) -> bool:
+    """Check that the part of a sorted CSV before offset was left alone.
+
+    Used by the incremental summaries, which remember where the rows before
+    start ended (offset), a digest of everything up to there and the CSV's
+    stamp (size, mtime) at the time. If the row-hash index vouches that
+    every rewrite since then started at or after offset, nothing is read;
+    otherwise the digest is recomputed over the whole prefix, so any edit
+    of older rows is caught. A row inserted just before start moves the
+    offset.
+    """
+    if csv_path.stat().st_size < offset:
+        return False
+    if stamp is None or bytes_kept_since(csv_path, stamp) < offset:
+        logging.info(f"Checking the first {offset} bytes of {csv_path}")
+        if prefix_digest(csv_path, offset) != digest:
+            return False
+    return find_tail_offset(csv_path, start) == offset
+
+
+def read_tail_chunks(csv_path: Path, offset: int, usecols: Optional[List[str]] = None,
+                     chunk_rows: int = CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """Stream the CSV rows from a byte offset onwards, as chunks of strings.
+
+    The rows are parsed straight from offset (0 reads everything), so memory
+    is bounded by chunk_rows however long the tail is.
+    """
+    with open(csv_path, "rb") as f:
+        header = next(csv.reader([f.readline().decode("utf-8")]), [])
+        f.seek(max(offset, f.tell()))
+        yield from pd.read_csv(f, header=None, names=header, usecols=usecols, dtype=str,
+                               keep_default_na=False, chunksize=chunk_rows)
+
+
+def unseen_rows(new_df: pd.DataFrame, csv_path: Path, dataset_dir: Optional[Path] = None,
+                pending: Optional[np.ndarray] = None) -> pd.DataFrame:
+    """Distinct rows of new_df whose exact line is not stored yet.
+
+    Rows are looked up in the CSV's hash index, or in the per-partition
+    hashes when dataset_dir (a Parquet dataset) is given. pending holds the
+    sorted line hashes of rows written but not merged yet (the write-ahead
+    log); those count as stored.
+    """
+    new_df = new_df.drop_duplicates()
+    hashes = row_hashes(new_df)
+    if pending is not None and len(pending):
+        logged = contains_sorted(pending, hashes)
+        new_df, hashes = new_df[~logged], hashes[~logged]
+    if dataset_dir is not None:
+        stored = np.zeros(len(new_df), dtype=bool)
+        keys = partition_keys(new_df.iloc[:, 0]).to_numpy()
+        for key in np.unique(keys):
+            hashes_path = partition_path(dataset_dir, key).parent / HASHES_FILE
+            if hashes_path.exists():
+                in_key = keys == key
+                stored[in_key] = contains_sorted(np.load(hashes_path), hashes[in_key])
+        return new_df[~stored]
+    if not csv_path.exists():
+        return new_df
+    return new_df[~contains_sorted(load_csv_index(csv_path), hashes)]
+
+
+def _journal_path(csv_path: Path) -> Path:
+    return csv_path.with_name(csv_path.name + JOURNAL_SUFFIX)
+
+
+def recover_csv(csv_path: Path) -> bool:
+    """Undo a tail rewrite that was interrupted, using its journal.
+
+    The journal holds the offset and the old tail of the file; writing them
+    back restores the file as it was before the rewrite started.
+
+    Returns:
+        bool: Whether a rewrite was rolled back
+    """
+    journal_path = _journal_path(csv_path)
+    if not journal_path.exists():
+        return False
+    with open(journal_path, "rb") as f:
+        offset = int(f.readline())
+        tail_bytes = f.read()
+    with open(csv_path, "r+b") as f:
+        f.seek(offset)
+        f.truncate()
+        f.write(tail_bytes)
+        f.flush()
+        os.fsync(f.fileno())
+    journal_path.unlink()
+    _INDEX_CACHE.pop(_index_path(csv_path).resolve(), None)
+    logging.warning(f"Rolled back an interrupted rewrite of {csv_path} at offset {offset}")
+    return True
+
+
+def upsert_csv(new_df: pd.DataFrame, csv_path: Path, time_column: str,
+               merge_fn: Callable[[pd.DataFrame, pd.DataFrame], pd.DataFrame],
+               journal: bool = False, codec: Optional[Codec] = None) -> Optional[int]:
+    """Upsert new rows into a sorted CSV, rewriting only the changed tail.
+
+    Rows whose exact CSV line is already stored are dropped using the hash
+    index. The file is then truncated at the first row at or after the
+    earliest remaining new row, and that tail is merged with merge_fn and
+    appended back, so the file stays sorted without a global sort. With a
+    codec, the tail and the new rows are merged encoded (see codec.py),
+    unless they hold values it cannot encode.
+
+    Args:
+        new_df (pd.DataFrame): New data, already cleaned by merge_fn
+        csv_path (Path): Existing CSV file, sorted by its first column
+        time_column (str): Date/time column, which must be the first column
+        merge_fn (Callable): The script's merge_data(new_df, existing_df)
+        journal (bool): Keep the old tail in a journal, synced to disk, until
+            the new tail is; recover_csv then undoes an interrupted rewrite
+        codec (Optional[Codec]): Encoding of the rows for merge_fn
+
+    Returns:
+        Optional[int]: Number of rows added, or None if the file layout does
+            not match new_df and the caller must fall back to a full merge
+    """
+    with open(csv_path, "rb") as f:
+        header = f.readline().rstrip(b"\r\n").decode("utf-8")
+    columns = header.split(",")
+    if columns != list(new_df.columns) or columns[0] != time_column:
+        return None
+
+    index = load_csv_index(csv_path)
+    changed = new_df[~contains_sorted(index, row_hashes(new_df))]
+    if changed.empty:
+        logging.info("All new rows are already stored")
+        return 0
+
+    start = str(changed[time_column].min())
+    offset = find_tail_offset(csv_path, start)
+    with open(csv_path, "rb") as f:
+        f.seek(offset)
+        tail_bytes = f.read()
+    tail_lines = [line.rstrip(b"\r") for line in tail_bytes.split(b"\n") if line.strip()]
+
+    text = None
+    if codec is not None:
+        try:
+            tail_df = codec.encode(_lines_frame(tail_lines, columns))
+            merged_tail = merge_fn(codec.encode(new_df[new_df[time_column] >= start]), tail_df)
+            text = codec.to_csv(merged_tail).encode("utf-8")
+        except CodecError as e:
+            logging.warning(f"Merging the tail of {csv_path} as strings: {e}")
+    if text is None:
+        if tail_lines:
+            tail_df = pd.read_csv(io.BytesIO(b"\n".join(tail_lines)), names=columns, header=None)
+        else:
+            tail_df = pd.DataFrame(columns=columns)
+        merged_tail = merge_fn(new_df[new_df[time_column] >= start], tail_df)
+        text = merged_tail.to_csv(index=False, header=False, lineterminator="\n").encode("utf-8")
+
+    if journal:
+        journal_path = _journal_path(csv_path)
+        tmp_path = journal_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(f"{offset}\n".encode("ascii") + tail_bytes)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, journal_path)
+
+    # Replace the tail in place; everything before offset is left untouched
+    previous_stamp = file_stamp(csv_path)
+    with open(csv_path, "r+b") as f:
+        f.seek(offset)
+        f.truncate()
+        f.write(text)
+        if journal:
+            f.flush()
+            os.fsync(f.fileno())
+    if journal:
+        journal_path.unlink()
+
+    index = update_sorted(index, line_hashes(tail_lines), line_hashes(text.split(b"\n")[:-1]))
+    save_csv_index(csv_path, index, rewrite=(previous_stamp, offset))
+    if codec is not None:
+        codec.save()
+    logging.info(f"Rewrote {len(merged_tail)} tail rows from {start}")
+    return len(merged_tail) - len(tail_df)
+
+
+def stream_merge_csv(new_df: pd.DataFrame, csv_path: Path, time_column: str,
+                     merge_fn: Callable[[pd.DataFrame, pd.DataFrame], pd.DataFrame],
+                     chunk_rows: int = CHUNK_ROWS, codec: Optional[Codec] = None) -> Optional[int]:
+    """Merge new rows into a sorted CSV with bounded memory.
+
+    The existing file is read in time-ordered chunks and merge-joined against
+    the sorted new rows. Rows sharing the last timestamp of a chunk are held
+    back until the next chunk, so every duplicate group is merged together.
+    Output goes to a temporary file that atomically replaces the original.
+    With a codec, the chunks and the new rows are merged encoded (see
+    codec.py); if a value cannot be encoded, the pass starts over with
+    strings.
+
+    Args:
+        new_df (pd.DataFrame): New data, sorted by time_column
+        csv_path (Path): Existing CSV file, sorted by time_column
+        time_column (str): Date/time column, which must be the first column
+        merge_fn (Callable): The script's merge_data(new_df, existing_df)
+        chunk_rows (int): Rows of the existing file held in memory at a time
+        codec (Optional[Codec]): Encoding of the rows for merge_fn
+
+    Returns:
+        Optional[int]: Number of rows added, or None if the file layout does
+            not match new_df and the caller must fall back to a full merge
+    """
+    with open(csv_path, "rb") as f:
+        header = f.readline().rstrip(b"\r\n").decode("utf-8")
+    columns = header.split(",")
+    if columns != list(new_df.columns) or columns[0] != time_column:
+        return None
+
+    if codec is not None:
+        try:
+            return _stream_merge(new_df, csv_path, header, time_column, merge_fn, chunk_rows, codec)
+        except CodecError as e:
+            logging.warning(f"Streaming {csv_path} as strings: {e}")
+    return _stream_merge(new_df, csv_path, header, time_column, merge_fn, chunk_rows)
+
+
+def _stream_merge(new_df: pd.DataFrame, csv_path: Path, header: str, time_column: str,
+                  merge_fn: Callable[[pd.DataFrame, pd.DataFrame], pd.DataFrame],
+                  chunk_rows: int, codec: Optional[Codec] = None) -> int:
+    """The pass of stream_merge_csv; the original file is only replaced once it completes."""
+    if codec is not None:
+        new_df = codec.encode(new_df)
+    new_df = new_df.sort_values(time_column, kind="stable")
+    # Encoded times are integers, which sort like the strings they stand for
+    new_times = new_df[time_column].to_numpy() if codec is not None else new_df[time_column].astype(str).to_numpy()
+    new_pos = 0
+    rows_in = 0
+    rows_out = 0
+    hashes = []
+
+    tmp_path = csv_path.with_suffix(".csv.tmp")
+    with open(tmp_path, "w", newline="") as out:
+        out.write(header + "\n")
+
+        def emit(new_part: pd.DataFrame, existing_part: pd.DataFrame) -> None:
+            nonlocal rows_out
+            if new_part.empty and existing_part.empty:
+                return
+            merged = merge_fn(new_part, existing_part)
+            if codec is not None:
+                text = codec.to_csv(merged)
+            else:
+                text = merged.to_csv(index=False, header=False, lineterminator="\n")
+            out.write(text)
+            hashes.append(line_hashes(text.encode("utf-8").split(b"\n")[:-1]))
+            rows_out += len(merged)
+
+        carry = pd.DataFrame()
+        if codec is not None:
+            chunks = (codec.encode(chunk) for chunk in pd.read_csv(csv_path, chunksize=chunk_rows, dtype=str,
+                                                                  keep_default_na=False))
+        else:
+            chunks = pd.read_csv(csv_path, chunksize=chunk_rows)
+        for chunk in chunks:
+            rows_in += len(chunk)
+            combined = pd.concat([carry, chunk], ignore_index=True) if not carry.empty else chunk
+            times = combined[time_column] if codec is not None else combined[time_column].astype(str)
+            boundary = times.iloc[-1]
+            ready = combined[times < boundary]
+            carry = combined[times == boundary]
+
+            # New rows strictly before the boundary can be merged now
+            end = int(np.searchsorted(new_times, boundary, side="left"))
+            emit(new_df.iloc[new_pos:end], ready)
+            new_pos = max(new_pos, end)
+
+        emit(new_df.iloc[new_pos:], carry)
+
+    os.replace(tmp_path, csv_path)
+    index = np.sort(np.concatenate(hashes)) if hashes else np.empty(0, dtype=np.uint64)
+    save_csv_index(csv_path, index)
+    if codec is not None:
+        codec.save()
+    logging.info(f"Streamed {rows_in} existing rows in chunks of {chunk_rows}")
+    return rows_out - rows_in
+
+
+def _key_hashes(lines: List[bytes], columns: List[str], key_columns: Optional[List[str]]) -> np.ndarray:
+    """Hash the key fields of CSV lines; the whole line when key_columns is None."""
+    if key_columns is None or not lines:
+        return line_hashes(lines)
+    keys = pd.read_csv(io.BytesIO(b"\n".join(lines)), names=columns, header=None, usecols=key_columns,
+                       dtype=str, keep_default_na=False)
+    text = keys[key_columns].to_csv(index=False, header=False, lineterminator="\n")
+    return line_hashes(text.encode("utf-8").split(b"\n")[:-1])
+
+
+def _lines_frame(lines: List[bytes], columns: List[str]) -> pd.DataFrame:
+    if not lines:
+        return pd.DataFrame(columns=columns)
+    return pd.read_csv(io.BytesIO(b"\n".join(lines)), names=columns, header=None,
+                       dtype=str, keep_default_na=False)
+
+
+def merge_diff(new_df: pd.DataFrame, csv_path: Path, time_column: str,
+               key_columns: Optional[List[str]] = None, dataset_dir: Optional[Path] = None,
+               examples: int = 5) -> Optional[Dict]:
+    """Work out what merging new_df would change, without building the merged table.
+
+    Every key the merge could touch starts at or after the earliest new row,
+    so only that tail of the sorted store is read, as raw lines. Rows are
+    compared through hashes of their key fields and of their whole CSV line,
+    following the merge rules: a key keeps its last new row, and stored rows
+    sharing a key with it are replaced. Stored rows outside the tail are not
+    read; their number comes from the row-hash index (or the per-partition
+    hashes when dataset_dir, a Parquet dataset, is given).
+
+    Args:
+        new_df (pd.DataFrame): New data, already cleaned like the stored rows
+        csv_path (Path): Stored CSV file, sorted by time_column
+        time_column (str): Date/time column, which must be the first column
+        key_columns (Optional[List[str]]): Columns identifying a row; None means whole rows
+        dataset_dir (Optional[Path]): Parquet dataset to compare against instead of the CSV
+        examples (int): Number of added and replaced rows to include
+
+    Returns:
+        Optional[Dict]: Counts of new, duplicate, added, replaced, unchanged
+            and dropped rows, the stored and resulting row counts, and example
+            rows, or None if the stored layout does not match new_df
+    """
+    columns = list(new_df.columns)
+    new_lines = new_df.to_csv(index=False, header=False, lineterminator="\n").encode("utf-8").split(b"\n")[:-1]
+    start = str(new_df[time_column].min()) if len(new_df) else None
+
+    # Stored rows from the earliest new row onwards
+    existing_rows = 0
+    tail_lines = []
+    if dataset_dir is not None:
+        for key in list_partitions(dataset_dir):
+            hashes_path = partition_path(dataset_dir, key).parent / HASHES_FILE
+            if hashes_path.exists():
+                existing_rows += len(np.load(hashes_path, mmap_mode="r"))
+        if start is not None:
+            tail_df = read_partitions(dataset_dir, [k for k in list_partitions(dataset_dir) if k >= start[:7]])
+            if not tail_df.empty:
+                if list(tail_df.columns) != columns:
+                    return None
+                tail_df = tail_df[tail_df[time_column].astype(str) >= start]
+                text = tail_df.to_csv(index=False, header=False, lineterminator="\n")
+                tail_lines = text.encode("utf-8").split(b"\n")[:-1]
+    elif csv_path.exists():
+        with open(csv_path, "rb") as f:
+            header = f.readline().rstrip(b"\r\n").decode("utf-8")
+        if header.split(",") != columns or columns[0] != time_column:
+            return None
+        existing_rows = len(load_csv_index(csv_path))
+        if start is not None:
+            with open(csv_path, "rb") as f:
+                f.seek(find_tail_offset(csv_path, start))
+                tail_lines = [line.rstrip(b"\r") for line in f.read().split(b"\n") if line.strip()]
+
+    new_keys = _key_hashes(new_lines, columns, key_columns)
+    new_hashes = line_hashes(new_lines)
+    stored_keys = _key_hashes(tail_lines, columns, key_columns)
+    stored_hashes = line_hashes(tail_lines)
+
+    # A key keeps its last new row
+    last = ~pd.Series(new_keys).duplicated(keep="last").to_numpy()
+    keys, hashes = new_keys[last], new_hashes[last]
+    stored_counts = pd.Series(stored_keys).value_counts()
+    matches = stored_counts.reindex(keys, fill_value=0).to_numpy()
+    # Equal lines have equal keys, so a stored copy of the row means the key is unchanged
+    same = contains_sorted(np.sort(stored_hashes), hashes) & (matches > 0)
+    added = matches == 0
+    replaced = (matches > 0) & ~same
+    # Extra stored rows per key disappear too, whether or not a new row has that key
+    dropped = int((stored_counts - 1).sum())
+
+    positions = np.flatnonzero(last)
+    replaced_keys = keys[replaced][:examples]
+    return {
+        "start": start,
+        "existing_rows": existing_rows,
+        "window_rows": len(tail_lines),
+        "new_rows": len(new_df),
+        "duplicate_new": int((~last).sum()),
+        "added": int(added.sum()),
+        "replaced": int(replaced.sum()),
+        "unchanged": int(same.sum()),
+        "dropped": dropped,
+        "final_rows": existing_rows + int(added.sum()) - dropped,
+        "examples": {
+            "added": new_df.iloc[positions[added][:examples]],
+            "replaced": new_df.iloc[positions[replaced][:examples]],
+            "replaced_before": _lines_frame(
+                [tail_lines[i] for i in np.flatnonzero(np.isin(stored_keys, replaced_keys))], columns),
+        },
+    }
+
+
+def format_merge_diff(diff: Dict, name: str = "") -> str:
+    """A compact text report of a merge_diff result."""
+    lines = [
+        f"Dry run{' of ' + name if name else ''}: {diff['new_rows']} fetched rows from {diff['start']}, "
+        f"{diff['window_rows']} of {diff['existing_rows']} stored rows in that window",
+        f"  added     {diff['added']:>10}",
+        f"  replaced  {diff['replaced']:>10}",
+        f"  dropped   {diff['dropped']:>10}",
+        f"  unchanged {diff['unchanged']:>10}",
+        f"  duplicate {diff['duplicate_new']:>10}  (repeated keys in the fetched rows)",
+        f"  rows after merge: {diff['existing_rows']} -> {diff['final_rows']}",
+    ]
+    for label in ("added", "replaced", "replaced_before"):
+        sample = diff["examples"][label]
+        if not sample.empty:
+            lines.append(f"\nFirst {label.replace('_', ' ')} rows:")
+            lines.append(sample.to_string(index=False))
+    return "\n".join(lines)
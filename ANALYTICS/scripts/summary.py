@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""Incremental version of make-summary.R.
+
+The summary lists the top 10 (country, city) pairs by activeUsers over all
+past dates and on the latest date, and writes df_past_html.txt,
+df_today_html.txt and df_html.txt next to the data directory, like
+make-summary.R.
+
+Instead of re-reading the whole history, per-(country, city) totals of all
+"closed" dates are persisted in ../data/summary_state.json. Dates within
+LOOKBACK_DAYS of the latest date can still be revised by the next fetch, so
+they stay "open" and are re-read from the tail of raw_data.csv on every run.
+After each run, dates that fell out of the look-back window are folded into
+the totals. A run therefore reads only the last few days of the file.
+
+The state remembers where the closed part of the file ends. If the file was
+rewritten before that point (e.g. after GA_FULL_REFRESH=1), the totals are
+rebuilt from the whole file.
+
+Usage:
+    python summary.py [--rebuild]
+"""
+import argparse
+import html
+import json
+import logging
+import os
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Dict, Optional
+
+import pandas as pd
+
+from ga_fetch import LOOKBACK_DAYS, read_last_value
+from storage import file_stamp, find_tail_offset, prefix_digest, prefix_unchanged, read_tail_chunks
+
+# Configuration
+DATA_FILE = '../data/raw_data.csv'
+SUMMARY_STATE = '../data/summary_state.json'
+SUMMARY_DIR = '..'
+TOP_N = 10
+SUMMARY_COLUMNS = ['date', 'country', 'city', 'activeUsers', 'newUsers']
+COUNTRY_NAMES = {"United States": "U.S."}
+STATE_VERSION = 3
+
+
+def load_state(state_path: Path) -> Optional[Dict]:
+    if not state_path.exists():
+        return None
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+        return state if state.get("version") == STATE_VERSION else None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read summary state {state_path}: {e}")
+        return None
+
+
+def save_state(state_path: Path, state: Dict) -> None:
+    tmp_path = state_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def aggregate(df: pd.DataFrame) -> pd.DataFrame:
+    """Sum activeUsers/newUsers per (country, city)."""
+    return df.groupby(['country', 'city'], as_index=False, sort=False)[['activeUsers', 'newUsers']].sum()
+
+
+def totals_frame(state: Optional[Dict]) -> pd.DataFrame:
+    if not state or not state["totals"]:
+        return pd.DataFrame(columns=['country', 'city', 'activeUsers', 'newUsers'])
+    return pd.DataFrame(state["totals"], columns=['country', 'city', 'activeUsers', 'newUsers'])
+
+
+def top_rows(summary: pd.DataFrame) -> pd.DataFrame:
+    """Top rows by activeUsers, ties in (country, city) order with missing values last."""
+    df = summary.copy()
+    df['country'] = df['country'].replace(COUNTRY_NAMES)
+    # Regroup: renaming can merge two countries into one key
+    df = df.groupby(['country', 'city'], as_index=False, sort=False)[['activeUsers', 'newUsers']].sum()
+    df['country_na'] = df['country'] == ""
+    df['city_na'] = df['city'] == ""
+    df = df.sort_values(['country_na', 'country', 'city_na', 'city']).drop(columns=['country_na', 'city_na'])
+    return df.sort_values('activeUsers', ascending=False, kind='stable').head(TOP_N).reset_index(drop=True)
+
+
+def escape(text: str) -> str:
+    """Escape text like knitr does for HTML tables (&, <, > and double quotes)."""
+    return html.escape(text, quote=False).replace('"', '&quot;')
+
+
+def render_table(df: pd.DataFrame, caption: str, missing: str) -> str:
+    """Render a table the way kable(format = "html") + kable_styling() do."""
+    header_style = "text-align:center;position: sticky; top:0; background-color: #FFFFFF;"
+    lines = ['<table class="table" style="margin-left: auto; margin-right: auto;">',
+             f'<caption>{escape(caption)}</caption>',
+             ' <thead>', '  <tr>']
+    lines += [f'   <th style="{header_style}"> {name} </th>' for name in df.columns]
+    lines += ['  </tr>', ' </thead>', '<tbody>']
+    for row in df.itertuples(index=False):
+        lines.append('  <tr>')
+        for value in row:
+            text = missing if value == "" else str(value)
+            lines.append(f'   <td style="text-align:center;"> {escape(text)} </td>')
+        lines.append('  </tr>')
+    lines += ['</tbody>', '</table>']
+    return "\n".join(lines)
+
+
+def render_page(body: str) -> str:
+    return f'<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8"/>\n</head>\n<body>\n{body}\n</body>\n</html>\n'
+
+
+def write_outputs(past: pd.DataFrame, today: pd.DataFrame, first_date: str, latest_date: str,
+                  output_dir: Path) -> None:
+    """Write df_past_html.txt, df_today_html.txt and df_html.txt."""
+    latest = datetime.strptime(latest_date, '%Y-%m-%d').date()
+    past_table = render_table(past, f"From {first_date} to {latest - timedelta(days=1)}", "NA")
+
+    # Pad today's table with ghost rows so both tables have the same length
+    today = today.astype(object)
+    ghosts = pd.DataFrame([[" '"] + [" ' "] * (len(today.columns) - 1)] * max(0, len(past) - len(today)),
+                          columns=today.columns)
+    today = pd.concat([today, ghosts], ignore_index=True)
+    today_table = render_table(today, f"On {latest_date}", " ' ")
+
+    both = "\n".join([
+        '<table class="kable_wrapper">',
+        f'<caption>Summary: {date.today()}</caption>',
+        '<tbody>', '  <tr>',
+        f'   <td valign="top"> {past_table} </td>',
+        f'   <td valign="top"> {today_table} </td>',
+        '  </tr>', '</tbody>', '</table>',
+    ])
+    for name, body in [("df_past_html.txt", past_table), ("df_today_html.txt", today_table), ("df_html.txt", both)]:
+        with open(output_dir / name, "w") as f:
+            f.write(render_page(body))
+
+
+def update_summary(csv_path: Path, state_path: Path, output_dir: Path, rebuild: bool = False) -> None:
+    """Bring the persisted totals up to date and rewrite the summary tables.
+
+    Args:
+        csv_path (Path): raw_data.csv, sorted by date
+        state_path (Path): Persisted closed-date totals
+        output_dir (Path): Directory for the three HTML text files
+        rebuild (bool): Ignore the persisted totals and start over
+
+    Note:
+        Errors are logged and not raised, so a failed summary never fails
+        the fetch that fed it.
+    """
+    try:
+        if not csv_path.exists():
+            logging.info(f"{csv_path} not found, skipping summary")
+            return
+
+        stamp = file_stamp(csv_path)
+        state = None if rebuild else load_state(state_path)
+        if state is not None and not prefix_unchanged(csv_path, state["closed_offset"], state["closed_digest"],
+                                                      state["open_from"], state["csv_stamp"]):
+            logging.info("Data file changed before the summarised part, rebuilding summary")
+            state = None
+
+        latest_date = read_last_value(csv_path, 'date') or (state["latest_date"] if state else None)
+        if latest_date is None:
+            logging.info("No data to summarise")
+            return
+
+        # Rows of dates that can no longer be revised are folded into the
+        # totals chunk by chunk; only the open dates are kept in memory
+        latest = datetime.strptime(latest_date, '%Y-%m-%d').date()
+        open_from = str(latest - timedelta(days=LOOKBACK_DAYS))
+        closed = totals_frame(state)
+        closed_parts, open_parts = [closed], []
+        first_date = state["first_date"] if state else None
+        n_rows = 0
+        for chunk in read_tail_chunks(csv_path, state["closed_offset"] if state else 0, SUMMARY_COLUMNS):
+            if chunk.empty:
+                continue
+            n_rows += len(chunk)
+            first_date = first_date or str(chunk['date'].iloc[0])
+            chunk = chunk.astype({'activeUsers': 'int64', 'newUsers': 'int64'})
+            folding = chunk['date'] < open_from
+            closed_parts.append(aggregate(chunk.loc[folding, closed.columns]))
+            open_parts.append(chunk[~folding])
+        logging.info(f"Summarising {n_rows} tail rows on top of "
+                     f"{len(state['totals']) if state else 0} stored totals")
+
+        new_closed = aggregate(pd.concat(closed_parts, ignore_index=True))
+        open_df = pd.concat(open_parts, ignore_index=True) if open_parts else pd.DataFrame(columns=SUMMARY_COLUMNS)
+        is_latest = open_df['date'] == latest_date
+        past = aggregate(pd.concat([new_closed, open_df.loc[~is_latest, closed.columns]], ignore_index=True))
+        today = aggregate(open_df.loc[is_latest, closed.columns])
+        write_outputs(top_rows(past), top_rows(today), first_date or latest_date, latest_date, output_dir)
+
+        closed_offset = find_tail_offset(csv_path, open_from)
+        save_state(state_path, {
+            "version": STATE_VERSION,
+            "first_date": first_date,
+            "latest_date": latest_date,
+            "open_from": open_from,
+            "closed_offset": closed_offset,
+            "closed_digest": prefix_digest(csv_path, closed_offset,
+                                           (state["closed_offset"], state["closed_digest"]) if state else None),
+            "csv_stamp": stamp,
+            "totals": [[country, city, int(active), int(new)]
+                       for country, city, active, new in new_closed.itertuples(index=False)],
+        })
+        logging.info(f"Summary tables updated for {latest_date}")
+
+    except Exception as e:
+        logging.error(f"Failed to update summary: {e}")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Update the top-10 city summary tables")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute the totals from the whole file")
+    args = parser.parse_args()
+
+    dirname = Path(os.path.dirname(os.path.abspath(__file__)))
+    update_summary(dirname / DATA_FILE, dirname / SUMMARY_STATE, dirname / SUMMARY_DIR, args.rebuild)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,12 +9,16 @@ import pandas as pd
 import os
 import logging
 from pathlib import Path
-from tqdm import tqdm
 from typing import List, Dict
 from datetime import datetime, timedelta
 import re
 import shutil
 
+from fake_ga import FAKE_GA, FakeAnalyticsClient
+from ga_fetch import fetch_report_frames, response_to_frame
+from response_cache import open_cache
+from storage import format_merge_diff, merge_diff
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -36,10 +40,17 @@ def setup_ga_client(credentials_path: str) -> BetaAnalyticsDataClient:
     Returns:
         BetaAnalyticsDataClient: Initialized GA client
         
+    Note:
+        With GA_FAKE=1 an offline FakeAnalyticsClient is returned instead,
+        configured through the GA_FAKE_* environment variables.
+        
     Raises:
         Exception: If client initialization fails
     """
     try:
+        if FAKE_GA:
+            logging.info("Using the offline fake GA client")
+            return FakeAnalyticsClient.from_env()
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_path
         return BetaAnalyticsDataClient()
     except Exception as e:
@@ -90,14 +101,7 @@ def process_response(response) -> pd.DataFrame:
             - Numeric metrics
             - Properly formatted datetime (YYYYMMDDHHMM format)
     """
-    data = []
-    for row in tqdm(response.rows, desc="Processing rows"):
-        dimension_values = [value.value for value in row.dimension_values]
-        metric_values = [value.value for value in row.metric_values]
-        data.append(dimension_values + metric_values)
-
-    columns = [dim.name for dim in response.dimension_headers] + [metric.name for metric in response.metric_headers]
-    df = pd.DataFrame(data, columns=columns)
+    df = response_to_frame(response)
     
     # Rename columns
     df = df.rename(columns={'pagePathPlusQueryString': 'page',
@@ -134,44 +138,26 @@ def process_response(response) -> pd.DataFrame:
     df = df[['time', 'country', 'city', 'device', 'newUsers', 'page', 'fileName', 'linkUrl']]
     return df
 
-def load_existing_data(file_path: Path) -> pd.DataFrame:
-    """Load existing data from CSV file if it exists."""
-    if file_path.exists():
-        df = pd.read_csv(file_path)
-        # Keep time as string to match archive format - no conversion needed
-        return df
-    return pd.DataFrame()
-
-def merge_and_save_data(new_df: pd.DataFrame, existing_df: pd.DataFrame, output_path: Path) -> None:
-    """Test function to analyze data merging without saving."""
+def preview_merge(new_df: pd.DataFrame, output_path: Path) -> None:
+    """Print what merging new_df into the stored file would change, without saving.
+    
+    The new rows are laid out like the stored file (missing columns are
+    empty, extra ones dropped), as a merge would store them, and compared
+    with merge_diff; the merged table itself is never built.
+    """
     try:
-        if existing_df.empty:
-            final_df = new_df
+        if not output_path.exists():
             print("No existing data found!")
+            columns = list(new_df.columns)
         else:
-            # Combine existing and new data
-            combined_df = pd.concat([existing_df, new_df])
-
-            # Drop activeUsers column if it exists
-            if 'activeUsers' in combined_df.columns:
-                combined_df = combined_df.drop(columns=['activeUsers'])
-
-            # Replace NaN with ""
-            combined_df = combined_df.fillna("")
-
-            # Remove duplicates based on all columns
-            final_df = combined_df.drop_duplicates()
-            
-            # Sort by time
-            final_df = final_df.sort_values('time')
-            
-            print(f"Combined data rows: {len(combined_df)}")
-            print(f"Final data rows: {len(final_df)}")
-            print(f"Number of rows dropped: {len(combined_df) - len(final_df)}")
-            
-        print(f"Final dataset shape: {final_df.shape}")
-        print("\nFirst 5 rows:")
-        print(final_df.head())
+            with open(output_path) as f:
+                columns = f.readline().rstrip("\r\n").split(",")
+        new_df = new_df.reindex(columns=columns, fill_value="")
+        diff = merge_diff(new_df, output_path, 'time')
+        if diff is None:
+            logging.warning("Stored columns differ from the new data; a merge would rewrite the whole file")
+            return
+        print(format_merge_diff(diff, output_path.name))
         
     except Exception as e:
         logging.error(f"Error in test merge: {e}")
@@ -183,17 +169,17 @@ def main():
     
     # Create and execute request
     request = create_report_request(GA_ID)
-    response = client.run_report(request)
-    
-    # Process response
-    new_df = process_response(response)
     
-    # Load existing data and merge
+    # Fetch date shards in parallel and process each page as it arrives;
+    # pages fetched by an earlier dry run are read from the response cache
     dirname = Path(os.path.dirname(os.path.abspath(__file__)))
+    frames = fetch_report_frames(client, request, process_response, cache=open_cache(dirname, serve_open=True))
+    new_df = pd.concat(frames, ignore_index=True).sort_values('time')
+    
+    # Report what a merge would change
     output_path = dirname / OUTPUT_FILE
     
-    existing_df = load_existing_data(output_path)
-    merge_and_save_data(new_df, existing_df, output_path)
+    preview_merge(new_df, output_path)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""Append-only write-ahead log of fetched rows.
+
+With GA_MERGE_MODE=wal, a run does not touch the data file. It appends its
+cleaned rows to a log under ../data/wal/<dataset>/ and is done, at a cost
+proportional to the new rows only. The log is a series of numbered segment
+files. Each record in a segment is one run's rows as CSV text (with a header
+line), framed by a line giving its row count, byte length and CRC-32:
+
+    WAL1 <rows> <bytes> <crc32>\\n<csv text>
+
+Records are synced to disk before the run goes on. A record cut short by a
+crash fails its length or checksum test and is dropped (only the newest
+record can be torn, and it is truncated before the next append). A damaged
+record anywhere else raises LogCorrupted rather than losing rows silently.
+
+Compaction folds the log into the sorted, deduplicated data file with the
+script's own merge_data (on encoded rows if the script has a codec, see
+codec.py), through storage.upsert_csv with a rollback journal, and then
+deletes the folded segments. Folding is idempotent, so a crash at
+any point is repaired by compacting again. It runs automatically once
+GA_WAL_COMPACT_ROWS rows are pending (default 0: in every run),
+and on demand:
+
+    python wal.py status              # pending records and rows per dataset
+    python wal.py compact [--levels daily detail]
+
+The rollups, sessions and summary tables are derived from the data file
+after compaction, so a larger GA_WAL_COMPACT_ROWS defers them along with
+the rewrite. Until then, readers merge the log with the data file: query.py
+and the daemon's tail command show logged rows right away, and read_merged
+returns the merged rows of a time window as a DataFrame. Only the standard library
+is imported unless rows are folded or read as DataFrames.
+"""
+import argparse
+import io
+import logging
+import os
+import zlib
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+
+# Configuration
+WAL_DIR = '../data/wal'
+SEGMENT_BYTES = int(float(os.environ.get("GA_WAL_SEGMENT_MB", "64")) * 1024 * 1024)
+COMPACT_ROWS = int(os.environ.get("GA_WAL_COMPACT_ROWS", "0"))
+SEGMENT_SUFFIX = ".seg"
+MAGIC = b"WAL1"
+
+
+class LogCorrupted(RuntimeError):
+    """A log record other than the newest one failed its checksum."""
+
+
+def _frame(payload: bytes, rows: int) -> bytes:
+    return b"%s %d %d %08x\n" % (MAGIC, rows, len(payload), zlib.crc32(payload)) + payload
+
+
+def _parse(data: bytes, name: str) -> Tuple[List[bytes], int]:
+    """Valid record payloads of a segment, and the byte length they cover."""
+    payloads = []
+    pos = 0
+    while pos < len(data):
+        end = data.find(b"\n", pos)
+        fields = data[pos:end].split(b" ") if end >= 0 else []
+        try:
+            if len(fields) != 4 or fields[0] != MAGIC:
+                raise ValueError("bad record header")
+            length, crc = int(fields[2]), int(fields[3], 16)
+            payload = data[end + 1:end + 1 + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                raise ValueError("length or checksum mismatch")
+        except ValueError as e:
+            logging.warning(f"Log segment {name}: invalid record at byte {pos} ({e})")
+            break
+        payloads.append(payload)
+        pos = end + 1 + length
+    return payloads, pos
+
+
+class WriteAheadLog:
+    """The segments of one dataset's log, oldest first."""
+
+    def __init__(self, directory: Path, segment_bytes: int = SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+
+    def segments(self) -> List[Path]:
+        if not self.directory.exists():
+            return []
+        return sorted(p for p in self.directory.iterdir() if p.name.endswith(SEGMENT_SUFFIX))
+
+    def _segment_path(self, seq: int) -> Path:
+        return self.directory / f"{seq:08d}{SEGMENT_SUFFIX}"
+
+    def _new_segment(self) -> Path:
+        segments = self.segments()
+        seq = int(segments[-1].name[:-len(SEGMENT_SUFFIX)]) + 1 if segments else 1
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._segment_path(seq)
+        path.touch()
+        # Make the new file itself durable
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return path
+
+    def _repair(self) -> Optional[Path]:
+        """Truncate a torn record at the end of the newest segment; return that segment."""
+        segments = self.segments()
+        if not segments:
+            return None
+        path = segments[-1]
+        data = path.read_bytes()
+        _, valid = _parse(data, path.name)
+        if valid < len(data):
+            with open(path, "r+b") as f:
+                f.truncate(valid)
+                os.fsync(f.fileno())
+            logging.warning(f"Truncated a torn record at byte {valid} of {path}")
+        return path
+
+    def payloads(self, segments: Optional[List[Path]] = None) -> Iterator[bytes]:
+        """Yield the CSV text of every valid record, in write order.
+
+        Raises:
+            LogCorrupted: If a record before the newest one is damaged
+        """
+        segments = self.segments() if segments is None else segments
+        last = self.segments()[-1:]
+        for path in segments:
+            data = path.read_bytes()
+            payloads, valid = _parse(data, path.name)
+            if valid < len(data) and [path] != last:
+                raise LogCorrupted(f"Log segment {path} is damaged at byte {valid}")
+            yield from payloads
+
+    def records(self, segments: Optional[List[Path]] = None) -> Iterator[Tuple[str, List[str]]]:
+        """Yield (header, data lines) of every valid record, in write order."""
+        for payload in self.payloads(segments):
+            lines = payload.decode("utf-8").split("\n")[:-1]
+            yield lines[0], lines[1:]
+
+    def lines(self, segments: Optional[List[Path]] = None) -> Tuple[Optional[str], List[str]]:
+        """The header and all logged data lines, in write order."""
+        header, lines = None, []
+        for record_header, record_lines in self.records(segments):
+            header = record_header
+            lines.extend(record_lines)
+        return header, lines
+
+    def pending_rows(self) -> int:
+        return sum(len(lines) for _, lines in self.records())
+
+    def append(self, df) -> int:
+        """Append a DataFrame as one record and sync it to disk.
+
+        Returns:
+            int: Bytes written
+        """
+        payload = df.to_csv(index=False, lineterminator="\n").encode("utf-8")
+        record = _frame(payload, len(df))
+        path = self._repair() or self._new_segment()
+        size = path.stat().st_size
+        if size and size + len(record) > self.segment_bytes:
+            path = self._new_segment()
+        with open(path, "ab") as f:
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        logging.info(f"Logged {len(df)} rows ({len(record)} bytes) to {path}")
+        return len(record)
+
+    def rotate(self) -> List[Path]:
+        """Seal the current segments; later appends go to a new one."""
+        self._repair()
+        segments = self.segments()
+        if segments:
+            self._new_segment()
+        return segments
+
+    def drop(self, segments: List[Path]) -> None:
+        for path in segments:
+            path.unlink(missing_ok=True)
+
+    def frame(self, segments: Optional[List[Path]] = None):
+        """All logged rows as a DataFrame of strings, in write order."""
+        import pandas as pd
+
+        header, lines = self.lines(segments)
+        if header is None:
+            return pd.DataFrame()
+        return pd.read_csv(io.StringIO("\n".join([header] + lines)), dtype=str, keep_default_na=False)
+
+    def row_hashes(self):
+        """Sorted hashes of the logged lines, as storage.line_hashes computes them."""
+        import numpy as np
+        from storage import line_hashes
+
+        _, lines = self.lines()
+        return np.sort(line_hashes([line.encode("utf-8") for line in lines]))
+
+    def latest_value(self) -> Optional[str]:
+        """The largest first field (date or time) among the logged rows."""
+        import csv
+
+        _, lines = self.lines()
+        return max((next(csv.reader([line]))[0] for line in lines), default=None)
+
+
+def compact(csv_path: Path, log: WriteAheadLog, time_column: str,
+            merge_fn: Callable, codec=None) -> int:
+    """Fold the logged rows into the data file and delete the folded segments.
+
+    Args:
+        csv_path (Path): Data file, sorted by time_column
+        log (WriteAheadLog): Log of the same dataset
+        time_column (str): Date/time column, which must be the first column
+        merge_fn (Callable): The script's merge_data(new_df, existing_df)
+        codec (Optional[Codec]): Encoding of the rows for merge_fn, see upsert_csv
+
+    Returns:
+        int: Number of rows the data file grew by
+
+    Raises:
+        RuntimeError: If the logged columns do not match the data file
+    """
+    from storage import recover_csv, upsert_csv
+
+    recover_csv(csv_path)
+    sealed = log.rotate()
+    rows = log.frame(sealed)
+    if rows.empty:
+        log.drop(sealed)
+        return 0
+    # Later records come last, so merge_fn lets them win like sequential runs
+    added = upsert_csv(rows, csv_path, time_column, merge_fn, journal=True, codec=codec)
+    if added is None:
+        raise RuntimeError(f"Logged columns do not match {csv_path}")
+    log.drop(sealed)
+    logging.info(f"Compacted {len(rows)} logged rows from {len(sealed)} segment(s) into {csv_path}")
+    return added
+
+
+def read_merged(csv_path: Path, log: WriteAheadLog, time_column: str, merge_fn: Callable,
+                start: Optional[str] = None):
+    """Rows from start onwards as they will be after compaction, without compacting.
+
+    Only the part of the data file from the earliest of start and the
+    oldest logged row is read.
+    """
+    import pandas as pd
+    from storage import find_tail_offset
+
+    logged = log.frame()
+    if not logged.empty:
+        logged = logged.sort_values(time_column, kind="stable")
+    window = min(filter(None, [start, logged[time_column].min() if not logged.empty else None]), default="")
+    base = pd.DataFrame()
+    if csv_path.exists():
+        with open(csv_path, "rb") as f:
+            header = f.readline()
+            f.seek(find_tail_offset(csv_path, window))
+            base = pd.read_csv(io.BytesIO(header + f.read()))
+    merged = merge_fn(logged, base) if not logged.empty else base
+    if start is not None and not merged.empty:
+        merged = merged[merged[time_column].astype(str) >= start]
+    return merged
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Inspect or compact the write-ahead logs")
+    parser.add_argument("command", choices=["status", "compact"])
+    parser.add_argument("--levels", nargs="+", default=None, help="Datasets to compact (default: all)")
+    args = parser.parse_args()
+
+    from ingest import LEVELS, load_levels
+
+    dirname = Path(os.path.dirname(os.path.abspath(__file__)))
+    modules = load_levels(dirname, args.levels or list(LEVELS))
+    for level, module in modules.items():
+        csv_path = dirname / module.OUTPUT_FILE
+        log = WriteAheadLog(dirname / WAL_DIR / csv_path.stem)
+        if args.command == "status":
+            records = list(log.records())
+            print(f"{level}: {len(records)} record(s), {sum(len(lines) for _, lines in records)} row(s) "
+                  f"in {len(log.segments())} segment(s)")
+        else:
+            codec = module.open_codec(csv_path) if hasattr(module, 'open_codec') else None
+            compact(csv_path, log, module.TIME_COLUMN, module.merge_data, codec)
+
+
+if __name__ == "__main__":
+    main()